@@ -0,0 +1,120 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Compiler cache support, e.g.
+#   board_build.compiler_cache = ccache
+# "yes" selects ccache, other values are taken as the cache executable
+# (e.g. sccache or an absolute path).
+#
+# The launcher is prepended to the compile command lines instead of CC/CXX,
+# so that every environment cloned later on (framework libraries, the
+# wifi-sdk mbl_env / envC, the library dependency finder) uses it, too.
+#
+
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+from os.path import basename
+
+from SCons.Script import Import
+
+Import("env")
+
+CCACHE_COUNTERS = {
+    "hits": ("direct_cache_hit", "preprocessed_cache_hit"),
+    "misses": ("cache_miss",),
+}
+
+
+def _get_ccache_stats(cache_tool, sysenv):
+    # machine readable statistics, available since ccache 4.0
+    result = subprocess.run(
+        [cache_tool, "--print-stats"], env=sysenv,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+    stats = {}
+    if result.returncode != 0:
+        return stats
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[key] = int(value)
+    return stats
+
+
+def _print_ccache_stats(cache_tool, sysenv, stats_before):
+    stats = _get_ccache_stats(cache_tool, sysenv)
+    if not stats:
+        return
+    delta = {
+        name: sum(stats.get(c, 0) - stats_before.get(c, 0) for c in counters)
+        for name, counters in CCACHE_COUNTERS.items()
+    }
+    total = delta["hits"] + delta["misses"]
+    if not total:
+        return
+    print("Compiler cache: %d hits, %d misses (%.1f%% hit rate)" % (
+        delta["hits"], delta["misses"], 100.0 * delta["hits"] / total))
+
+
+def _print_generic_stats(cache_tool, sysenv):
+    subprocess.run([cache_tool, "--show-stats"], env=sysenv)
+
+
+def configure_compiler_cache(env):
+    cache_tool = str(env.BoardConfig().get("build.compiler_cache", "no"))
+    if cache_tool.lower() in ("", "0", "no", "false"):
+        return
+    if cache_tool.lower() in ("1", "yes", "true"):
+        cache_tool = "ccache"
+    cache_tool_path = shutil.which(cache_tool, path=env["ENV"]["PATH"])
+    if not cache_tool_path:
+        sys.stderr.write(
+            "Warning! Compiler cache '%s' not found, building without it.\n" % cache_tool)
+        return
+
+    # paths below the project directory are rewritten to relative ones and
+    # mapped to "." in the debug information and __FILE__, so that cache
+    # hits survive different checkout locations, also for debug builds.
+    # Package paths stay absolute (debuggers find the framework sources
+    # through them), so the cache is only shared by installations with the
+    # same ~/.platformio location.
+    base_dir = env.subst("$PROJECT_DIR")
+    env.Append(CCFLAGS=["-ffile-prefix-map=%s=." % base_dir])
+    is_ccache = basename(cache_tool_path).lower().startswith("ccache")
+    if is_ccache:
+        env["ENV"]["CCACHE_BASEDIR"] = base_dir
+        env["ENV"]["CCACHE_NOHASHDIR"] = "1"
+    else:
+        env["ENV"]["SCCACHE_BASEDIRS"] = base_dir
+
+    launcher = '"%s"' % cache_tool_path
+    for cmd in ("CCCOM", "CXXCOM", "ASPPCOM"):
+        env[cmd] = "%s %s" % (launcher, env[cmd])
+
+    sysenv = os.environ.copy()
+    sysenv.update({k: str(v) for k, v in env["ENV"].items()})
+    if is_ccache:
+        atexit.register(
+            _print_ccache_stats, cache_tool_path, sysenv,
+            _get_ccache_stats(cache_tool_path, sysenv))
+    else:
+        atexit.register(_print_generic_stats, cache_tool_path, sysenv)
+
+
+if "BOARD" in env:
+    configure_compiler_cache(env)
@@ -0,0 +1,266 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Differential flashing for OpenOCD uploads, e.g.
+#   board_upload.differential = yes
+#   board_upload.flash_sectors = 4x16K, 64K, 7x128K   (optional, see below)
+# A record of the last uploaded image (a copy of it and the hashes of its
+# flash sectors) is kept per device (adapter serial number, see
+# Gd32Platform.get_adapter_id()) in the core dir cache. The next upload
+# only erases and programs the sectors that differ from it. Adapters whose
+# serial number can't be determined share one record per MCU.
+#
+# The record is only trusted if the device still holds the recorded image,
+# checked on the target with verify_image_checksum. Otherwise (other
+# firmware flashed in between, another board on the adapter, ...) the full
+# image is programmed. After a partial upload the whole image is checked
+# once more, on mismatch the full image is programmed, too.
+#
+# board_upload.flash_sectors is the erase sector layout from the start of
+# the flash, repeated until the end of the image (groups can be repeated,
+# e.g. "2x(4x16K, 64K, 7x128K), 4x256K"). The default is the layout
+# of the series from the reference manuals. Series with 1 / 2 / 4 KB pages
+# use 4 KB blocks, which always cover whole pages. For series without a
+# known layout, the full image is programmed unless
+# board_upload.flash_sectors is set.
+#
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+from os import makedirs
+from os.path import isdir, isfile, join
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+FLASH_ORIGIN = 0x08000000
+FLASH_SECTOR_LAYOUTS = {
+    # 1 KB pages
+    "gd32a50x": "4K",
+    "gd32c10x": "4K",
+    "gd32e10x": "4K",
+    "gd32e23x": "4K",
+    "gd32f1x0": "4K",
+    "gd32f3x0": "4K",
+    # 1 or 2 KB pages in the first 512 KB, 4 KB pages above
+    "gd32f10x": "4K",
+    "gd32f20x": "4K",
+    "gd32f30x": "4K",
+    "gd32f403": "4K",
+    # 4 KB pages
+    "gd32l23x": "4K",
+    "gd32h7xx": "4K",
+    "gd32h75e": "4K",
+    # 4 KB sectors of the SIP / QSPI flash
+    "gd32w51x": "4K",
+    "gd32vw55x": "4K",
+    # 8 KB pages
+    "gd32e50x": "8K",
+    "gd32e51x": "8K",
+    "gd32eprt": "8K",
+    # 4 x 16 KB, 64 KB, 7 x 128 KB per 1 MB bank, 256 KB sectors above 2 MB
+    "gd32f4xx": "2x(4x16K, 64K, 7x128K), 4x256K",
+}
+
+
+def IsDifferentialUploadEnabled(env):
+    return str(env.BoardConfig().get(
+        "upload.differential", "no")).lower() in ("1", "yes", "true")
+
+
+def _parse_size(value):
+    value = value.strip().upper()
+    for suffix, factor in (("K", 1024), ("M", 1024 * 1024)):
+        if value.endswith(suffix):
+            return int(value[:-1], 0) * factor
+    return int(value, 0)
+
+
+def get_flash_sector_layout(env):
+    """Sector sizes from the start of the flash, None if unknown"""
+    board = env.BoardConfig()
+    layout = board.get("upload.flash_sectors", "") or FLASH_SECTOR_LAYOUTS.get(
+        board.get("build.spl_series", "").lower())
+    if not layout:
+        return None
+    return parse_flash_sector_layout(layout)
+
+
+def parse_flash_sector_layout(layout):
+    """"2x(4x16K, 64K), 8K" -> [16384, 16384, 16384, 16384, 65536, ...]"""
+    sizes = []
+    for item in re.findall(r"(?:(?!0x)(\d+)\s*x\s*)?(\([^)]*\)|[^,\s()]+)", layout):
+        count, value = item
+        if value.startswith("("):
+            group = parse_flash_sector_layout(value[1:-1])
+        else:
+            group = [_parse_size(value)]
+        sizes.extend(group * int(count or 1))
+    return sizes
+
+
+def get_flash_sectors(layout, base, size):
+    """Returns (address, size) of all sectors overlapping [base, base + size)"""
+    sectors = []
+    address = FLASH_ORIGIN
+    i = 0
+    while address < base + size:
+        sector_size = layout[i % len(layout)]
+        if address + sector_size > base:
+            sectors.append((address, sector_size))
+        address += sector_size
+        i += 1
+    return sectors
+
+
+def get_sector_hashes(image, base, sectors):
+    """{"address:size": hash of the image data in the sector}"""
+    hashes = {}
+    for address, size in sectors:
+        data = image[max(address - base, 0):address + size - base]
+        hashes["0x%x:%d" % (address, size)] = hashlib.sha1(data).hexdigest()
+    return hashes
+
+
+def get_changed_chunks(record, image, base, sectors):
+    """Returns the changed sectors and the (address, data) chunks to program,
+    consecutive sectors are merged into one chunk"""
+    old_hashes = record["sectors"] if record["base"] == base else {}
+    new_hashes = get_sector_hashes(image, base, sectors)
+    changed = [
+        (address, size) for address, size in sectors
+        if old_hashes.get("0x%x:%d" % (address, size)) != new_hashes["0x%x:%d" % (address, size)]
+    ]
+    chunks = []
+    for address, size in changed:
+        start = max(address, base)
+        data = image[start - base:address + size - base]
+        if chunks and chunks[-1][0] + len(chunks[-1][1]) == start:
+            chunks[-1] = (chunks[-1][0], chunks[-1][1] + data)
+        else:
+            chunks.append((start, data))
+    return changed, chunks
+
+
+def _get_record_dir(env, device):
+    board = env.BoardConfig()
+    key = hashlib.sha1("\0".join([
+        board.get("build.mcu", ""), env.subst("$UPLOAD_PROTOCOL"), device or ""
+    ]).encode("utf-8")).hexdigest()[:16]
+    return join(env.subst("$PROJECT_CORE_DIR"), ".cache", "gd32-flash-records", key)
+
+
+def _tcl_path(path):
+    return "{%s}" % path.replace("\\", "/")
+
+
+def PrepareDifferentialUpload(env, source, device=None):
+    """Writes an OpenOCD script that programs source (a .bin file) into the
+    halted target. Returns the script path and a function that has to be
+    called after a successful upload to update the record."""
+    board = env.BoardConfig()
+    base = int(board.get("upload.offset_address", "0x08000000"), 0)
+    with open(source, "rb") as fp:
+        image = fp.read()
+    layout = get_flash_sector_layout(env)
+    if layout is None:
+        print("Warning! Flash sector layout of %s unknown, set board_upload.flash_sectors "
+              "for differential uploads. Programming the full image." % board.get(
+                  "build.spl_series", board.get("build.mcu", "")))
+    sectors = get_flash_sectors(layout, base, len(image)) if layout else []
+    record_dir = _get_record_dir(env, device)
+    record_path = join(record_dir, "record.json")
+    record_image = join(record_dir, "image.bin")
+    record = None
+    if layout and isfile(record_path) and isfile(record_image):
+        with open(record_path) as fp:
+            record = json.load(fp)
+
+    work_dir = join(env.subst("$BUILD_DIR"), "diff_flash")
+    if isdir(work_dir):
+        shutil.rmtree(work_dir)
+    makedirs(work_dir)
+    full_program = env.GetOpenOCDProgramCommands(source, "0x%x" % base)
+    lines = ["reset init"]
+    if record:
+        changed, chunks = get_changed_chunks(record, image, base, sectors)
+        partial_program = []
+        for i, (address, data) in enumerate(chunks):
+            chunk_path = join(work_dir, "chunk_%d.bin" % i)
+            with open(chunk_path, "wb") as fp:
+                fp.write(data)
+            partial_program.append(
+                "flash write_image erase %s 0x%x bin" % (_tcl_path(chunk_path), address))
+        lines.extend([
+            "if {[catch {verify_image_checksum %s 0x%x bin}]} {" % (
+                _tcl_path(record_image), record["base"]),
+            "    echo \"Device doesn't match the last upload, programming the full image\"",
+        ] + ["    " + c for c in full_program] + [
+            "} else {",
+            "    echo \"Programming %d changed of %d sectors\"" % (
+                len(changed), len(sectors)),
+        ] + ["    " + c for c in partial_program] + [
+            "    if {[catch {verify_image_checksum %s 0x%x bin}]} {" % (_tcl_path(source), base),
+            "        echo \"Verification failed, programming the full image\"",
+        ] + ["        " + c for c in full_program] + [
+            "    }",
+            "}",
+        ])
+    else:
+        lines.extend(full_program)
+    lines.extend(["reset run", ""])
+    script_path = join(work_dir, "upload.tcl")
+    with open(script_path, "w") as fp:
+        fp.write("\n".join(lines))
+
+    def _update_record():
+        if not layout:
+            return
+        if not isdir(record_dir):
+            makedirs(record_dir)
+        shutil.copyfile(source, record_image)
+        with open(record_path, "w") as fp:
+            json.dump({
+                "base": base,
+                "size": len(image),
+                "sectors": get_sector_hashes(image, base, sectors)
+            }, fp)
+
+    return script_path, _update_record
+
+
+def DifferentialUpload(env, openocd_args, source, device=None):
+    """One-shot OpenOCD upload of the changed sectors, returns an exit code"""
+    script_path, update_record = env.PrepareDifferentialUpload(source, device)
+    sysenv = os.environ.copy()
+    sysenv.update({k: str(v) for k, v in env["ENV"].items()})
+    openocd = shutil.which("openocd", path=sysenv["PATH"]) or "openocd"
+    result = subprocess.run(
+        [openocd] + [env.subst(arg) for arg in openocd_args] +
+        ["-c", "init", "-f", script_path, "-c", "shutdown"],
+        env=sysenv)
+    if result.returncode == 0:
+        update_record()
+    return result.returncode
+
+
+env.AddMethod(IsDifferentialUploadEnabled)
+env.AddMethod(PrepareDifferentialUpload)
+env.AddMethod(DifferentialUpload)
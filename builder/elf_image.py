@@ -0,0 +1,225 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# In-process replacement for "objcopy -O binary / ihex" and dfu-suffix.
+# The ELF file is memory-mapped, the contents of its loadable sections are
+# placed at their load addresses (LMA, taken from the PT_LOAD program
+# headers) and written straight from the mapping into the image.
+#
+# board_build.gap_fill = 0xFF fills the gaps between sections of .bin
+# images (default 0, like objcopy).
+#
+
+import mmap
+import struct
+import zlib
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+PT_LOAD = 1
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+IHEX_RECORD_SIZE = 16
+
+
+class ElfImageError(Exception):
+    pass
+
+
+class ElfImage(object):
+    """Loadable contents of an ELF file as (lma, memoryview) blocks"""
+
+    def __init__(self, path):
+        self._fp = open(path, "rb")
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+        self.sections = []
+        try:
+            self._parse()
+        except (ElfImageError, struct.error):
+            self.close()
+            raise ElfImageError("%s is not a valid ELF file" % path)
+
+    def _parse(self):
+        mm = self._mm
+        if mm[:4] != b"\x7fELF":
+            raise ElfImageError()
+        is_64 = mm[4] == 2
+        endian = "<" if mm[5] == 1 else ">"
+        if is_64:
+            header = struct.unpack_from(endian + "QQQIHHHHHH", mm, 24)
+        else:
+            header = struct.unpack_from(endian + "IIIIHHHHHH", mm, 24)
+        (self.entry, phoff, shoff, _, _, phentsize, phnum,
+         shentsize, shnum, shstrndx) = header
+
+        segments = []
+        for i in range(phnum):
+            if is_64:
+                p_type, _, p_offset, _, p_paddr, p_filesz = struct.unpack_from(
+                    endian + "IIQQQQ", mm, phoff + i * phentsize)
+            else:
+                p_type, p_offset, _, p_paddr, p_filesz = struct.unpack_from(
+                    endian + "IIIII", mm, phoff + i * phentsize)
+            if p_type == PT_LOAD and p_filesz:
+                segments.append((p_offset, p_filesz, p_paddr))
+
+        headers = []
+        for i in range(shnum):
+            if is_64:
+                sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size = struct.unpack_from(
+                    endian + "IIQQQQ", mm, shoff + i * shentsize)
+            else:
+                sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size = struct.unpack_from(
+                    endian + "IIIIII", mm, shoff + i * shentsize)
+            headers.append((sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size))
+        strtab_offset = headers[shstrndx][4] if shnum else 0
+
+        view = memoryview(mm)
+        self._views.append(view)
+        for sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size in headers:
+            if not (sh_flags & SHF_ALLOC) or sh_type == SHT_NOBITS or not sh_size:
+                continue
+            name_end = mm.find(b"\0", strtab_offset + sh_name)
+            name = mm[strtab_offset + sh_name:name_end].decode("utf-8", errors="replace")
+            lma = sh_addr
+            for p_offset, p_filesz, p_paddr in segments:
+                if p_offset <= sh_offset < p_offset + p_filesz:
+                    lma = p_paddr + sh_offset - p_offset
+                    break
+            data = view[sh_offset:sh_offset + sh_size]
+            self._views.append(data)
+            self.sections.append((name, lma, data))
+        self.sections.sort(key=lambda s: s[1])
+
+    def get_blocks(self, exclude=()):
+        return [(lma, data) for name, lma, data in self.sections if name not in exclude]
+
+    def close(self):
+        # the views have to be released before the mapping can be closed
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self.sections = []
+        self._mm.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_bin_image(elf_path, target_path, gap_fill=0, exclude=()):
+    with ElfImage(elf_path) as image, open(target_path, "wb") as fp:
+        blocks = image.get_blocks(exclude)
+        if not blocks:
+            return
+        address = blocks[0][0]
+        for lma, data in blocks:
+            if lma > address:
+                fp.write(bytes([gap_fill]) * (lma - address))
+            elif lma < address:
+                raise ElfImageError("Overlapping sections at 0x%08x" % lma)
+            fp.write(data)
+            address = lma + len(data)
+
+
+def _ihex_record(record_type, address, data=b""):
+    record = bytes([len(data), (address >> 8) & 0xFF, address & 0xFF, record_type]) + data
+    return b":%s%02X\r\n" % (record.hex().upper().encode(), -sum(record) & 0xFF)
+
+
+def write_hex_image(elf_path, target_path, exclude=()):
+    # same records as objcopy: extended segment addresses below 1 MB,
+    # extended linear addresses above
+    records = []
+    with ElfImage(elf_path) as image:
+        segbase = extbase = 0
+        for lma, data in image.get_blocks(exclude):
+            offset = 0
+            while offset < len(data):
+                address = lma + offset
+                if address > segbase + extbase + 0xFFFF:
+                    if extbase == 0 and address <= 0xFFFFF:
+                        segbase = address & 0xF0000
+                        records.append(_ihex_record(2, 0, struct.pack(">H", segbase >> 4)))
+                    else:
+                        if segbase:
+                            segbase = 0
+                            records.append(_ihex_record(2, 0, b"\0\0"))
+                        extbase = address & 0xFFFF0000
+                        records.append(_ihex_record(4, 0, struct.pack(">H", extbase >> 16)))
+                record_address = address - segbase - extbase
+                # records don't cross 64 KB boundaries
+                size = min(IHEX_RECORD_SIZE, len(data) - offset, 0x10000 - record_address)
+                records.append(_ihex_record(
+                    0, record_address, bytes(data[offset:offset + size])))
+                offset += size
+        if image.entry > 0xFFFFF:
+            records.append(_ihex_record(5, 0, struct.pack(">I", image.entry)))
+        elif image.entry:
+            records.append(_ihex_record(3, 0, struct.pack(
+                ">HH", (image.entry & 0xF0000) >> 4, image.entry & 0xFFFF)))
+    records.append(_ihex_record(1, 0))
+    with open(target_path, "wb") as fp:
+        fp.write(b"".join(records))
+
+
+def append_dfu_suffix(path, vid, pid, device=0xFFFF):
+    """Same as "dfu-suffix -v vid -p pid -d device -a path" (DFU 1.0 suffix)"""
+    with open(path, "rb") as fp:
+        crc = zlib.crc32(fp.read())
+    suffix = struct.pack("<HHHH3sB", device, pid, vid, 0x0100, b"UFD", 16)
+    crc = zlib.crc32(suffix, crc)
+    with open(path, "ab") as fp:
+        # dfu-util's CRC is the CRC-32 without the final inversion
+        fp.write(suffix + struct.pack("<I", crc ^ 0xFFFFFFFF))
+
+
+def get_gap_fill(env):
+    return int(str(env.BoardConfig().get("build.gap_fill", "0")), 0) & 0xFF
+
+
+def ElfToBinAction(env):
+    gap_fill = get_gap_fill(env)
+
+    # gap_fill is a default argument, so that it's part of the action signature
+    def _elf_to_bin(target, source, env, gap_fill=gap_fill):
+        write_bin_image(source[0].get_abspath(), target[0].get_abspath(), gap_fill)
+
+    return env.VerboseAction(_elf_to_bin, "Building $TARGET")
+
+
+def ElfToHexAction(env):
+    def _elf_to_hex(target, source, env, exclude=(".eeprom",)):
+        write_hex_image(source[0].get_abspath(), target[0].get_abspath(), exclude)
+
+    return env.VerboseAction(_elf_to_hex, "Building $TARGET")
+
+
+def DfuSuffixAction(env, vid, pid):
+    def _dfu_suffix(target, source, env, vid=int(vid, 16), pid=int(pid, 16)):
+        append_dfu_suffix(target[0].get_abspath(), vid, pid)
+
+    return env.VerboseAction(_dfu_suffix, "Adding dfu suffix to $TARGET")
+
+
+env.AddMethod(ElfToBinAction)
+env.AddMethod(ElfToHexAction)
+env.AddMethod(DfuSuffixAction)
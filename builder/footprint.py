@@ -0,0 +1,328 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# "pio run -t footprint": flash / RAM usage per library (FrameworkSPL,
+# lwIP, mbedtls_ssl, libc_nano, ...), per object file and per symbol.
+# The input sections are taken from the linker map file next to the ELF
+# file, the symbols from its symbol table. Without a map file only the
+# symbols are reported.
+#
+# Every run stores a snapshot in $PROJECT_BUILD_DIR/footprint-${PIOENV}.json
+# and prints the items that grew the most against the snapshot of the
+# previous firmware, or against a baseline snapshot:
+#   board_build.footprint_baseline = footprint-baseline.json
+#   board_build.footprint_top = 10            (items printed per breakdown)
+#   board_build.footprint_max_growth = 512    (fail if flash or RAM grew more)
+# The report is written to $BUILD_DIR/footprint.json for CI jobs. The
+# snapshot of a build without board_build.use_lto is the reference for the
+# size comparison printed by LTO builds.
+#
+
+import hashlib
+import json
+import re
+import sys
+from bisect import bisect_right
+from os.path import basename, isfile, join, relpath, splitext
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+FOOTPRINT_FORMAT_VERSION = 1
+MAP_START_MARKER = "Linker script and memory map"
+# " .text.main    0x08000194       0x2c src/main.o", the address part may
+# follow on the next line for long section names
+INPUT_SECTION_RE = re.compile(
+    r"^ (?P<name>[^\s*][^\s]*)(?:\s+0x(?P<address>[0-9a-fA-F]+)\s+0x(?P<size>[0-9a-fA-F]+)\s+(?P<object>.+))?$")
+CONTINUATION_RE = re.compile(
+    r"^\s+0x(?P<address>[0-9a-fA-F]+)\s+0x(?P<size>[0-9a-fA-F]+)\s+(?P<object>.+)$")
+OUTPUT_SECTION_RE = re.compile(r"^(?P<name>\.[^\s]+|[A-Za-z_][^\s]*)(?:\s+0x[0-9a-fA-F]+.*)?$")
+ARCHIVE_MEMBER_RE = re.compile(r"^(?P<archive>.+\.a)\((?P<member>[^)]+)\)$")
+
+
+class FootprintError(Exception):
+    pass
+
+
+def parse_map_file(content):
+    """Returns the input sections of the memory map as
+    [(output section, input section, address, size, object)]"""
+    start = content.find(MAP_START_MARKER)
+    if start < 0:
+        raise FootprintError("No memory map found in the map file")
+    sections = []
+    output_section = None
+    pending = None
+    for line in content[start:].splitlines()[1:]:
+        if pending:
+            match = CONTINUATION_RE.match(line)
+            if match:
+                sections.append((
+                    output_section, pending, int(match.group("address"), 16),
+                    int(match.group("size"), 16), match.group("object").strip()))
+            pending = None
+            continue
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            match = OUTPUT_SECTION_RE.match(line)
+            output_section = match.group("name") if match else None
+            continue
+        match = INPUT_SECTION_RE.match(line)
+        if not match or not output_section:
+            continue
+        if match.group("address") is None:
+            pending = match.group("name")
+            continue
+        sections.append((
+            output_section, match.group("name"), int(match.group("address"), 16),
+            int(match.group("size"), 16), match.group("object").strip()))
+    return [s for s in sections if s[3]]
+
+
+def _strip_build_dir(obj, build_dirs):
+    path = obj.replace("\\", "/")
+    for build_dir in build_dirs:
+        build_dir = build_dir.replace("\\", "/").rstrip("/")
+        if path.startswith(build_dir + "/"):
+            return path[len(build_dir) + 1:]
+    return path
+
+
+def get_library_name(obj, build_dirs):
+    """libFrameworkSPL.a(gd32f30x_gpio.o) -> FrameworkSPL, objects are
+    grouped by their top level folder in the build dir (e.g. src)"""
+    match = ARCHIVE_MEMBER_RE.match(obj)
+    if match:
+        name = splitext(basename(match.group("archive")))[0]
+        return name[3:] if name.startswith("lib") else name
+    path = _strip_build_dir(obj, build_dirs)
+    if path == obj.replace("\\", "/") or "/" not in path:
+        # startup files of the toolchain, linker generated sections, ...
+        return "other"
+    return path.split("/")[0]
+
+
+def get_object_name(obj, build_dirs):
+    match = ARCHIVE_MEMBER_RE.match(obj)
+    if match:
+        return "%s(%s)" % (basename(match.group("archive")), match.group("member"))
+    return _strip_build_dir(obj, build_dirs)
+
+
+def _get_output_sections(elf):
+    """{section name: (flash, ram)}, .data is in both"""
+    from elftools.elf.constants import SH_FLAGS
+    result = {}
+    for section in elf.iter_sections():
+        flags = section["sh_flags"]
+        if not flags & SH_FLAGS.SHF_ALLOC or not section["sh_size"]:
+            continue
+        result[section.name] = (
+            section["sh_type"] != "SHT_NOBITS", bool(flags & SH_FLAGS.SHF_WRITE))
+    return result
+
+
+def _add_usage(breakdown, key, usage, size):
+    item = breakdown.setdefault(key, {"flash": 0, "ram": 0})
+    if usage[0]:
+        item["flash"] += size
+    if usage[1]:
+        item["ram"] += size
+
+
+def get_footprint(elf_path, map_path, build_dirs):
+    """build_dirs: the build dir as absolute path and relative to the
+    project dir, as the map file may contain both"""
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.sections import SymbolTableSection
+
+    footprint = {
+        "version": FOOTPRINT_FORMAT_VERSION,
+        "totals": {"flash": 0, "ram": 0},
+        "libraries": {},
+        "objects": {},
+        "symbols": {},
+    }
+    with open(elf_path, "rb") as fp:
+        footprint["elf_hash"] = hashlib.sha1(fp.read()).hexdigest()
+        fp.seek(0)
+        elf = ELFFile(fp)
+        output_sections = _get_output_sections(elf)
+        for name, usage in output_sections.items():
+            _add_usage(footprint, "totals", usage, elf.get_section_by_name(name)["sh_size"])
+
+        # object of each address, from the input sections of the map file
+        ranges = []
+        if map_path and isfile(map_path):
+            with open(map_path, errors="replace") as mp:
+                input_sections = parse_map_file(mp.read())
+            for output_section, _, address, size, obj in input_sections:
+                usage = output_sections.get(output_section)
+                if not usage:
+                    continue
+                obj_name = get_object_name(obj, build_dirs)
+                _add_usage(footprint["objects"], obj_name, usage, size)
+                _add_usage(
+                    footprint["libraries"], get_library_name(obj, build_dirs), usage, size)
+                ranges.append((address, size, obj_name))
+        ranges.sort()
+        starts = [r[0] for r in ranges]
+
+        is_arm = elf["e_machine"] == "EM_ARM"
+        for section in elf.iter_sections():
+            if not isinstance(section, SymbolTableSection):
+                continue
+            for symbol in section.iter_symbols():
+                if (symbol["st_info"]["type"] not in ("STT_FUNC", "STT_OBJECT")
+                        or not symbol["st_size"] or not symbol.name):
+                    continue
+                shndx = symbol["st_shndx"]
+                if not isinstance(shndx, int):
+                    continue
+                usage = output_sections.get(elf.get_section(shndx).name)
+                if not usage:
+                    continue
+                address = symbol["st_value"]
+                if is_arm and symbol["st_info"]["type"] == "STT_FUNC":
+                    # Thumb bit
+                    address &= ~1
+                _add_usage(footprint["symbols"], symbol.name, usage, symbol["st_size"])
+                i = bisect_right(starts, address) - 1
+                if i >= 0 and address < ranges[i][0] + ranges[i][1]:
+                    footprint["symbols"][symbol.name]["object"] = ranges[i][2]
+    return footprint
+
+
+def get_growth(current, reference, top):
+    """Returns {breakdown: [(name, flash delta, ram delta)]} of the top items
+    with the largest growth"""
+    growth = {}
+    for breakdown in ("libraries", "objects", "symbols"):
+        old, new = reference.get(breakdown, {}), current[breakdown]
+        items = []
+        for name in set(old) | set(new):
+            zero = {"flash": 0, "ram": 0}
+            delta = (
+                new.get(name, zero)["flash"] - old.get(name, zero)["flash"],
+                new.get(name, zero)["ram"] - old.get(name, zero)["ram"])
+            if delta != (0, 0):
+                items.append((name, delta[0], delta[1]))
+        items.sort(key=lambda item: (item[1] + item[2], item[1]), reverse=True)
+        growth[breakdown] = items[:top]
+    return growth
+
+
+def _load_json(path):
+    if not isfile(path):
+        return None
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except ValueError:
+        return None
+
+
+def _print_breakdown(title, items, with_delta):
+    if not items:
+        return
+    print("%s:" % title)
+    for name, flash, ram in items:
+        if with_delta:
+            print("  %+8d %+8d  %s" % (flash, ram, name))
+        else:
+            print("  %8d %8d  %s" % (flash, ram, name))
+
+
+def Footprint(target, source, env):
+    board = env.BoardConfig()
+    elf_path = source[0].get_abspath()
+    build_dir = env.subst("$BUILD_DIR")
+    top = int(board.get("build.footprint_top", 10))
+    try:
+        current = get_footprint(
+            elf_path, splitext(elf_path)[0] + ".map",
+            (build_dir, relpath(build_dir, env.subst("$PROJECT_DIR"))))
+    except (FootprintError, OSError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    # LTO builds compare their size against the last non-LTO snapshot
+    current["lto"] = "-flto" in env.get("CCFLAGS", [])
+
+    # the snapshots are kept one level above $BUILD_DIR, so that they
+    # survive a full rebuild. A snapshot of an unchanged firmware doesn't
+    # replace the previous one.
+    history_path = env.subst(join("$PROJECT_BUILD_DIR", "footprint-${PIOENV}.json"))
+    history = _load_json(history_path) or {}
+    if history.get("version") != FOOTPRINT_FORMAT_VERSION:
+        history = {"version": FOOTPRINT_FORMAT_VERSION}
+    if history.get("latest", {}).get("elf_hash") != current["elf_hash"]:
+        history["previous"] = history.get("latest")
+        history["latest"] = current
+        with open(history_path, "w") as fp:
+            json.dump(history, fp)
+
+    reference_name = "previous build"
+    reference = history.get("previous")
+    baseline = board.get("build.footprint_baseline", "")
+    if baseline:
+        baseline = join(env.subst("$PROJECT_DIR"), baseline)
+        snapshot = _load_json(baseline)
+        if not snapshot:
+            sys.stderr.write("Error: Could not read footprint baseline %s\n" % baseline)
+            return 1
+        # a whole history file or a single snapshot
+        reference = snapshot.get("latest", snapshot)
+        reference_name = "baseline"
+
+    totals = current["totals"]
+    report = {"totals": totals, "reference": None, "growth": None, "current": current}
+    print("Flash: %d bytes, RAM: %d bytes" % (totals["flash"], totals["ram"]))
+    if reference:
+        delta = {r: totals[r] - reference["totals"][r] for r in ("flash", "ram")}
+        growth = get_growth(current, reference, top)
+        report["reference"] = reference_name
+        report["delta"] = delta
+        report["growth"] = growth
+        print("Against the %s: flash %+d bytes, RAM %+d bytes" % (
+            reference_name, delta["flash"], delta["ram"]))
+        print("     flash      ram")
+        for breakdown in ("libraries", "objects", "symbols"):
+            _print_breakdown(breakdown.capitalize(), growth[breakdown], True)
+    else:
+        print("     flash      ram")
+        for breakdown in ("libraries", "symbols"):
+            items = sorted(
+                ((name, v["flash"], v["ram"]) for name, v in current[breakdown].items()),
+                key=lambda item: item[1] + item[2], reverse=True)
+            _print_breakdown("Largest %s" % breakdown, items[:top], False)
+
+    with open(join(build_dir, "footprint.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    max_growth = board.get("build.footprint_max_growth", "")
+    if reference and str(max_growth) != "":
+        exceeded = [r for r in ("flash", "ram") if report["delta"][r] > int(max_growth)]
+        if exceeded:
+            sys.stderr.write("Error: %s grew by more than %s bytes against the %s\n" % (
+                " and ".join(exceeded), max_growth, reference_name))
+            return 1
+    return None
+
+
+env.AddMethod(
+    lambda env: env.VerboseAction(Footprint, "Calculating footprint of $SOURCE"),
+    "FootprintAction")
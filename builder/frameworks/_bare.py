@@ -82,12 +82,3 @@ if "BOARD" in env:
 
 # copy CCFLAGS to ASFLAGS (-x assembler-with-cpp mode)
 env.Append(ASFLAGS=env.get("CCFLAGS", [])[:])
-
-# create .lst file
-env.AddPostAction(
-    "$BUILD_DIR/${PROGNAME}.elf",
-    env.VerboseAction(" ".join([
-        "$OBJDUMP", "-drwC",
-        "$BUILD_DIR/${PROGNAME}.elf", ">", "$BUILD_DIR/${PROGNAME}.lst"
-    ]), "Building .pio/build/$PIOENV/${PROGNAME}.lst")
-)
\ No newline at end of file
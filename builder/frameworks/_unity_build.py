@@ -0,0 +1,228 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Unity (jumbo) builds for framework libraries.
+# With board_build.framework_unity_build = yes, env.BuildUnityLibrary()
+# concatenates the C sources of a library into batches of
+# board_build.framework_unity_batch_size files (default 32), each compiled
+# as a single translation unit. Files whose file-local symbols (static
+# functions / variables, types, local macros) would clash with another file
+# of a batch are put into a different batch. Files that define macros before
+# an #include (e.g. to configure a header, which has no effect once its
+# include guard is set by another file of the batch) are compiled on their
+# own. If a batch still fails to compile, its sources are compiled one by
+# one in the same build.
+#
+
+import fnmatch
+import re
+import shutil
+from os import makedirs
+from os.path import basename, isdir, isfile, join, splitext
+
+from SCons.Script import Action, DefaultEnvironment
+
+env = DefaultEnvironment()
+
+IDENTIFIER_RE = re.compile(r"\b[A-Za-z_]\w*\b")
+# file scope static functions and variables start at column 0
+STATIC_SYMBOL_RE = re.compile(
+    r"^static\b[^;{(=\[]*?\b([A-Za-z_]\w*)\s*(?:\(|=|;|\[)", re.M)
+# file scope struct / union / enum tags and typedef names
+TAG_RE = re.compile(r"^(?:typedef\s+)?(?:struct|union|enum)\s+([A-Za-z_]\w*)\s*\{", re.M)
+TYPEDEF_RE = re.compile(
+    r"^typedef\b[^;{]*?(?:\(\s*\*\s*([A-Za-z_]\w*)\s*\)|\b([A-Za-z_]\w*))\s*(?:\[[^\]]*\]\s*)?[;(]",
+    re.M)
+TYPEDEF_END_RE = re.compile(r"^(?:typedef\b[^\n]*)?\}\s*([A-Za-z_]\w*)\s*;", re.M)
+LOCAL_MACRO_RE = re.compile(r"^\s*#\s*define\s+([A-Za-z_]\w*)", re.M)
+MACRO_CHANGE_RE = re.compile(r"^\s*#\s*(?:define|undef)\b", re.M)
+INCLUDE_RE = re.compile(r"^\s*#\s*include\b", re.M)
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+
+
+def is_unity_build_enabled(env):
+    return str(env.BoardConfig().get(
+        "build.framework_unity_build", "no")).lower() in ("1", "yes", "true")
+
+
+def get_unity_batch_size(env):
+    return max(int(env.BoardConfig().get("build.framework_unity_batch_size", 32)), 1)
+
+
+class UnitySource(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, errors="ignore") as fp:
+            content = COMMENT_RE.sub("", fp.read())
+        self.statics = set(STATIC_SYMBOL_RE.findall(content))
+        self.statics.update(TAG_RE.findall(content))
+        self.statics.update(a or b for a, b in TYPEDEF_RE.findall(content))
+        self.statics.update(TYPEDEF_END_RE.findall(content))
+        self.macros = set(LOCAL_MACRO_RE.findall(content))
+        self.identifiers = set(IDENTIFIER_RE.findall(content))
+        # a macro defined before an #include may configure that header
+        first_macro = MACRO_CHANGE_RE.search(content)
+        includes = [m.start() for m in INCLUDE_RE.finditer(content)]
+        self.configures_headers = bool(
+            first_macro and includes and first_macro.start() < includes[-1])
+
+
+class UnityBatch(object):
+
+    def __init__(self):
+        self.sources = []
+        self.statics = set()
+        self.macros = set()
+        self.identifiers = set()
+
+    def conflicts_with(self, source):
+        # two static symbols or types with the same name are a redefinition,
+        # a local macro of one file would silently rewrite the code of the
+        # other one.
+        return bool(
+            self.statics & source.statics
+            or self.macros & source.identifiers
+            or source.macros & self.identifiers
+        )
+
+    def add(self, source):
+        self.sources.append(source)
+        self.statics |= source.statics
+        self.macros |= source.macros
+        self.identifiers |= source.identifiers
+
+
+def get_unity_batches(paths, batch_size):
+    batches = []
+    for path in paths:
+        source = UnitySource(path)
+        if source.configures_headers:
+            batch = UnityBatch()
+            batch.add(source)
+            batches.append(batch)
+            continue
+        for batch in batches:
+            if batch.sources[0].configures_headers:
+                continue
+            if len(batch.sources) < batch_size and not batch.conflicts_with(source):
+                batch.add(source)
+                break
+        else:
+            batch = UnityBatch()
+            batch.add(source)
+            batches.append(batch)
+    return batches
+
+
+def write_if_changed(path, content):
+    if isfile(path):
+        with open(path) as fp:
+            if fp.read() == content:
+                return
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def compile_unity_batch(target, source, env):
+    """Compiles the batch into target[0], or if that fails, its sources
+    one by one into target[1:]. The objects that are not used are copies
+    of an empty object, all of them go into the library."""
+    compile_action = Action("$CCCOM", "$CCCOMSTR")
+    empty_object = env.subst("$UNITY_EMPTY_OBJECT")
+    if not compile_action(target[:1], source, env):
+        for obj in target[1:]:
+            shutil.copyfile(empty_object, obj.get_abspath())
+        return 0
+    print("Warning: %s failed to compile, compiling its sources separately" % (
+        basename(source[0].get_path())))
+    for obj, path in zip(target[1:], env["UNITY_SOURCES"]):
+        if compile_action([obj], [env.File(path)], env):
+            return 1
+    shutil.copyfile(empty_object, target[0].get_abspath())
+    return 0
+
+
+def apply_build_middlewares(env, node):
+    # same as CollectBuildFiles() does for the regular source nodes
+    for callback, pattern in env.get("__PIO_BUILD_MIDDLEWARES", []):
+        if pattern and not fnmatch.fnmatch(node.srcnode().get_path(), pattern):
+            continue
+        if callback.__code__.co_argcount == 2:
+            node = callback(env, node)
+        else:
+            node = callback(node)
+        if not node:
+            break
+    return node
+
+
+def BuildUnityLibrary(env, variant_dir, src_dir, src_filter=None):
+    if not is_unity_build_enabled(env):
+        return env.BuildLibrary(variant_dir, src_dir, src_filter=src_filter)
+
+    src_dir = env.subst(src_dir)
+    c_sources = sorted(env.MatchSourceFiles(src_dir, src_filter, ["c"]))
+    batches = [
+        b for b in get_unity_batches(
+            [join(src_dir, f) for f in c_sources], get_unity_batch_size(env))
+        if len(b.sources) > 1
+    ]
+
+    unity_dir = join(env.subst(variant_dir), "unity")
+    if batches and not isdir(unity_dir):
+        makedirs(unity_dir)
+    nodes = []
+    merged_files = []
+    empty_object = None
+    for i, batch in enumerate(batches):
+        unity_file = join(unity_dir, "unity_%d.c" % i)
+        write_if_changed(unity_file, "".join(
+            '#include "%s"\n' % s.path.replace("\\", "/") for s in batch.sources))
+        merged_files.extend(s.path for s in batch.sources)
+        node = apply_build_middlewares(env, env.File(unity_file))
+        if node is None or node != env.File(unity_file):
+            # removed or replaced by a middleware (e.g. with other flags)
+            if node:
+                nodes.append(node)
+            continue
+        if empty_object is None:
+            empty_file = join(unity_dir, "unity_empty.c")
+            write_if_changed(empty_file, "typedef int unity_empty_t;\n")
+            empty_object = env.Object(join(unity_dir, "unity_empty"), empty_file)
+        objects = env.Command(
+            [join(unity_dir, "unity_%d${OBJSUFFIX}" % i)] + [
+                join(unity_dir, "unity_%d" % i, "%d_%s${OBJSUFFIX}" % (
+                    j, splitext(basename(s.path))[0]))
+                for j, s in enumerate(batch.sources)],
+            node,
+            Action(compile_unity_batch, None),
+            UNITY_SOURCES=[s.path for s in batch.sources],
+            UNITY_EMPTY_OBJECT=empty_object[0].get_abspath())
+        env.Depends(objects, empty_object)
+        nodes.extend(objects)
+
+    # everything else (assembly, C++, standalone C files) is built as usual
+    src_filter = src_filter or "+<*>"
+    if isinstance(src_filter, (list, tuple)):
+        src_filter = " ".join(src_filter)
+    src_filter = " ".join([src_filter] + [
+        "-<%s>" % f for f in c_sources if join(src_dir, f) in merged_files
+    ])
+    nodes.extend(env.CollectBuildFiles(variant_dir, src_dir, src_filter))
+    return env.BuildLibrary(variant_dir, src_dir, nodes=nodes)
+
+
+env.AddMethod(BuildUnityLibrary)
@@ -21,16 +21,29 @@ The idea is to save the user (the new user, in particular) having to deal
 directly with the registers.
 """
 
-from os.path import isdir, isfile, join, dirname, realpath
+import hashlib
+import json
+import re
+import shutil
+from contextlib import contextmanager
+from os import listdir, makedirs, remove, replace, stat, utime, walk
+from os.path import basename, isdir, isfile, join, dirname, realpath, splitext
 from string import Template
 
-from SCons.Script import DefaultEnvironment
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from SCons.Script import Action, DefaultEnvironment
 
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 
 env.SConscript("_bare.py")
+env.SConscript("_unity_build.py")
 
 is_riscv = board.get("build.mcu", "").startswith("gd32vw")
 
@@ -51,10 +64,6 @@ if activate_semihosting:
 else:
     env.Append(LINKFLAGS=["--specs=nosys.specs", "--specs=nano.specs"])
 
-# make it easure to enable LTO
-if get_flag_value("use_lto", False):
-    env.Append(LINKFLAGS=["-flto"])
-
 FRAMEWORK_DIR = platform.get_package_dir("framework-spl-gd32")
 assert isdir(FRAMEWORK_DIR)
 
@@ -89,8 +98,13 @@ def get_linker_script(mcu):
     if isfile(ldscript):
         return ldscript
 
-    default_ldscript = join(FRAMEWORK_DIR, "platformio",
-                            "ldscripts", mcu[:-2].upper() + "_DEFAULT.ld")
+    # rendered into the build directory instead of the shared framework package,
+    # so that parallel builds of different environments don't race on it.
+    build_dir = env.subst("$BUILD_DIR")
+    if not isdir(build_dir):
+        makedirs(build_dir)
+    default_ldscript = join(build_dir, mcu[:-2].upper() + "_DEFAULT.ld")
+    default_ldscript_hash = default_ldscript + ".sha256"
 
     ram = board.get("upload.maximum_ram_size", 0)
     ram_start = str(board.get("upload.ram_start", "0x20000000"))
@@ -99,20 +113,38 @@ def get_linker_script(mcu):
     flash_start = int(board.get("upload.offset_address", "0x8000000"), 0)
     template_file = join(FRAMEWORK_DIR, "platformio",
                          "ldscripts", "tpl", "linker.tpl")
-    content = ""
     with open(template_file) as fp:
-        data = Template(fp.read())
-        content = data.substitute(
-            stack=hex(int(ram_start, base=0) + ram), # 0x20000000 - usual start address for RAM
-            ramstart=ram_start,
-            ram=str(int(ram/1024)) + "K",
-            ccram=str(int(ccram/1024)) + "K", # Closely coupled RAM - not all parts have this
-            flash=str(int(flash/1024)) + "K",
-            flash_start=hex(flash_start)
-        )
+        template = fp.read()
+
+    # skip rendering if neither the template nor the memory parameters changed
+    key = hashlib.sha256("\n".join([
+        template, str(ram), ram_start, str(ccram), str(flash), hex(flash_start)
+    ]).encode()).hexdigest()
+    if isfile(default_ldscript) and isfile(default_ldscript_hash):
+        with open(default_ldscript_hash) as fp:
+            if fp.read().strip() == key:
+                return default_ldscript
+
+    content = Template(template).substitute(
+        stack=hex(int(ram_start, base=0) + ram), # 0x20000000 - usual start address for RAM
+        ramstart=ram_start,
+        ram=str(int(ram/1024)) + "K",
+        ccram=str(int(ccram/1024)) + "K", # Closely coupled RAM - not all parts have this
+        flash=str(int(flash/1024)) + "K",
+        flash_start=hex(flash_start)
+    )
 
-    with open(default_ldscript, "w") as fp:
-        fp.write(content)
+    # only touch the file if the content actually differs, so that its
+    # timestamp and signature stay stable and no relink is triggered.
+    old_content = None
+    if isfile(default_ldscript):
+        with open(default_ldscript) as fp:
+            old_content = fp.read()
+    if content != old_content:
+        with open(default_ldscript, "w") as fp:
+            fp.write(content)
+    with open(default_ldscript_hash, "w") as fp:
+        fp.write(key)
 
     return default_ldscript
 
@@ -181,23 +213,6 @@ if not board.get("build.ldscript", ""):
 # Configure standard library
 cpp_defines = env.Flatten(env.get("CPPDEFINES", []))
 process_standard_library_configuration(cpp_defines)
-#
-# Target: Build SPL Library
-#
-
-extra_flags = board.get("build.extra_flags", "")
-src_filter_patterns = ["+<*>"]
-# could come in handy later to exclude certain files, not needed / trigger now
-
-libs = []
-
-libs.append(env.BuildLibrary(
-    join("$BUILD_DIR", "FrameworkCMSISVariant"),
-    join(
-        FRAMEWORK_DIR, spl_chip_type, "cmsis",
-        "variants", spl_series
-    )
-))
 
 # Build built-in startup file if wanted
 use_builtin_startup_file = board.get("build.spl_build_startup_file", True)
@@ -222,15 +237,6 @@ if use_builtin_startup_file:
         startup_file_filter
     )
 
-libs.append(env.BuildLibrary(
-    join("$BUILD_DIR", "FrameworkSPL"),
-    join(FRAMEWORK_DIR, spl_chip_type,
-         "spl", "variants", spl_series, "src"),
-    src_filter=" ".join(src_filter_patterns)
-))
-
-env.Append(LIBS=libs)
-
 # include optional SPL libraries into the library search path for the LDF
 # can be put in board def file, or overridden in the platformio.ini with
 # board_build.spl_libs = no
@@ -312,3 +318,467 @@ def configure_printf_lib():
         ])
 
 configure_printf_lib()
+
+# make it easy to enable LTO.
+# project, SPL and CMSIS objects are all compiled into LTO bytecode, the
+# archives are created with gcc-ar / gcc-ranlib (see main.py) so that the
+# linker plugin can see them. -ffat-lto-objects keeps the archives usable
+# for non-LTO links (e.g. when shared through the SPL cache).
+def configure_lto():
+    if not get_flag_value("use_lto", False):
+        return
+    env.Append(
+        CCFLAGS=["-flto", "-ffat-lto-objects"],
+        # run LTRANS partitions in parallel
+        LINKFLAGS=["-flto=auto", "-fuse-linker-plugin"]
+    )
+    env.AddPostAction(
+        join("$BUILD_DIR", "${PROGNAME}.elf"),
+        env.VerboseAction(report_lto_size_delta, "Comparing LTO firmware size")
+    )
+
+def get_elf_memory_usage(elf_path):
+    from elftools.elf.constants import SH_FLAGS
+    from elftools.elf.elffile import ELFFile
+    flash = ram = 0
+    with open(elf_path, "rb") as fp:
+        for section in ELFFile(fp).iter_sections():
+            flags = section["sh_flags"]
+            if not flags & SH_FLAGS.SHF_ALLOC or not section["sh_size"]:
+                continue
+            if section["sh_type"] != "SHT_NOBITS":
+                flash += section["sh_size"]
+            if flags & SH_FLAGS.SHF_WRITE:
+                ram += section["sh_size"]
+    return {"flash": flash, "ram": ram}
+
+def get_nolto_reference_sizes(env):
+    # the snapshots of "pio run -t footprint", one level above $BUILD_DIR,
+    # so that they survive the full rebuild when switching LTO on or off.
+    history_path = env.subst(join("$PROJECT_BUILD_DIR", "footprint-${PIOENV}.json"))
+    if not isfile(history_path):
+        return None
+    try:
+        with open(history_path) as fp:
+            history = json.load(fp)
+    except ValueError:
+        return None
+    for snapshot in (history.get("latest"), history.get("previous")):
+        if snapshot and snapshot.get("lto") is False:
+            return snapshot["totals"]
+    return None
+
+def report_lto_size_delta(target, source, env):
+    reference = get_nolto_reference_sizes(env)
+    if not reference:
+        print("Run \"pio run -t footprint\" without use_lto to compare the "
+              "LTO firmware size against a non-LTO build")
+        return
+    sizes = get_elf_memory_usage(target[0].get_abspath())
+    for region in ("flash", "ram"):
+        delta = sizes[region] - reference[region]
+        print("LTO %s: %d bytes (%+d bytes / %+.1f%% against non-LTO build)" % (
+            region, sizes[region], delta,
+            100.0 * delta / reference[region] if reference[region] else 0))
+
+configure_lto()
+
+#
+# Global cache for the prebuilt SPL / CMSIS variant archives.
+# Shared between all projects and environments, can be turned on with
+# board_build.spl_cache = yes
+#
+
+SPL_CACHE_DIR = join(env.subst("$PROJECT_CORE_DIR"), ".cache", "gd32-spl")
+SPL_CACHE_STATS_FILE = join(SPL_CACHE_DIR, "stats.json")
+SPL_CACHE_LOCK_FILE = join(SPL_CACHE_DIR, "stats.lock")
+
+def get_spl_cache_size_limit():
+    # in megabytes
+    return int(board.get("build.spl_cache_size", 256)) * 1024 * 1024
+
+@contextmanager
+def lock_spl_cache_stats():
+    # the stats file is shared between parallel builds of all projects
+    if not isdir(SPL_CACHE_DIR):
+        makedirs(SPL_CACHE_DIR)
+    with open(SPL_CACHE_LOCK_FILE, "a") as fp:
+        if fcntl:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+def load_spl_cache_stats():
+    if not isfile(SPL_CACHE_STATS_FILE):
+        return {"hits": 0, "misses": 0, "evictions": 0}
+    try:
+        with open(SPL_CACHE_STATS_FILE) as fp:
+            return json.load(fp)
+    except ValueError:
+        return {"hits": 0, "misses": 0, "evictions": 0}
+
+def update_spl_cache_stats(**increments):
+    with lock_spl_cache_stats():
+        stats = load_spl_cache_stats()
+        for key, value in increments.items():
+            stats[key] = stats.get(key, 0) + value
+        tmp_file = SPL_CACHE_STATS_FILE + ".tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump(stats, fp)
+        replace(tmp_file, SPL_CACHE_STATS_FILE)
+
+def get_spl_cache_entries():
+    # list of (path, size, last access time), least recently used first
+    entries = []
+    if not isdir(SPL_CACHE_DIR):
+        return entries
+    for name in listdir(SPL_CACHE_DIR):
+        path = join(SPL_CACHE_DIR, name)
+        if isfile(path) and name.endswith(".a"):
+            st = stat(path)
+            entries.append((path, st.st_size, st.st_mtime))
+    return sorted(entries, key=lambda e: e[2])
+
+def evict_spl_cache_entries():
+    entries = get_spl_cache_entries()
+    total_size = sum(e[1] for e in entries)
+    evicted = 0
+    for path, size, _ in entries:
+        if total_size <= get_spl_cache_size_limit():
+            break
+        remove(path)
+        total_size -= size
+        evicted += 1
+    if evicted:
+        update_spl_cache_stats(evictions=evicted)
+
+def get_shadowing_headers_hash():
+    """Hash of the project side headers (e.g. gd32f30x_libopt.h) that have
+    the name of a header in the SPL / CMSIS include paths"""
+    cpppath = [env.subst(p) for p in env.get("CPPPATH", [])]
+    framework_dirs = [p for p in cpppath if realpath(p).startswith(realpath(FRAMEWORK_DIR))]
+    other_dirs = [p for p in cpppath if p not in framework_dirs] + [
+        env.subst("$PROJECT_INCLUDE_DIR"), env.subst("$PROJECT_SRC_DIR")]
+    header_names = set()
+    for d in framework_dirs:
+        if isdir(d):
+            header_names.update(f for f in listdir(d) if f.endswith(".h"))
+    digest = hashlib.sha256()
+    for d in other_dirs:
+        if not isdir(d):
+            continue
+        for name in sorted(header_names.intersection(listdir(d))):
+            digest.update(name.encode() + b"\0")
+            with open(join(d, name), "rb") as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+def get_spl_cache_key(lib_name, src_filter):
+    toolchain = "toolchain-riscv-nuclei" if is_riscv else "toolchain-gccarmnoneeabi"
+    # CCFLAGS already contain the FPU flags from configure_floatingpoint() at
+    # this point. Debug flags are only added after the framework script ran, so
+    # the build type and unflags have to be part of the key, too.
+    key_data = [
+        lib_name,
+        spl_series,
+        str(src_filter),
+        str(board.get("build.framework_unity_build", "no")),
+        str(board.get("build.framework_unity_batch_size", 32)),
+        str(extra_flags),
+        # the PCH include path is project specific but doesn't change the code,
+        # neither does the project dir in -ffile-prefix-map (compiler cache)
+        env.Override({"SPL_PCH_FLAGS": []}).subst(
+            "$CCFLAGS $CFLAGS $_CPPDEFFLAGS").replace(env.subst("$PROJECT_DIR"), "<project>"),
+        # include paths relative to the project, so that projects with the
+        # same layout and headers still share the archives
+        env.subst("$_CPPINCFLAGS").replace(env.subst("$PROJECT_DIR"), "<project>"),
+        get_shadowing_headers_hash(),
+        str(env.get("BUILD_UNFLAGS", "")),
+        env.GetBuildType(),
+        str(platform.get_package_version(toolchain)),
+        str(platform.get_package_version("framework-spl-gd32")),
+    ]
+    return hashlib.sha256("\n".join(key_data).encode()).hexdigest()[:16]
+
+def store_in_spl_cache(lib_path, cache_file):
+    tmp_file = cache_file + ".tmp"
+    shutil.copyfile(lib_path, tmp_file)
+    replace(tmp_file, cache_file)
+    update_spl_cache_stats(misses=1)
+    evict_spl_cache_entries()
+
+# the hits are only counted when the firmware is actually linked with the
+# cached archives, not for upload, clean or other targets
+spl_cache_hits = []
+
+def record_spl_cache_hits(target, source, env):
+    for cache_file in spl_cache_hits:
+        # mark as recently used for the LRU eviction
+        if isfile(cache_file):
+            utime(cache_file, None)
+    update_spl_cache_stats(hits=len(spl_cache_hits))
+
+def build_cached_library(variant_dir, src_dir, src_filter=None):
+    lib_name = basename(variant_dir)
+    if not get_flag_value("spl_cache", False):
+        return env.BuildUnityLibrary(variant_dir, src_dir, src_filter=src_filter)
+    cache_file = join(SPL_CACHE_DIR, "lib%s-%s.a" % (
+        lib_name, get_spl_cache_key(lib_name, src_filter)))
+    if isfile(cache_file):
+        if not spl_cache_hits:
+            env.AddPreAction(
+                join("$BUILD_DIR", "${PROGNAME}.elf"),
+                env.VerboseAction(record_spl_cache_hits, "Using cached SPL archives"))
+        spl_cache_hits.append(cache_file)
+        return env.File(cache_file)
+    if not isdir(SPL_CACHE_DIR):
+        makedirs(SPL_CACHE_DIR)
+    lib = env.BuildUnityLibrary(variant_dir, src_dir, src_filter=src_filter)
+    env.AddPostAction(lib, env.VerboseAction(
+        lambda target, source, env: store_in_spl_cache(
+            target[0].get_abspath(), cache_file),
+        "Storing %s in SPL cache" % lib_name))
+    return lib
+
+def print_spl_cache_stats(target, source, env):
+    stats = load_spl_cache_stats()
+    entries = get_spl_cache_entries()
+    requests = stats.get("hits", 0) + stats.get("misses", 0)
+    print("SPL cache: %s" % SPL_CACHE_DIR)
+    print("Hits: %d, misses: %d, evictions: %d, hit rate: %.1f%%" % (
+        stats.get("hits", 0), stats.get("misses", 0), stats.get("evictions", 0),
+        100.0 * stats.get("hits", 0) / requests if requests else 0.0))
+    print("Entries: %d, size: %d / %d bytes" % (
+        len(entries), sum(e[1] for e in entries), get_spl_cache_size_limit()))
+    for path, size, _ in reversed(entries):
+        print("  %-60s %10d" % (basename(path), size))
+
+env.AddPlatformTarget(
+    "spl-cache-stats",
+    None,
+    env.VerboseAction(print_spl_cache_stats, "Reading SPL cache statistics"),
+    "SPL Cache Stats",
+    "Show hit/miss statistics of the global SPL library cache",
+)
+
+#
+# Demand-driven SPL driver selection. With board_build.spl_prune = auto only
+# the peripheral drivers whose functions are referenced by the project
+# (directly or through other drivers) are compiled.
+#
+
+SPL_SRC_DIR = join(FRAMEWORK_DIR, spl_chip_type, "spl", "variants", spl_series, "src")
+SPL_PRUNE_FALLBACK_FILE = join(env.subst("$BUILD_DIR"), "spl_prune_fallback.json")
+SCANNED_SOURCE_EXTS = (".c", ".cpp", ".cc", ".cxx", ".h", ".hpp", ".ino", ".S")
+
+IDENTIFIER_RE = re.compile(r"\b[A-Za-z_]\w*\b")
+# non-static function definitions starting at column 0, as used in all SPL drivers
+FUNCTION_DEFINITION_RE = re.compile(
+    r"^(?!static\b)[A-Za-z_][\w \t\*]*?[\s\*]([A-Za-z_]\w*)\s*\([^;\n]*$", re.M)
+INCLUDE_RE = re.compile(r"^\s*#\s*include\s*[<\"]([^>\"]+)[>\"]", re.M)
+
+def read_source(path):
+    with open(path, errors="ignore") as fp:
+        return fp.read()
+
+def collect_source_files(*dirs):
+    files = []
+    for d in dirs:
+        if not isdir(d):
+            continue
+        for dirpath, _, filenames in walk(d):
+            files.extend(
+                join(dirpath, f) for f in filenames
+                if splitext(f)[1] in SCANNED_SOURCE_EXTS)
+    return files
+
+def get_project_source_files():
+    project_files = collect_source_files(
+        env.subst("$PROJECT_SRC_DIR"),
+        env.subst("$PROJECT_INCLUDE_DIR"),
+        env.subst("$PROJECT_LIB_DIR"),
+        join(env.subst("$PROJECT_LIBDEPS_DIR"), env.subst("$PIOENV")),
+    )
+    # built-in SPL libraries (USB stacks etc.) are only scanned if the
+    # project includes one of their headers
+    included = set()
+    for f in project_files:
+        included.update(basename(h) for h in INCLUDE_RE.findall(read_source(f)))
+    for lib_dir in env.Flatten(env.get("LIBSOURCE_DIRS", [])):
+        lib_dir = env.subst(str(lib_dir))
+        if not lib_dir.startswith(FRAMEWORK_DIR) or not isdir(lib_dir):
+            continue
+        for lib_name in listdir(lib_dir):
+            lib_files = collect_source_files(join(lib_dir, lib_name))
+            if any(basename(f) in included for f in lib_files):
+                project_files.extend(lib_files)
+    return project_files
+
+def get_required_spl_drivers():
+    driver_functions = {}
+    driver_identifiers = {}
+    for f in listdir(SPL_SRC_DIR):
+        if splitext(f)[1] != ".c":
+            continue
+        content = read_source(join(SPL_SRC_DIR, f))
+        driver_functions[f] = set(FUNCTION_DEFINITION_RE.findall(content))
+        driver_identifiers[f] = set(IDENTIFIER_RE.findall(content))
+
+    # seed with everything the project and the CMSIS variant reference
+    identifiers = set()
+    for f in get_project_source_files() + collect_source_files(join(
+            FRAMEWORK_DIR, spl_chip_type, "cmsis", "variants", spl_series)):
+        identifiers.update(IDENTIFIER_RE.findall(read_source(f)))
+
+    # drivers call into each other (e.g. everything into RCU), so iterate
+    # until the set of required drivers doesn't grow anymore.
+    required = set()
+    while True:
+        new_drivers = set(
+            d for d, funcs in driver_functions.items()
+            if d not in required and funcs & identifiers)
+        if not new_drivers:
+            break
+        required.update(new_drivers)
+        for d in new_drivers:
+            identifiers.update(driver_identifiers[d])
+    return sorted(required)
+
+def get_spl_src_filter():
+    if str(board.get("build.spl_prune", "no")).lower() != "auto":
+        return "+<*>"
+    required_drivers = get_required_spl_drivers()
+    # a previous link with exactly this driver set failed: use the full library
+    if isfile(SPL_PRUNE_FALLBACK_FILE):
+        with open(SPL_PRUNE_FALLBACK_FILE) as fp:
+            if json.load(fp) == required_drivers:
+                print("SPL pruning disabled after a failed link, building all drivers")
+                return "+<*>"
+        remove(SPL_PRUNE_FALLBACK_FILE)
+    print("SPL drivers: %s" % ", ".join(
+        splitext(d)[0] for d in required_drivers))
+    # the firmware is linked by link_with_spl_fallback(), which retries the
+    # link with the left out drivers if it fails
+    env.Replace(
+        SPL_PRUNED_DRIVERS=required_drivers,
+        SPL_PRUNE_LINKCOM=env["LINKCOM"],
+        # no own message, the link commands print $LINKCOMSTR
+        LINKCOM=Action(link_with_spl_fallback, None)
+    )
+    return " ".join(["-<*>"] + ["+<%s>" % d for d in required_drivers])
+
+def link_with_spl_fallback(target, source, env):
+    if not Action("$SPL_PRUNE_LINKCOM", "$LINKCOMSTR")(target, source, env):
+        return 0
+    required_drivers = env["SPL_PRUNED_DRIVERS"]
+    print("Linking failed with a pruned SPL (%s), linking again with all "
+          "drivers" % ", ".join(required_drivers))
+    fallback_dir = join(env.subst("$BUILD_DIR"), "FrameworkSPLFallback")
+    if not isdir(fallback_dir):
+        makedirs(fallback_dir)
+    objs = []
+    for d in sorted(listdir(SPL_SRC_DIR)):
+        if splitext(d)[1] != ".c" or d in required_drivers:
+            continue
+        obj = env.File(join(fallback_dir, splitext(d)[0] + ".o"))
+        if Action("$CCCOM", "$CCCOMSTR")([obj], [env.File(join(SPL_SRC_DIR, d))], env):
+            return 1
+        objs.append(obj)
+    # unused driver functions are dropped again by --gc-sections
+    if Action("$SPL_PRUNE_LINKCOM", "$LINKCOMSTR")(target, source + objs, env):
+        return 1
+    # the next build compiles the full SPL right away
+    with open(SPL_PRUNE_FALLBACK_FILE, "w") as fp:
+        json.dump(required_drivers, fp)
+    return 0
+
+#
+# Precompiled header for the series umbrella header (e.g. gd32f30x.h),
+# enabled with board_build.spl_pch = yes.
+#
+
+def configure_spl_pch():
+    if not get_flag_value("spl_pch", False):
+        return
+    umbrella_header = spl_series + ".h"
+    if not isfile(join(FRAMEWORK_DIR, spl_chip_type, "cmsis", "variants",
+                       spl_series, umbrella_header)):
+        print("Warning: %s not found, not using a precompiled header" % umbrella_header)
+        return
+    pch_dir = join(env.subst("$BUILD_DIR"), "pch")
+    if not isdir(pch_dir):
+        makedirs(pch_dir)
+    # small wrapper header that is force-included into every C/C++ file.
+    # GCC picks the matching precompiled variant from the spl_pch.h.gch
+    # directory, or silently parses the real header if none of them is valid
+    # (e.g. because a library added different flags).
+    pch_header = join(pch_dir, "spl_pch.h")
+    content = '#include "%s"\n' % umbrella_header
+    if not isfile(pch_header) or read_source(pch_header) != content:
+        with open(pch_header, "w") as fp:
+            fp.write(content)
+
+    # the exact compile flags are part of the command signature, so the
+    # precompiled headers are rebuilt whenever the flags change.
+    pch_nodes = [
+        env.Command(
+            join(pch_header + ".gch", "c.gch"), pch_header,
+            env.VerboseAction(
+                "$CC -x c-header -o $TARGET -c $CFLAGS $CCFLAGS $_CCCOMCOM $SOURCE",
+                "Precompiling %s for C" % umbrella_header),
+            SPL_PCH_FLAGS=[]
+        ),
+        env.Command(
+            join(pch_header + ".gch", "cxx.gch"), pch_header,
+            env.VerboseAction(
+                "$CXX -x c++-header -o $TARGET -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCE",
+                "Precompiling %s for C++" % umbrella_header),
+            SPL_PCH_FLAGS=[]
+        )
+    ]
+    env.Replace(SPL_PCH_FLAGS=["-include", pch_header])
+    env.Append(CCFLAGS=["$SPL_PCH_FLAGS"])
+
+    # the force-included header is invisible to the dependency scanner
+    def _depend_on_pch(env, node):
+        if splitext(node.get_path())[1] not in (".c", ".cpp", ".cc", ".cxx"):
+            return node
+        obj = env.Object(node)
+        env.Depends(obj, pch_nodes)
+        return obj
+
+    env.AddBuildMiddleware(_depend_on_pch)
+
+configure_spl_pch()
+
+#
+# Target: Build SPL Library
+#
+
+extra_flags = board.get("build.extra_flags", "")
+spl_src_filter = get_spl_src_filter()
+
+libs = []
+
+libs.append(build_cached_library(
+    join("$BUILD_DIR", "FrameworkCMSISVariant"),
+    join(
+        FRAMEWORK_DIR, spl_chip_type, "cmsis",
+        "variants", spl_series
+    )
+))
+
+libs.append(build_cached_library(
+    join("$BUILD_DIR", "FrameworkSPL"),
+    SPL_SRC_DIR,
+    src_filter=spl_src_filter
+))
+
+env.Append(LIBS=libs)
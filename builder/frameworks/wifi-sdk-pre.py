@@ -34,23 +34,24 @@ def WiFiSDKBuildProgram(env):
         env.Prepend(_LIBFLAGS="-Wl,--start-group ")
         env.Append(_LIBFLAGS=" -Wl,--end-group")
 
-    mbl_program = env.Program(
-        os.path.join("$BUILD_DIR", "mbl"), env["PIOBUILDFILES"][0],
-        LDSCRIPT_PATH=os.path.join("$BUILD_DIR", "mbl_gdm32_ns_processed.ld"),
-        LIBS=[], # fix to stop making env.BuildLibrary() files appear in bootloader
-        LIBPATH=[],
-        LINKFLAGS= env["LINKFLAGS"] + ["-Wl,--print-memory-usage", "-Wl,-Map=$BUILD_DIR/mbl/mbl.map"],
-        _LIBFLAGS=[]
-    )
-    mbl_bin = env.ElfToBin(os.path.join("$BUILD_DIR", "mbl"), mbl_program)
-
     program = env.Program(
         os.path.join("$BUILD_DIR", env.subst("$PROGNAME")),
         env["PIOBUILDFILES"][1:],
         LDSCRIPT_PATH=os.path.join("$BUILD_DIR", "nspe_gdm32_ns_processed.ld")
     )
 
-    env.Depends(program, mbl_bin)
+    # a cached MBL ($MBL_BIN) is used as it is, see wifi-sdk.py
+    if not env.get("MBL_CACHED"):
+        mbl_program = env.Program(
+            os.path.join("$BUILD_DIR", "mbl"), env["PIOBUILDFILES"][0],
+            LDSCRIPT_PATH=os.path.join("$BUILD_DIR", "mbl_gdm32_ns_processed.ld"),
+            LIBS=[], # fix to stop making env.BuildLibrary() files appear in bootloader
+            LIBPATH=[],
+            LINKFLAGS= env["LINKFLAGS"] + ["-Wl,--print-memory-usage", "-Wl,-Map=$BUILD_DIR/mbl/mbl.map"],
+            _LIBFLAGS=[]
+        )
+        mbl_bin = env.ElfToBin(os.path.join("$BUILD_DIR", "mbl"), mbl_program)
+        env.Depends(program, mbl_bin)
 
     env.Replace(PIOMAINPROG=program)
 
@@ -19,8 +19,10 @@ The GigaDevice supplied WiFi SDK enables the development of WiFi-enabled
 firmwares for GD32W51x series microcontrollers.
 """
 
-from os.path import isdir, isfile, join, dirname, realpath, splitext
-from os import walk
+import hashlib
+import shutil
+from os.path import isdir, isfile, join, dirname, realpath, relpath, splitext
+from os import getpid, makedirs, replace, walk
 from string import Template
 
 from SCons.Script import DefaultEnvironment
@@ -30,6 +32,8 @@ platform = env.PioPlatform()
 board = env.BoardConfig()
 PROJECT_SRC_DIR = env.subst("$PROJECT_SRC_DIR")
 
+env.SConscript("_unity_build.py")
+
 # same semihosting logic as with SPL
 activate_semihosting = board.get("debug.semihosting", False)
 activate_semihosting = str(activate_semihosting).lower() in ("1", "yes", "true")
@@ -148,7 +152,7 @@ def get_objects_for_path(target_env, source_path:str, target_prefix:str, only_al
                 )
     return objs
 
-def compile_bootloader_sources(default_env):
+def get_bootloader_env(default_env):
     is_build_type_debug = "debug" in default_env.GetBuildType()
     mbl_env = default_env.Clone()
     mbl_env.Append(ASFLAGS=mbl_env.get("CCFLAGS", [])[:])
@@ -158,6 +162,9 @@ def compile_bootloader_sources(default_env):
     mbl_env.Append(CPPPATH=[
         join(FRAMEWORK_DIR, "NSPE", "Firmware", "GD32W51x_standard_peripheral", "Include")
     ])
+    return mbl_env
+
+def compile_bootloader_sources(mbl_env):
     action = [
         '"$CC"',
         "-E",
@@ -211,9 +218,86 @@ def compile_bootloader_sources(default_env):
     )
     return objs
 
+#
+# Global cache for the master bootloader. The MBL only depends on the SDK,
+# the config folder and the flags, so mbl.bin and the processed linker
+# script are shared between all projects and environments. On a hit, the
+# MBL objects and mbl.elf are not part of the build at all.
+# Can be turned on with board_build.mbl_cache = yes
+#
+
+MBL_CACHE_DIR = join(env.subst("$PROJECT_CORE_DIR"), ".cache", "gd32-wifi-sdk-mbl")
+MBL_CACHE_FILES = ("mbl.bin", "mbl.elf", "mbl_gdm32_ns_processed.ld")
+
+def get_directory_hash(path):
+    digest = hashlib.sha256()
+    for (dirpath, dirnames, filenames) in walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            file_path = join(dirpath, f)
+            digest.update(relpath(file_path, path).replace("\\", "/").encode() + b"\0")
+            with open(file_path, "rb") as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+def get_mbl_cache_key(mbl_env):
+    # the location of a custom config folder is project specific, only its
+    # contents matter
+    flags = mbl_env.subst(
+        "$CCFLAGS $ASFLAGS $CFLAGS $_CPPDEFFLAGS $LINKFLAGS").replace(config_folder, "<config>")
+    key_data = [
+        flags,
+        str([p.replace(config_folder, "<config>") for p in mbl_env["CPPPATH"]]),
+        get_directory_hash(config_folder),
+        str(mbl_env.get("BUILD_UNFLAGS", "")),
+        mbl_env.GetBuildType(),
+        str(platform.get_package_version("toolchain-gccarmnoneeabi")),
+        str(platform.get_package_version("framework-wifi-sdk-gd32")),
+    ]
+    return hashlib.sha256("\n".join(key_data).encode()).hexdigest()[:16]
+
+def store_in_mbl_cache(build_dir, cache_entry):
+    if isdir(cache_entry):
+        return
+    tmp_dir = "%s.tmp%d" % (cache_entry, getpid())
+    if isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    makedirs(tmp_dir)
+    for f in MBL_CACHE_FILES:
+        shutil.copyfile(join(build_dir, f), join(tmp_dir, f))
+    try:
+        replace(tmp_dir, cache_entry)
+    except OSError:
+        # stored by a parallel build in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+mbl_env = get_bootloader_env(env)
+mbl_objs = []
+env.Replace(
+    MBL_BIN=join("$BUILD_DIR", "mbl.bin"),
+    MBL_LDSCRIPT=join("$BUILD_DIR", "mbl_gdm32_ns_processed.ld")
+)
+if str(board.get("build.mbl_cache", "no")).lower() in ("1", "yes", "true"):
+    mbl_cache_entry = join(MBL_CACHE_DIR, get_mbl_cache_key(mbl_env))
+    if all(isfile(join(mbl_cache_entry, f)) for f in MBL_CACHE_FILES):
+        env.Replace(
+            MBL_BIN=join(mbl_cache_entry, "mbl.bin"),
+            MBL_LDSCRIPT=join(mbl_cache_entry, "mbl_gdm32_ns_processed.ld"),
+            MBL_CACHED=True
+        )
+        print("Using cached MBL %s" % mbl_cache_entry)
+    else:
+        mbl_objs = compile_bootloader_sources(mbl_env)
+        env.AddPostAction(join("$BUILD_DIR", "mbl.bin"), env.VerboseAction(
+            lambda target, source, env: store_in_mbl_cache(
+                env.subst("$BUILD_DIR"), mbl_cache_entry),
+            "Storing MBL in cache"))
+else:
+    mbl_objs = compile_bootloader_sources(mbl_env)
+
 env.Append(
     PIOBUILDFILES=[
-        compile_bootloader_sources(env), # all build files for mbl.elf
+        mbl_objs, # all build files for mbl.elf, empty with a cached MBL
         # firmware files etc will be added by BuildProgram()
     ]
 )
@@ -264,12 +348,12 @@ envC.BuildSources(
     join(FRAMEWORK_DIR, "NSPE", "WIFI_IOT", "bsp"),
     src_filter=["+<*>", "-<bsp_gd32w51x.c>"]
 )
-libs.append(envC.BuildLibrary(
+libs.append(envC.BuildUnityLibrary(
     join("$BUILD_DIR", "common"),
     join(FRAMEWORK_DIR, "NSPE", "WIFI_IOT", "common"),
     src_filter=["+<*>", "-<wrapper_os.c>"] # include in os later
 ))
-libs.append(envC.BuildLibrary(
+libs.append(envC.BuildUnityLibrary(
     join("$BUILD_DIR", "lwIP"),
     join(FRAMEWORK_DIR, "NSPE", "WIFI_IOT", "network", "lwip-2.1.2"),
     src_filter=[
@@ -282,11 +366,11 @@ libs.append(envC.BuildLibrary(
         "+<src/netif/ethernet.c>",
     ]
 ))
-libs.append(envC.BuildLibrary(
+libs.append(envC.BuildUnityLibrary(
     join("$BUILD_DIR", "mbedtls_ssl"),
     join(FRAMEWORK_DIR, "NSPE", "WIFI_IOT", "network", "mbedtls-2.17.0-ssl")
 ))
-libs.append(envC.BuildLibrary(
+libs.append(envC.BuildUnityLibrary(
     join("$BUILD_DIR", "wifi"),
     join(FRAMEWORK_DIR, "NSPE", "WIFI_IOT", "wifi")
 ))
@@ -298,7 +382,7 @@ libs.append(envC.BuildLibrary(
         "+<wrapper_os.c>"
     ]
 ))
-libs.append(envC.BuildLibrary(
+libs.append(envC.BuildUnityLibrary(
     join("$BUILD_DIR", "freertos"),
     join(FRAMEWORK_DIR, "NSPE", "WIFI_IOT", "os", "FreeRTOSv10.3.1"),
     src_filter=[
@@ -0,0 +1,97 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# In-process composer for combined images (e.g. image-all.bin of wifi-sdk
+# projects = MBL + NSPE firmware). The partition table is declared with
+# the IMAGE_PARTITIONS construction variable of the BinsToCombinedBin
+# target, a list of
+#   (name, binary, linker script, memory region)
+# The partition of a binary is the memory region of the linker script it
+# was linked with. Partitions must not overlap and binaries must fit into
+# their partition, gaps are filled with 0xFF (erased flash).
+#
+
+import mmap
+import sys
+from os.path import getsize
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+IMAGE_FILL = b"\xff"
+
+
+class ImageComposerError(Exception):
+    pass
+
+
+def get_partitions(env, partitions):
+    """Returns [(name, binary path, origin, length)] sorted by origin"""
+    result = []
+    for name, binary, ldscript, region in partitions:
+        regions = env.GetLinkerMemoryRegions(ldscript)
+        if region not in regions:
+            raise ImageComposerError(
+                "Memory region %s not found in %s" % (region, env.subst(ldscript)))
+        result.append((
+            name, env.subst(binary), regions[region]["origin"], regions[region]["length"]))
+    return sorted(result, key=lambda p: p[2])
+
+
+def check_partitions(partitions):
+    for i, (name, binary, origin, length) in enumerate(partitions):
+        size = getsize(binary)
+        if size > length:
+            raise ImageComposerError(
+                "%s (%d bytes) doesn't fit into partition %s (%d bytes at 0x%08x)" % (
+                    binary, size, name, length, origin))
+        if i + 1 < len(partitions) and origin + length > partitions[i + 1][2]:
+            raise ImageComposerError(
+                "Partition %s (0x%08x-0x%08x) overlaps partition %s at 0x%08x" % (
+                    name, origin, origin + length, partitions[i + 1][0],
+                    partitions[i + 1][2]))
+
+
+def compose_image(target, partitions):
+    check_partitions(partitions)
+    with open(target, "wb") as out:
+        address = partitions[0][2]
+        for name, binary, origin, length in partitions:
+            out.write(IMAGE_FILL * (origin - address))
+            size = getsize(binary)
+            if size:
+                with open(binary, "rb") as fp, mmap.mmap(
+                        fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    out.write(mm)
+            address = origin + size
+
+
+def CombineImages(target, source, env):
+    try:
+        partitions = get_partitions(env, env["IMAGE_PARTITIONS"])
+        compose_image(target[0].get_abspath(), partitions)
+    except (ImageComposerError, OSError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    for name, binary, origin, length in partitions:
+        print("  %-8s 0x%08x %7d / %7d bytes  %s" % (
+            name, origin, getsize(binary), length, binary))
+    return None
+
+
+env.AddMethod(
+    lambda env: env.VerboseAction(CombineImages, "Generating $TARGET"),
+    "CombineImagesAction")
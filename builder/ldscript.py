@@ -0,0 +1,271 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Parser for the MEMORY command of GNU ld linker scripts, e.g.
+#   MEMORY
+#   {
+#     FLASH (rx) : ORIGIN = (0x08000000 + 0xA000 + 0), LENGTH = (0x100000 - 0xA000)
+#     RAM (xrw)  : ORIGIN = 0x20000000, LENGTH = 64K
+#   }
+# ORIGIN / LENGTH expressions may use numbers with K / M suffixes, the
+# operators + - * / % << >> & |, parentheses and ORIGIN(region) /
+# LENGTH(region) of regions defined before.
+#
+# The parsed regions are cached by the hash of the linker script. Before
+# the size check the regions of the linker script the firmware was linked
+# with replace the static upload.maximum_size / maximum_ram_size limits of
+# the board, for all frameworks and custom board_build.ldscript files.
+#
+
+import hashlib
+import re
+from collections import OrderedDict
+from os.path import isfile, join
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+MEMORY_BLOCK_RE = re.compile(r"\bMEMORY\s*\{(.*?)\}", re.S)
+REGION_RE = re.compile(
+    r"([A-Za-z_][\w.]*)\s*(?:\(([^)]*)\))?\s*:\s*"
+    r"(?:ORIGIN|org|o)\s*=\s*(.+?)\s*,\s*(?:LENGTH|len|l)\s*=\s*(.+?)\s*(?=$|\n|[A-Za-z_][\w.]*\s*(?:\([^)]*\))?\s*:)",
+    re.S)
+# (kind, name patterns), checked in this order. CCRAM / TCM / AXI SRAM are
+# separate from the main RAM, e.g. CCMRAM, DTCMRAM, RAM_D1
+REGION_KINDS = (
+    ("flash", ("FLASH", "ROM")),
+    ("ccram", ("CCM", "CCRAM")),
+    ("tcm", ("TCM",)),
+    ("axi", ("AXI", "RAM_D1")),
+    ("ram", ("RAM",)),
+)
+TOKEN_RE = re.compile(
+    r"\s*(?:(0[xX][0-9a-fA-F]+|\d+)([KkMm]?)|(<<|>>|[-+*/%&|()~])|([A-Za-z_]\w*))")
+
+
+class LinkerScriptError(ValueError):
+    pass
+
+
+class _ExpressionParser(object):
+    # precedence climbing over the C operators ld supports in MEMORY
+
+    BINARY_OPS = {
+        "|": (1, lambda a, b: a | b),
+        "&": (2, lambda a, b: a & b),
+        "<<": (3, lambda a, b: a << b),
+        ">>": (3, lambda a, b: a >> b),
+        "+": (4, lambda a, b: a + b),
+        "-": (4, lambda a, b: a - b),
+        "*": (5, lambda a, b: a * b),
+        "/": (5, lambda a, b: a // b),
+        "%": (5, lambda a, b: a % b),
+    }
+
+    def __init__(self, expression, regions):
+        self.tokens = []
+        self.regions = regions
+        pos = 0
+        expression = expression.strip()
+        while pos < len(expression):
+            match = TOKEN_RE.match(expression, pos)
+            if not match or match.end() == pos:
+                raise LinkerScriptError("Unsupported expression '%s'" % expression)
+            number, suffix, op, name = match.groups()
+            if number:
+                value = int(number, 0)
+                value *= {"": 1, "k": 1024, "m": 1024 * 1024}[suffix.lower()]
+                self.tokens.append(("num", value))
+            elif op:
+                self.tokens.append(("op", op))
+            else:
+                self.tokens.append(("name", name))
+            pos = match.end()
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _expect(self, value):
+        if self._next() != ("op", value):
+            raise LinkerScriptError("Expected '%s'" % value)
+
+    def parse(self):
+        value = self._binary(1)
+        if self.pos != len(self.tokens):
+            raise LinkerScriptError("Unexpected token %s" % str(self._peek()[1]))
+        return value
+
+    def _binary(self, min_precedence):
+        value = self._unary()
+        while True:
+            kind, op = self._peek()
+            if kind != "op" or op not in self.BINARY_OPS:
+                return value
+            precedence, func = self.BINARY_OPS[op]
+            if precedence < min_precedence:
+                return value
+            self._next()
+            value = func(value, self._binary(precedence + 1))
+
+    def _unary(self):
+        kind, value = self._next()
+        if kind == "num":
+            return value
+        if kind == "op" and value == "(":
+            result = self._binary(1)
+            self._expect(")")
+            return result
+        if kind == "op" and value in ("-", "+", "~"):
+            operand = self._unary()
+            return {"-": -operand, "+": operand, "~": ~operand}[value]
+        if kind == "name" and value.upper() in ("ORIGIN", "LENGTH"):
+            self._expect("(")
+            kind, region = self._next()
+            self._expect(")")
+            if region not in self.regions:
+                raise LinkerScriptError("Unknown memory region '%s'" % region)
+            return self.regions[region][value.lower()]
+        raise LinkerScriptError("Unsupported token '%s'" % value)
+
+
+def evaluate_expression(expression, regions=None):
+    return _ExpressionParser(expression, regions or {}).parse()
+
+
+def parse_memory_regions(content):
+    """Returns {region name: {"origin", "length", "attributes"}} in the order
+    of the MEMORY command"""
+    content = COMMENT_RE.sub("", content)
+    regions = OrderedDict()
+    for block in MEMORY_BLOCK_RE.findall(content):
+        for name, attributes, origin, length in REGION_RE.findall(block):
+            regions[name] = {
+                "origin": evaluate_expression(origin, regions),
+                "length": evaluate_expression(length, regions),
+                "attributes": (attributes or "").strip(),
+            }
+    return regions
+
+
+def get_region_kind(name, attributes=""):
+    """flash, ram, ccram, tcm or axi, by name or else by attributes"""
+    for kind, patterns in REGION_KINDS:
+        if any(p in name.upper() for p in patterns):
+            return kind
+    # attributes after "!" are negated, e.g. ILM (rxa!w) is not writable
+    attributes = attributes.lower().split("!")[0]
+    if "w" in attributes:
+        return "ram"
+    if "x" in attributes or "r" in attributes:
+        return "flash"
+    return None
+
+
+# sha256 of the linker script -> regions
+_regions_cache = {}
+
+
+def GetLinkerMemoryRegions(env, path):
+    with open(env.subst(path), "rb") as fp:
+        content = fp.read()
+    key = hashlib.sha256(content).hexdigest()
+    if key not in _regions_cache:
+        _regions_cache[key] = parse_memory_regions(content.decode("utf-8", errors="replace"))
+    return OrderedDict(
+        (name, dict(region)) for name, region in _regions_cache[key].items())
+
+
+def GetProgramLinkerScript(env, program):
+    """Path of the linker script program was linked with or None. The
+    build environment of the node knows about per program overrides of
+    LDSCRIPT_PATH (e.g. the MBL and NSPE firmware of wifi-sdk)."""
+    build_env = program.get_build_env()
+    scripts = []
+    flags = build_env.get("LINKFLAGS", [])
+    for i, flag in enumerate(flags):
+        if flag == "-T" and i + 1 < len(flags):
+            scripts.append(flags[i + 1])
+        elif str(flag).startswith("-Wl,-T"):
+            scripts.append(str(flag)[6:])
+    if build_env.get("LDSCRIPT_PATH"):
+        scripts.append("$LDSCRIPT_PATH")
+    for script in scripts:
+        script = build_env.subst(str(script)).replace('"', "").strip()
+        if not script:
+            continue
+        if isfile(script):
+            return script
+        for libpath in build_env.get("LIBPATH", []):
+            path = join(build_env.subst(str(libpath)), script)
+            if isfile(path):
+                return path
+    return None
+
+
+def GetMemoryRegionLimits(env, ldscript):
+    """{region name: {"kind", "origin", "length"}} of the regions with a known
+    kind, the first flash and ram region are the main ones"""
+    limits = OrderedDict()
+    for name, region in env.GetLinkerMemoryRegions(ldscript).items():
+        kind = get_region_kind(name, region["attributes"])
+        if kind:
+            limits[name] = {
+                "kind": kind, "origin": region["origin"], "length": region["length"]}
+    return limits
+
+
+def _get_main_region(limits, kind):
+    for name, region in limits.items():
+        if region["kind"] == kind:
+            return name, region
+    return None, None
+
+
+def UpdateUploadSizeLimits(target, source, env):
+    ldscript = env.GetProgramLinkerScript(source[0])
+    if not ldscript:
+        return None
+    try:
+        limits = env.GetMemoryRegionLimits(ldscript)
+    except (LinkerScriptError, OSError) as exc:
+        print("Warning: Failed to retrieve the memory regions of %s: %s" % (ldscript, exc))
+        return None
+    board = env.BoardConfig()
+    for kind, option in (("flash", "maximum_size"), ("ram", "maximum_ram_size")):
+        _, region = _get_main_region(limits, kind)
+        if region and region["length"] > 0:
+            board.update("upload.%s" % option, region["length"])
+    if limits:
+        print("Memory regions: %s" % ", ".join(
+            "%s at 0x%08x (%d bytes)" % (name, r["origin"], r["length"])
+            for name, r in limits.items()))
+    return None
+
+
+env.AddMethod(GetLinkerMemoryRegions)
+env.AddMethod(GetProgramLinkerScript)
+env.AddMethod(GetMemoryRegionLimits)
+env.AddMethod(
+    lambda env: env.VerboseAction(
+        UpdateUploadSizeLimits, "Retrieving memory regions of $SOURCES"),
+    "UpdateUploadSizeLimitsAction")
@@ -16,7 +16,6 @@ import sys
 from platform import system
 from os import makedirs
 from os.path import basename, isdir, join, isfile, realpath
-import re
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
                           Builder, Default, DefaultEnvironment)
@@ -58,49 +57,9 @@ ftdi_layout_signal nSRST -oe 0x0020 -data 0x0020
         with open(expected_filepath, "w") as fp:
             fp.write(expected_filecontents)
 
-# safely evaluates a e.g. mathematical expression
-# no global variables or functions allowed
-def s_eval(input_string):
-     code = compile(input_string, "<int>", "eval")
-     if code.co_names:
-         raise NameError(f"Use of names not allowed")
-     return eval(code, {"__builtins__": {}}, {})
-
-def _update_max_upload_size(env):
-    # only invoked for wifi-sdk projects
-    # get the generated linkerscript again
-    genned_ldscript = join(env.subst("$BUILD_DIR"), "nspe_gdm32_ns_processed.ld")
-    if not isfile(genned_ldscript):
-        print("Warning: Failed to retrieve linker script for size update from file '%s'." % str(genned_ldscript))
-        return
-    ldscript = ""
-    with open(genned_ldscript, 'r') as fp:
-        ldscript = fp.read()
-    # parse the "MEMORY" sections out of it
-    # example:
-    #  FLASH (rx) : ORIGIN = (0x08000000 + 0xA000 + 0), LENGTH = (0x100000 - 0xA000)
-    #  RAM (xrw) : ORIGIN = ((0x20000000 + 0x200)), LENGTH = (0x00070000 - 0x200)
-    flash_matches = re.findall(r"FLASH \(rx\) : ORIGIN = \(([0-9xA-Fa-f +-]+)\), LENGTH = \(([0-9xA-Fa-f +-]+)\)", ldscript)
-    if flash_matches is None or len(flash_matches) != 1:
-        print("Warning: Failed to retrieve flash memory details from linker script for size update from file '%s'." % str(genned_ldscript))
-        print("Flash matches: %s" % str(flash_matches))
-        return
-    flash_origin, flash_len = flash_matches[0]
-    ram_matches = re.findall(r"RAM \(xrw\) : ORIGIN = \(\(([0-9xA-Fa-f +-]+)\)\), LENGTH = \(([0-9xA-Fa-f +-]+)\)", ldscript)
-    if ram_matches is None or len(ram_matches) != 1:
-        print("Warning: Failed to retrieve RAM memory details from linker script for size update from file '%s'." % str(genned_ldscript))
-        return
-    ram_origin, ram_len = ram_matches[0]
-    # due to the regexes, all extracted strings can can only be expressions involving hex numbers.
-    # especially, no paranthesis are possible, so no function calls etc.
-    # use a hardened of eval() anyways.
-    flash_origin, flash_len, ram_origin, ram_len = s_eval(flash_origin), s_eval(flash_len), s_eval(ram_origin), s_eval(ram_len)
-    print(f"Partition table: Flash at {hex(flash_origin)}, {flash_len} bytes. RAM at {hex(ram_origin)}, {ram_len} bytes.")
-    board.update("upload.maximum_ram_size", ram_len)
-    board.update("upload.maximum_size", flash_len)
-
 env = DefaultEnvironment()
 env.SConscript("compat.py", exports="env")
+env.SConscript("trace.py", exports="env")
 platform = env.PioPlatform()
 board = env.BoardConfig()
 
@@ -116,66 +75,44 @@ env.Replace(
     OBJCOPY="%s-objcopy" % toolchain_triple,
     OBJDUMP="%s-objdump" % toolchain_triple,
     RANLIB="%s-gcc-ranlib" % toolchain_triple,
+    # the size check runs in-process, see memory_usage.py
     SIZETOOL="%s-size" % toolchain_triple,
 
     ARFLAGS=["rc"],
 
-    SIZEPROGREGEXP=r"^(?:\.text|\.data|\.rodata|\.preinit_array|\.init_array|\.fini_array|\.code_to_sram|\.vectors|\.text.align|\.ARM.exidx|\.ccram_data)\s+(\d+).*",
-    SIZEDATAREGEXP=r"^(?:\.data|\.bss|\.noinit|\.stack|\.code_to_sram|\.memory_layout)\s+(\d+).*",
-    SIZECHECKCMD="$SIZETOOL -A -d $SOURCES",
-    SIZEPRINTCMD='$SIZETOOL -B -d $SOURCES',
-
     PROGSUFFIX=".elf"
 )
 
+env.SConscript("compiler_cache.py", exports="env")
+env.SConscript("upload_server.py", exports="env")
+env.SConscript("multi_upload.py", exports="env")
+env.SConscript("diff_flash.py", exports="env")
+env.SConscript("elf_image.py", exports="env")
+env.SConscript("ldscript.py", exports="env")
+env.SConscript("memory_usage.py", exports="env")
+env.SConscript("image_composer.py", exports="env")
+env.SConscript("footprint.py", exports="env")
+env.SConscript("stack_analysis.py", exports="env")
+env.SConscript("wcet.py", exports="env")
+
 # Allow user to override via pre:script
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
 
 env.Append(
     BUILDERS=dict(
+        # written in-process, see elf_image.py
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "binary",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.ElfToBinAction(),
             suffix=".bin"
         ),
         ElfToHex=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.ElfToHexAction(),
             suffix=".hex"
         ),
+        # partition table in IMAGE_PARTITIONS, see image_composer.py
         BinsToCombinedBin=Builder(
-            action=env.VerboseAction(" ".join([
-                '"%s"' % join(platform.get_package_dir("tool-sreccat") or "",
-                    "srec_cat"),
-                "${SOURCES[1]}", # master bootloader (mbl)
-                "-Binary",
-                "-offset",
-                "0",
-                "${SOURCES[0]}", # firmware.bin (nspe)
-                "-Binary",
-                "-offset",
-                "0xa000",
-                "-fill",
-                "0xFF",
-                "0x7FFC",
-                "0xA000",
-                "-o",
-                "$TARGET",
-                "-Binary"
-            ]), "Generating $TARGET"),
+            action=env.CombineImagesAction()
         )
     )
 )
@@ -214,24 +151,30 @@ else:
 
     env.Depends(target_firm, "checkprogsize")
 
+# the size limits are taken from the MEMORY regions of the linker script
+# the firmware was linked with, see ldscript.py
+if env.get("PIOMAINPROG"):
+    env.AddPreAction("checkprogsize", env.UpdateUploadSizeLimitsAction())
+
 # replace target_firm variable with *combined* .bin image
 # of master bootloader and firmware.
 # this self-referential thing actually works.
 if "wifi-sdk" in pioframework:
+    # $MBL_BIN / $MBL_LDSCRIPT point into the MBL cache on a hit, see wifi-sdk.py
+    mbl_ldscript = "$MBL_LDSCRIPT"
+    nspe_ldscript = join("$BUILD_DIR", "nspe_gdm32_ns_processed.ld")
     target_firm = env.BinsToCombinedBin(
         join("$BUILD_DIR", "image-all.bin"),
         [
             target_firm,
-            join("$BUILD_DIR", "mbl.bin")
+            "$MBL_BIN"
+        ],
+        IMAGE_PARTITIONS=[
+            ("mbl", "$MBL_BIN", mbl_ldscript, "FLASH"),
+            ("nspe", join("$BUILD_DIR", "${PROGNAME}.bin"), nspe_ldscript, "FLASH"),
         ]
     )
-    # update max upload size based on linker file
-    if env.get("PIOMAINPROG"):
-        env.AddPreAction(
-            "checkprogsize",
-            env.VerboseAction(
-                lambda source, target, env: _update_max_upload_size(env),
-                "Retrieving maximum program size $SOURCES"))
+    env.Depends(target_firm, [mbl_ldscript, nspe_ldscript])
 
 AlwaysBuild(env.Alias("nobuild", target_firm))
 target_buildprog = env.Alias("buildprog", target_firm, target_firm)
@@ -240,11 +183,84 @@ target_buildprog = env.Alias("buildprog", target_firm, target_firm)
 # Target: Print binary size
 #
 
-target_size = env.Alias(
-    "size", target_elf,
-    env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
+target_size = env.Alias("size", target_elf, env.MemoryUsageAction())
 AlwaysBuild(target_size)
 
+#
+# Target: Disassembly listing (.lst file)
+#
+
+def _get_lst_commands():
+    # restrict the listing to some sections or symbols, e.g.
+    # board_build.lst_sections = .isr_vector, .text
+    # board_build.lst_symbols = main, SysTick_Handler
+    def _get_list(option):
+        return [
+            v.strip() for v in str(board.get("build.%s" % option, "")).replace(",", " ").split()
+            if v.strip()
+        ]
+    base_cmd = ["$OBJDUMP", "-drwC"]
+    for section in _get_list("lst_sections"):
+        base_cmd.extend(["-j", section])
+    symbols = _get_list("lst_symbols")
+    if not symbols:
+        return [" ".join(base_cmd + ["$SOURCE", ">", "$TARGET"])]
+    return [
+        " ".join(base_cmd + [
+            "--disassemble=%s" % symbol, "$SOURCE", ">" if i == 0 else ">>", "$TARGET"])
+        for i, symbol in enumerate(symbols)
+    ]
+
+# only regenerated when the ELF content (or the listing options) changed
+target_lst = env.Command(
+    join("$BUILD_DIR", "${PROGNAME}.lst"),
+    target_elf,
+    env.VerboseAction(_get_lst_commands(), "Building $TARGET")
+)
+env.AddPlatformTarget(
+    "lst",
+    target_lst,
+    None,
+    "Disassembly Listing",
+    "Generate a disassembly listing (.lst) of the firmware",
+)
+
+#
+# Target: Flash / RAM usage per library, object file and symbol
+#
+
+env.AddPlatformTarget(
+    "footprint",
+    target_elf,
+    env.FootprintAction(),
+    "Footprint",
+    "Show the flash / RAM usage per library, object and symbol and its growth",
+)
+
+#
+# Target: Worst case stack depth per root function
+#
+
+env.AddPlatformTarget(
+    "stack-analysis",
+    target_elf,
+    env.StackAnalysisAction(),
+    "Stack Analysis",
+    "Compute the worst case stack depth of main, the handlers and tasks",
+)
+
+#
+# Target: Execution time and latency estimates of the interrupt handlers
+#
+
+env.AddPlatformTarget(
+    "wcet",
+    target_elf,
+    env.WcetAction(),
+    "ISR Timing Analysis",
+    "Estimate the worst case execution time and entry latency of the handlers",
+)
+
 #
 # Target: Upload by default .bin file
 #
@@ -253,6 +269,9 @@ upload_protocol = env.subst("$UPLOAD_PROTOCOL")
 debug_tools = board.get("debug.tools", {})
 upload_source = target_firm
 upload_actions = []
+upload_server = None
+# construction variables selecting one of board_upload.devices
+upload_device_overrides = None
 
 if upload_protocol == "mbed":
     upload_actions = [
@@ -271,11 +290,15 @@ elif upload_protocol.startswith("blackmagic"):
             ("jtag" if upload_protocol == "blackmagic-jtag" else "swdp"),
             "-ex", "attach 1",
             "-ex", "load",
+            # compare-sections uses qCRC, the CRC is computed by the probe
             "-ex", "compare-sections",
             "-ex", "kill"
         ],
         UPLOADCMD="$UPLOADER $UPLOADERFLAGS $SOURCE"
     )
+    if str(board.get("upload.verify", "full")).lower() in ("no", "0", "false"):
+        i = env["UPLOADERFLAGS"].index("compare-sections")
+        del env["UPLOADERFLAGS"][i - 1:i + 1]
     upload_source = target_elf
     upload_actions = [
         env.VerboseAction(env.AutodetectUploadPort, "Looking for BlackMagic port..."),
@@ -313,6 +336,19 @@ elif upload_protocol.startswith("jlink"):
         UPLOADCMD='$UPLOADER $UPLOADERFLAGS -CommanderScript "${__jlink_cmd_script(__env__, SOURCE)}"'
     )
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+    upload_device_overrides = lambda device: {
+        "UPLOADERFLAGS": env["UPLOADERFLAGS"] + ["-USB", device]}
+
+    if env.IsPersistentUploadServerEnabled():
+        upload_server = ("jlink", [
+            "JLinkGDBServerCL.exe" if system() == "Windows" else "JLinkGDBServerCLExe",
+            "-device", board.get("debug", {}).get("jlink_device"),
+            "-speed", env.GetProjectOption("debug_speed", "4000"),
+            "-if", ("jtag" if upload_protocol == "jlink-jtag" else "swd"),
+            "-vd",
+            "-silent"
+        ])
+        upload_source = target_elf
 
 
 elif upload_protocol == "dfu":
@@ -357,17 +393,13 @@ elif upload_protocol == "dfu":
                                      "Looking for upload port..."))
 
     if "dfu-util" in _upload_tool:
+        # "-D" has to stay in front of the file
+        upload_device_overrides = lambda device: {
+            "UPLOADERFLAGS": _upload_flags[:-1] + ["-S", device, "-D"]}
+
         # Add special DFU header to the binary image
         env.AddPostAction(
-            join("$BUILD_DIR", "${PROGNAME}.bin"),
-            env.VerboseAction(
-                " ".join([
-                    '"%s"' % join(platform.get_package_dir("tool-dfuutil") or "",
-                         "bin", "dfu-suffix"),
-                    "-v %s" % vid,
-                    "-p %s" % pid,
-                    "-d 0xffff", "-a", "$TARGET"
-                ]), "Adding dfu suffix to ${PROGNAME}.bin"))
+            join("$BUILD_DIR", "${PROGNAME}.bin"), env.DfuSuffixAction(vid, pid))
 
     env.Replace(
         UPLOADER=_upload_tool,
@@ -391,6 +423,7 @@ elif upload_protocol == "serial":
         ],
         UPLOADCMD='$UPLOADER $UPLOADERFLAGS "$SOURCE" "${__configure_upload_port(__env__)}"'
     )
+    upload_device_overrides = lambda device: {"UPLOAD_PORT": device}
 
     upload_actions = [
         env.VerboseAction(env.AutodetectUploadPort, "Looking for upload port..."),
@@ -449,28 +482,79 @@ elif upload_protocol in debug_tools:
     ]
     openocd_args.extend(
         debug_tools.get(upload_protocol).get("server").get("arguments", []))
-    if env.GetProjectOption("debug_speed"):
-        openocd_args.extend(
-            ["-c", "adapter speed %s" % env.GetProjectOption("debug_speed")]
-        )
-    openocd_args.extend([
-        "-c", "program {$SOURCE} %s verify reset; shutdown;" %
-        board.get("upload.offset_address", "")
-    ])
     openocd_args = [
         f.replace("$PACKAGE_DIR",
                   platform.get_package_dir("tool-openocd-gd32") or "")
         for f in openocd_args
     ]
+    debug_speed = env.GetProjectOption("debug_speed", "")
+    auto_speed = str(debug_speed).lower() == "auto"
+    if auto_speed:
+        # tuned (or taken from the cache) when the upload command is run,
+        # per adapter (serial number, see Gd32Platform.get_adapter_id())
+        def _get_tuning_args(env):
+            if env.get("UPLOAD_ADAPTER_SERIAL"):
+                return tuning_args + ["-c", "adapter serial %s" % env["UPLOAD_ADAPTER_SERIAL"]]
+            return tuning_args
+
+        def _auto_adapter_speed(env):
+            speed = platform.get_auto_adapter_speed(
+                join(platform.get_package_dir("tool-openocd-gd32") or "", "bin", "openocd"),
+                _get_tuning_args(env), env.subst("$BOARD"))
+            # without an argument, "adapter speed" only prints the default
+            return "adapter speed %d" % speed if speed else "adapter speed"
+
+        tuning_args = list(openocd_args)
+        env.Replace(__auto_adapter_speed=_auto_adapter_speed)
+        openocd_args.extend(["-c", "${__auto_adapter_speed(__env__)}"])
+    elif debug_speed:
+        openocd_args.extend(["-c", "adapter speed %s" % debug_speed])
+    if env.IsPersistentUploadServerEnabled():
+        upload_server = ("openocd", ["openocd"] + openocd_args)
+    program_args = [
+        "-c", "program {$SOURCE} %s verify reset; shutdown;" %
+        board.get("upload.offset_address", "")
+    ]
+    if str(board.get("upload.verify", "full")).lower() != "full":
+        # board_upload.verify = crc / no, see GetOpenOCDProgramCommands()
+        program_args = ["-c", "init", "-c", "reset init"]
+        for command in env.GetOpenOCDProgramCommands(
+                "$SOURCE", board.get("upload.offset_address", "")):
+            program_args.extend(["-c", command])
+        program_args.extend(["-c", "reset run", "-c", "shutdown"])
+    upload_device_overrides = lambda device: {
+        "UPLOADERFLAGS": openocd_args + ["-c", "adapter serial %s" % device] + program_args,
+        "UPLOAD_ADAPTER_SERIAL": device}
     env.Replace(
         UPLOADER="openocd",
-        UPLOADERFLAGS=openocd_args,
+        UPLOADERFLAGS=openocd_args + program_args,
         UPLOADCMD="$UPLOADER $UPLOADERFLAGS")
 
     if not board.get("upload").get("offset_address"):
         upload_source = target_elf
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
 
+    if auto_speed:
+        def _upload_with_speed_downgrade(target, source, env):
+            # on transfer errors, retry once with the next slower clock
+            result = env.Execute(env.subst("$UPLOADCMD", target=target, source=source))
+            if result and platform.downgrade_adapter_speed(
+                    env.subst("$BOARD"), _get_tuning_args(env)):
+                result = env.Execute(env.subst("$UPLOADCMD", target=target, source=source))
+            return result
+
+        upload_actions = [env.VerboseAction(_upload_with_speed_downgrade, "Uploading $SOURCE")]
+
+    if env.IsDifferentialUploadEnabled():
+        # board_upload.differential: only program the changed flash sectors
+        upload_source = target_firm
+        # the record of the last upload is kept per adapter serial number
+        upload_actions = [env.VerboseAction(
+            lambda target, source, env: env.DifferentialUpload(
+                openocd_args, source[0].get_abspath(),
+                platform.get_adapter_id(openocd_args)),
+            "Uploading changed sectors of $SOURCE")]
+
 # custom upload tool
 elif upload_protocol == "custom":
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
@@ -478,6 +562,45 @@ elif upload_protocol == "custom":
 else:
     sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
 
+upload_devices = env.GetUploadDevices()
+if upload_devices and not upload_device_overrides:
+    sys.stderr.write(
+        "Warning! Upload protocol %s doesn't support multiple devices\n" % upload_protocol)
+    upload_devices = []
+
+if upload_devices:
+    # board_upload.devices: flash all devices in parallel
+    upload_actions = [env.VerboseAction(
+        lambda target, source, env: env.MultiDeviceUpload(
+            upload_device_overrides, source),
+        "Uploading $SOURCE to %d devices" % len(upload_devices))]
+    env.AddPlatformTarget(
+        "upload_retry_failed",
+        upload_source,
+        env.VerboseAction(
+            lambda target, source, env: env.MultiDeviceUpload(
+                upload_device_overrides, source, only_failed=True),
+            "Uploading $SOURCE to the failed devices"),
+        "Retry Failed Uploads",
+        "Upload again to the devices that failed during the last upload",
+    )
+elif upload_server:
+    # board_upload.persistent_server: keep the OpenOCD / J-Link server alive
+    # between uploads instead of initializing the adapter every time
+    upload_actions = [env.VerboseAction(
+        lambda target, source, env: env.UploadViaServer(
+            upload_server[0], upload_server[1], source[0].get_abspath()),
+        "Uploading $SOURCE through the %s server" % upload_server[0])]
+    env.AddPlatformTarget(
+        "stop_upload_server",
+        None,
+        env.VerboseAction(
+            lambda target, source, env: env.StopUploadServer(*upload_server),
+            "Stopping the %s upload server" % upload_server[0]),
+        "Stop Upload Server",
+        "Stop the persistent OpenOCD / J-Link upload server",
+    )
+
 AlwaysBuild(env.Alias("upload", upload_source, upload_actions))
 
 #
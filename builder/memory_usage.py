@@ -0,0 +1,185 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Region aware memory usage, replaces "$SIZETOOL -A" and the section name
+# regexes of the stock size check. Every allocated section of the ELF file
+# is assigned to the MEMORY region of the linker script that contains its
+# address (VMA). Sections with contents that are loaded from elsewhere
+# (.data, .code_to_sram, .ccram_data, ...) are also counted in the region
+# of their load address (LMA). The build fails if any region overflows,
+# e.g. CCRAM / TCM on F4 or AXI SRAM on H7, not only flash and main RAM.
+#
+# Without a linker script (or MEMORY command) the regions are made up from
+# the upload.maximum_size / maximum_ram_size / closely_coupled_ram_size
+# values of the board.
+#
+
+import sys
+from collections import OrderedDict
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+USAGE_BAR_BLOCKS = 10
+
+
+def get_allocated_sections(elf_path):
+    """Returns [(name, vma, lma, size, loaded)] of the allocated sections,
+    loaded is False for sections without contents (.bss, .stack, ...)"""
+    from elftools.elf.constants import SH_FLAGS
+    from elftools.elf.elffile import ELFFile
+    sections = []
+    with open(elf_path, "rb") as fp:
+        elf = ELFFile(fp)
+        segments = [
+            (s["p_offset"], s["p_filesz"], s["p_paddr"])
+            for s in elf.iter_segments() if s["p_type"] == "PT_LOAD" and s["p_filesz"]
+        ]
+        for section in elf.iter_sections():
+            if not section["sh_flags"] & SH_FLAGS.SHF_ALLOC or not section["sh_size"]:
+                continue
+            vma = lma = section["sh_addr"]
+            loaded = section["sh_type"] != "SHT_NOBITS"
+            if loaded:
+                for p_offset, p_filesz, p_paddr in segments:
+                    if p_offset <= section["sh_offset"] < p_offset + p_filesz:
+                        lma = p_paddr + section["sh_offset"] - p_offset
+                        break
+            sections.append((section.name, vma, lma, section["sh_size"], loaded))
+    return sections
+
+
+def find_region(regions, address):
+    """Name of the region containing address, the one with the highest
+    origin for nested regions (e.g. RAM after a reserved area)"""
+    result = None
+    for name, region in regions.items():
+        if region["origin"] <= address < region["origin"] + region["length"]:
+            if result is None or region["origin"] > regions[result]["origin"]:
+                result = name
+    return result
+
+
+def get_region_usage(sections, regions):
+    """Returns {region: used bytes} and [(section, address, size)] of the
+    sections outside of all regions"""
+    usage = OrderedDict((name, 0) for name in regions)
+    unassigned = []
+    for name, vma, lma, size, loaded in sections:
+        addresses = [vma]
+        if loaded and lma != vma:
+            addresses.append(lma)
+        for address in addresses:
+            region = find_region(regions, address)
+            if region is None:
+                unassigned.append((name, address, size))
+                continue
+            usage[region] += size
+    return usage, unassigned
+
+
+def _get_board_regions(env):
+    board = env.BoardConfig()
+    regions = OrderedDict()
+    for name, origin, length in (
+            ("FLASH", board.get("upload.offset_address", "0x08000000"),
+             board.get("upload.maximum_size", 0)),
+            ("RAM", board.get("upload.ram_start", "0x20000000"),
+             board.get("upload.maximum_ram_size", 0)),
+            ("CCRAM", "0x10000000", board.get("upload.closely_coupled_ram_size", 0))):
+        if int(length):
+            regions[name] = {"origin": int(str(origin), 0), "length": int(length)}
+    return regions
+
+
+def GetMemoryRegions(env, program):
+    ldscript = env.GetProgramLinkerScript(program)
+    if ldscript:
+        try:
+            regions = env.GetLinkerMemoryRegions(ldscript)
+            if regions:
+                return regions
+        except (ValueError, OSError) as exc:
+            print("Warning: Failed to retrieve the memory regions of %s: %s" % (
+                ldscript, exc))
+    return _get_board_regions(env)
+
+
+def _format_usage(used, length):
+    if not length:
+        return "(used %d bytes)" % used
+    percent = float(used) / length
+    blocks = min(int(round(USAGE_BAR_BLOCKS * percent)), USAGE_BAR_BLOCKS)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * blocks, USAGE_BAR_BLOCKS, percent, used, length)
+
+
+def _get_usage(env, source):
+    regions = env.GetMemoryRegions(source[0])
+    sections = get_allocated_sections(source[0].get_abspath())
+    return (regions, sections) + get_region_usage(sections, regions)
+
+
+def CheckUploadSize(_, target, source, env):
+    """Replaces the stock CheckUploadSize() of PlatformIO"""
+    if not env.get("BOARD"):
+        return None
+    regions, _, usage, unassigned = _get_usage(env, source)
+    if not regions:
+        return None
+    width = max(len(name) for name in regions) + 1
+    for name, region in regions.items():
+        if usage[name] or region["length"]:
+            print("%-*s %s" % (width, name + ":", _format_usage(usage[name], region["length"])))
+    for name, address, size in unassigned:
+        sys.stderr.write(
+            "Warning! Section %s (%d bytes at 0x%08x) is outside of all memory regions\n" % (
+                name, size, address))
+    overflows = [
+        (name, usage[name] - region["length"]) for name, region in regions.items()
+        if usage[name] > region["length"]
+    ]
+    for name, excess in overflows:
+        sys.stderr.write(
+            "Error: Region %s overflowed by %d bytes (used %d bytes from %d bytes)\n" % (
+                name, excess, usage[name], regions[name]["length"]))
+    if overflows:
+        env.Exit(1)
+    return None
+
+
+def PrintMemoryUsage(target, source, env):
+    regions, sections, usage, _ = _get_usage(env, source)
+    print("%-24s %10s %10s %8s  %s" % ("section", "address", "load addr", "size", "region"))
+    for name, vma, lma, size, loaded in sections:
+        region = find_region(regions, vma) or "-"
+        if loaded and lma != vma:
+            region = "%s (loaded from %s)" % (region, find_region(regions, lma) or "-")
+        print("%-24s 0x%08x 0x%08x %8d  %s" % (name, vma, lma, size, region))
+    print("")
+    print("%-24s %10s %10s %8s" % ("region", "origin", "length", "used"))
+    for name, region in regions.items():
+        print("%-24s 0x%08x %10d %8d  %5.1f%%" % (
+            name, region["origin"], region["length"], usage[name],
+            100.0 * usage[name] / region["length"] if region["length"] else 0))
+    return None
+
+
+env.AddMethod(GetMemoryRegions)
+env.AddMethod(CheckUploadSize)
+env.AddMethod(
+    lambda env: env.VerboseAction(PrintMemoryUsage, "Calculating size $SOURCE"),
+    "MemoryUsageAction")
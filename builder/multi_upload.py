@@ -0,0 +1,145 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Uploads to several devices at once, e.g. for production fixtures:
+#   board_upload.devices = 066DFF343039, 066EFF555051, ...
+#   board_upload.parallel_jobs = 8   (default: up to 8 at the same time)
+#   board_upload.retries = 1         (retries of failed devices)
+# Devices are adapter serial numbers (OpenOCD debug tools, J-Link, DFU) or
+# serial ports (serial upload). The upload command of the protocol is run
+# once per device in a bounded pool of worker threads and a per-device
+# pass / fail table is printed. The results are kept in
+# $BUILD_DIR/upload_devices.json, "pio run -t upload_retry_failed" flashes
+# only the devices that failed last time.
+#
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os.path import isdir, isfile, join
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+MAX_DEFAULT_JOBS = 8
+
+
+def GetUploadDevices(env):
+    return [
+        d for d in re.split(r"[\s,]+", str(env.BoardConfig().get("upload.devices", "")))
+        if d
+    ]
+
+
+def _get_device_log_path(env, device):
+    log_dir = join(env.subst("$BUILD_DIR"), "upload_logs")
+    if not isdir(log_dir):
+        makedirs(log_dir)
+    return join(log_dir, "%s.log" % re.sub(r"[^\w.-]", "_", device))
+
+
+def _upload_device(cmd, sysenv, log_path):
+    start = time.time()
+    with open(log_path, "w") as log:
+        log.write(cmd + "\n")
+        log.flush()
+        result = subprocess.run(
+            cmd, shell=True, env=sysenv, stdin=subprocess.DEVNULL,
+            stdout=log, stderr=subprocess.STDOUT)
+    return result.returncode == 0, time.time() - start
+
+
+def _print_results_table(results):
+    rows = [("Device", "Result", "Time", "Attempts")] + [
+        (device, "PASSED" if r["passed"] else "FAILED", "%.1fs" % r["duration"],
+         str(r["attempts"]))
+        for device, r in results.items()
+    ]
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    for i, row in enumerate(rows):
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+        if i == 0:
+            print("  ".join("-" * w for w in widths))
+
+
+def MultiDeviceUpload(env, get_device_overrides, source, only_failed=False):
+    """Runs $UPLOADCMD for every device in board_upload.devices in parallel.
+    get_device_overrides(device) returns the construction variables that
+    select the device. Returns an exit code."""
+    board = env.BoardConfig()
+    devices = env.GetUploadDevices()
+    results_path = join(env.subst("$BUILD_DIR"), "upload_devices.json")
+    results = {}
+    if only_failed and isfile(results_path):
+        with open(results_path) as fp:
+            results = {d: r for d, r in json.load(fp).items() if d in devices}
+        devices = [d for d in devices if not results.get(d, {}).get("passed")]
+        if not devices:
+            print("No failed devices to retry")
+            return 0
+
+    sysenv = os.environ.copy()
+    sysenv.update({k: str(v) for k, v in env["ENV"].items()})
+    commands = {
+        device: env.Override(get_device_overrides(device)).subst(
+            "$UPLOADCMD", source=source)
+        for device in devices
+    }
+    jobs = int(board.get("upload.parallel_jobs", 0)) or min(len(devices), MAX_DEFAULT_JOBS)
+    retries = int(board.get("upload.retries", 1))
+
+    pending = list(devices)
+    for attempt in range(retries + 1):
+        if attempt:
+            print("Retrying %d failed device(s)" % len(pending))
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = {
+                device: executor.submit(
+                    _upload_device, commands[device], sysenv,
+                    _get_device_log_path(env, device))
+                for device in pending
+            }
+        for device, future in futures.items():
+            passed, duration = future.result()
+            results[device] = {
+                "passed": passed,
+                "duration": duration,
+                "attempts": results.get(device, {}).get("attempts", 0) + 1
+            }
+        # devices that passed are never flashed again
+        pending = [d for d in pending if not results[d]["passed"]]
+        if not pending:
+            break
+
+    with open(results_path, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print()
+    _print_results_table({d: results[d] for d in env.GetUploadDevices() if d in results})
+    if pending:
+        sys.stderr.write(
+            "Error: upload failed for %s, see %s\n" % (
+                ", ".join(pending), join(env.subst("$BUILD_DIR"), "upload_logs")))
+        return 1
+    return 0
+
+
+env.AddMethod(GetUploadDevices)
+env.AddMethod(MultiDeviceUpload)
@@ -0,0 +1,451 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# "pio run -t stack-analysis": worst case stack depth per root function.
+# The frame sizes come from the .su files of -fstack-usage, which is added
+# to the compiler flags with
+#   board_build.stack_usage = yes
+# The flag is kept for all builds, so that switching between the target and
+# normal builds doesn't recompile the project and the framework. Without it
+# (and for prebuilt libraries, libc) the frame sizes are estimated from the
+# function prologues (push / vpush / sub sp). The call graph is taken from
+# the disassembly of the ELF file.
+#
+# Roots are the reset handler (startup code and main), the handlers of the
+# vector table and FreeRTOS tasks (functions passed to xTaskCreate and
+# friends), more can be given with
+#   board_build.stack_roots = my_task, other_task
+# NMI and HardFault are left out, they only run when something already
+# went wrong. The main stack has to hold the reset handler plus the deepest
+# handlers, one per interrupt nesting level, with their exception frames:
+#   board_build.stack_isr_nesting = 1
+# It's checked against the RAM left between .data / .bss / heap and the
+# initial stack pointer. Task stacks are allocated separately, their depth
+# is only reported.
+#
+# Recursion and indirect calls (function pointers) can't be bounded, the
+# affected paths are marked.
+#
+
+import json
+import os
+import re
+import subprocess
+import sys
+from os.path import join
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+VECTOR_TABLE_SECTIONS = (".isr_vector", ".vectors", ".vector_table")
+TASK_CREATE_FUNCTIONS = (
+    "xTaskCreate", "xTaskCreateStatic", "sys_task_create", "sys_task_create_dynamic")
+# sections holding the stack (and the minimum heap) of the linker scripts
+STACK_SECTIONS = (".stack", "._user_heap_stack", ".heap_stack")
+# Cortex-M vector table: initial SP, Reset, NMI, HardFault, then the
+# handlers that are analyzed
+RESET_VECTOR = 1
+FIRST_HANDLER_VECTOR = 4
+# registers stacked on exception entry, with or without the FPU context
+EXCEPTION_FRAME = 32
+EXCEPTION_FRAME_FPU = 104
+
+FUNCTION_RE = re.compile(r"^([0-9a-fA-F]+) <(.+)>:$")
+INSTRUCTION_RE = re.compile(r"^\s*([0-9a-fA-F]+):\s+(\S+)\s*(.*)$")
+CALL_TARGET_RE = re.compile(r"<([^>+]+)>")
+DIRECT_CALLS = ("bl", "blx", "b", "jal", "call", "tail", "j")
+# branches to another function are tail calls
+JUMPS = ("b", "j", "tail")
+INDIRECT_CALLS = ("blx", "jalr")
+REGISTER_LIST_RE = re.compile(r"\{([^}]*)\}")
+
+
+class StackAnalysisError(Exception):
+    pass
+
+
+def is_stack_usage_enabled(env):
+    return str(env.BoardConfig().get(
+        "build.stack_usage", "no")).lower() in ("1", "yes", "true")
+
+
+def normalize_function_name(name):
+    """"void ns::Foo::bar(int)" (.su files of C++) and "ns::Foo::bar(int)"
+    (demangled disassembly) -> "ns::Foo::bar", C names are unchanged"""
+    name = name.split("(")[0].strip()
+    return name.rsplit(" ", 1)[-1]
+
+
+def parse_stack_usage_files(build_dir):
+    """{function: (frame size, qualifier)} from all .su files, the largest
+    frame is kept for functions of the same name"""
+    frames = {}
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            if not name.endswith(".su"):
+                continue
+            with open(join(root, name), errors="replace") as fp:
+                for line in fp:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) < 3 or not parts[1].isdigit():
+                        continue
+                    # file:line:column:function
+                    function = normalize_function_name(parts[0].split(":", 3)[-1])
+                    size = int(parts[1])
+                    if function not in frames or frames[function][0] < size:
+                        frames[function] = (size, parts[2].strip())
+    return frames
+
+
+def _get_register_count(operands):
+    match = REGISTER_LIST_RE.search(operands)
+    if not match:
+        return 0
+    count = 0
+    for item in match.group(1).split(","):
+        first, _, last = item.strip().partition("-")
+        if last:
+            count += int(re.sub(r"\D", "", last)) - int(re.sub(r"\D", "", first)) + 1
+        elif first:
+            count += 1
+    return count
+
+
+def get_prologue_frame_size(instructions):
+    """Frame size from the prologue of a function without .su entry"""
+    size = 0
+    for _, mnemonic, operands in instructions[:8]:
+        mnemonic = mnemonic.split(".")[0]
+        if mnemonic in ("push", "stmdb") and ("sp!" in operands or mnemonic == "push"):
+            size += 4 * _get_register_count(operands)
+        elif mnemonic == "vpush":
+            registers = _get_register_count(operands)
+            size += (8 if "d" in operands.split("{")[-1][:2] else 4) * registers
+        elif mnemonic in ("sub", "subw") and operands.replace(" ", "").startswith("sp,"):
+            match = re.search(r"#(\d+)", operands)
+            if match:
+                size += int(match.group(1))
+        elif mnemonic in ("addi", "add") and operands.replace(" ", "").startswith("sp,sp,-"):
+            size += int(operands.replace(" ", "")[len("sp,sp,-"):], 0)
+        elif mnemonic in DIRECT_CALLS:
+            break
+    return size
+
+
+def parse_disassembly(output):
+    """Returns {function: {"address", "calls", "indirect", "words",
+    "instructions"}} from "objdump -dwC --no-show-raw-insn" output, the
+    instructions are (address, mnemonic, operands)"""
+    functions = {}
+    current = current_name = None
+    for line in output.splitlines():
+        match = FUNCTION_RE.match(line)
+        if match:
+            current_name = match.group(2)
+            current = functions.setdefault(current_name, {
+                "address": int(match.group(1), 16), "calls": set(), "indirect": False,
+                "words": set(), "instructions": []})
+            continue
+        match = INSTRUCTION_RE.match(line)
+        if not match or current is None:
+            continue
+        mnemonic, operands = match.group(2).lower(), match.group(3)
+        if mnemonic == ".word":
+            try:
+                current["words"].add(int(operands.split()[0], 0))
+            except (ValueError, IndexError):
+                pass
+            continue
+        current["instructions"].append((int(match.group(1), 16), mnemonic, operands))
+        base = mnemonic.split(".")[0]
+        target = CALL_TARGET_RE.search(operands)
+        if target and base in DIRECT_CALLS:
+            # e.g. the endless loop of Default_Handler
+            if base in JUMPS and target.group(1) == current_name:
+                continue
+            current["calls"].add(target.group(1))
+        elif base in INDIRECT_CALLS:
+            current["indirect"] = True
+    return functions
+
+
+class CallGraph(object):
+
+    def __init__(self, functions, frames):
+        self.functions = functions
+        self.frames = {}
+        for name, function in functions.items():
+            key = normalize_function_name(name)
+            if key in frames:
+                self.frames[name] = (frames[key][0], frames[key][1], False)
+            else:
+                self.frames[name] = (
+                    get_prologue_frame_size(function["instructions"]), "estimated", True)
+        self._memo = {}
+
+    def get_worst_path(self, root):
+        """Returns (depth, [(function, frame size)], flags) of the deepest
+        path from root, flags is a set of "recursion", "indirect",
+        "dynamic" and "estimated"."""
+        return self._walk(root, ())
+
+    def _walk(self, name, stack):
+        if name in stack:
+            return 0, [], {"recursion"}
+        if name in self._memo:
+            return self._memo[name]
+        size, qualifier, estimated = self.frames.get(name, (0, "unknown", True))
+        function = self.functions.get(name, {"calls": (), "indirect": False})
+        flags = set()
+        if estimated:
+            flags.add("estimated")
+        if "dynamic" in qualifier and "bounded" not in qualifier:
+            flags.add("dynamic")
+        if function["indirect"]:
+            flags.add("indirect")
+        best = (0, [], set())
+        for callee in sorted(function["calls"]):
+            if callee == name:
+                flags.add("recursion")
+                continue
+            result = self._walk(callee, stack + (name,))
+            flags |= result[2]
+            if result[0] > best[0]:
+                best = result
+        result = (size + best[0], [(name, size)] + best[1], flags)
+        if not stack or "recursion" not in flags:
+            # results of a cycle depend on the path, don't reuse them
+            self._memo[name] = result
+        return result
+
+
+def get_task_functions(functions):
+    """Functions whose address is loaded by callers of the task create
+    functions (FreeRTOS / wifi-sdk)"""
+    by_address = {f["address"]: name for name, f in functions.items()}
+    tasks = set()
+    for name, function in functions.items():
+        if not function["calls"] & set(TASK_CREATE_FUNCTIONS):
+            continue
+        for word in function["words"]:
+            task = by_address.get(word & ~1)
+            if task and task not in TASK_CREATE_FUNCTIONS:
+                tasks.add(task)
+    return tasks
+
+
+def get_vector_table_handlers(data, functions, endian="little"):
+    """Returns the reset handler and the other handlers (without NMI and
+    HardFault) of the vector table data, functions is {address: name}"""
+    vectors = [
+        functions.get(int.from_bytes(data[i:i + 4], endian) & ~1)
+        for i in range(0, len(data) - 3, 4)
+    ]
+    reset_handler = vectors[RESET_VECTOR] if len(vectors) > RESET_VECTOR else None
+    handlers = []
+    for name in vectors[FIRST_HANDLER_VECTOR:]:
+        if name and name != reset_handler and name not in handlers:
+            handlers.append(name)
+    return reset_handler, handlers
+
+
+def get_elf_info(elf_path):
+    """Returns the reset handler, the other vector table handlers, the
+    symbol values and the (name, vma, size) of the allocated sections"""
+    from elftools.elf.constants import SH_FLAGS
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.sections import SymbolTableSection
+
+    with open(elf_path, "rb") as fp:
+        elf = ELFFile(fp)
+        endian = "little" if elf.little_endian else "big"
+        symbols = {}
+        functions = {}
+        for section in elf.iter_sections():
+            if not isinstance(section, SymbolTableSection):
+                continue
+            for symbol in section.iter_symbols():
+                if not symbol.name:
+                    continue
+                symbols[symbol.name] = symbol["st_value"]
+                if symbol["st_info"]["type"] == "STT_FUNC":
+                    functions.setdefault(symbol["st_value"] & ~1, symbol.name)
+        sections = []
+        reset_handler, handlers = None, []
+        for section in elf.iter_sections():
+            if not section["sh_flags"] & SH_FLAGS.SHF_ALLOC or not section["sh_size"]:
+                continue
+            sections.append((section.name, section["sh_addr"], section["sh_size"]))
+            if section.name in VECTOR_TABLE_SECTIONS and section["sh_type"] != "SHT_NOBITS":
+                reset_handler, handlers = get_vector_table_handlers(
+                    section.data(), functions, endian)
+    return reset_handler, handlers, symbols, sections
+
+
+def get_available_stack(symbols, sections, ram_region):
+    """Bytes between the end of .data / .bss / heap and the initial stack
+    pointer in the main RAM region"""
+    if not ram_region:
+        return None
+    start = ram_region["origin"]
+    end = start + ram_region["length"]
+    stack_top = symbols.get("_estack", end)
+    used_end = start
+    for name, vma, size in sections:
+        if start <= vma < end and name not in STACK_SECTIONS:
+            used_end = max(used_end, vma + size)
+    return stack_top - used_end - symbols.get("_Min_Heap_Size", 0)
+
+
+def _get_list_option(board, option):
+    return [
+        v.strip() for v in str(board.get(option, "")).replace(",", " ").split()
+        if v.strip()
+    ]
+
+
+def _get_exception_frame(env):
+    if env.BoardConfig().get("build.mcu", "").startswith("gd32vw"):
+        return 0
+    flags = env.get("CCFLAGS", []) + env.get("LINKFLAGS", [])
+    hard_float = any(
+        "-mfloat-abi=hard" in str(f) or "-mfloat-abi=softfp" in str(f) for f in flags)
+    return EXCEPTION_FRAME_FPU if hard_float else EXCEPTION_FRAME
+
+
+def _get_disassembly(env, elf_path):
+    sysenv = os.environ.copy()
+    sysenv.update({k: str(v) for k, v in env["ENV"].items()})
+    result = subprocess.run(
+        [env.subst("$OBJDUMP"), "-dwC", "--no-show-raw-insn", elf_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        env=sysenv)
+    if result.returncode != 0:
+        raise StackAnalysisError("Disassembling %s failed: %s" % (elf_path, result.stderr))
+    return result.stdout
+
+
+def DisassembleElf(env, elf_path):
+    """Functions of elf_path, see parse_disassembly()"""
+    return parse_disassembly(_get_disassembly(env, elf_path))
+
+
+def GetVectorTableHandlers(env, elf_path):
+    """Vector table handlers without Reset, NMI and HardFault"""
+    return get_elf_info(elf_path)[1]
+
+
+def _format_path(path, flags):
+    text = " -> ".join("%s (%d)" % (name, size) for name, size in path)
+    marks = sorted(flags - {"estimated"})
+    if "estimated" in flags:
+        marks.append("estimated frames")
+    return text + (" [%s]" % ", ".join(marks) if marks else "")
+
+
+def analyze_stack(functions, frames, reset_handler, handlers, extra_roots=(),
+                  exception_frame=EXCEPTION_FRAME, nesting=1):
+    """Returns the results per root and the worst case depth of the main
+    stack: the reset handler (or main, if there is no vector table) plus
+    the deepest handlers, one per nesting level"""
+    graph = CallGraph(functions, frames)
+    main_root = reset_handler if reset_handler in functions else "main"
+    roots = []
+    for name in [main_root] + list(extra_roots):
+        if name in functions:
+            roots.append(("main" if name == main_root else "root", name))
+    roots.extend(("handler", name) for name in handlers if name in functions)
+    roots.extend(("task", name) for name in sorted(get_task_functions(functions)))
+
+    results = []
+    for kind, name in roots:
+        depth, path, flags = graph.get_worst_path(name)
+        if kind == "handler":
+            depth += exception_frame
+        results.append({
+            "root": name, "kind": kind, "depth": depth, "path": path,
+            "flags": sorted(flags)})
+
+    main_depth = sum(r["depth"] for r in results if r["kind"] == "main")
+    handler_depths = sorted(
+        (r["depth"] for r in results if r["kind"] == "handler"), reverse=True)
+    return results, main_depth + sum(handler_depths[:nesting])
+
+
+def StackAnalysis(target, source, env):
+    board = env.BoardConfig()
+    elf_path = source[0].get_abspath()
+    build_dir = env.subst("$BUILD_DIR")
+    try:
+        functions = env.DisassembleElf(elf_path)
+        reset_handler, handlers, symbols, sections = get_elf_info(elf_path)
+    except (StackAnalysisError, OSError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    frames = parse_stack_usage_files(build_dir)
+    if not frames:
+        print("Warning: No -fstack-usage output found, all frame sizes are estimated. "
+              "Set board_build.stack_usage = yes for the exact sizes")
+
+    exception_frame = _get_exception_frame(env)
+    nesting = int(board.get("build.stack_isr_nesting", 1))
+    results, worst_case = analyze_stack(
+        functions, frames, reset_handler, handlers,
+        _get_list_option(board, "build.stack_roots"), exception_frame, nesting)
+
+    print("%-8s %8s  %s" % ("kind", "depth", "deepest path"))
+    top = int(board.get("build.stack_analysis_top", 10))
+    for result in sorted(results, key=lambda r: r["depth"], reverse=True)[:top]:
+        print("%-8s %8d  %s" % (
+            result["kind"], result["depth"],
+            _format_path(result["path"], set(result["flags"]))))
+
+    regions = env.GetMemoryRegions(source[0])
+    ram_region = regions.get("RAM") or regions.get("SRAM") or next(
+        (r for name, r in regions.items() if "RAM" in name.upper()), None)
+    available = get_available_stack(symbols, sections, ram_region)
+
+    report = {
+        "roots": results, "worst_case": worst_case, "available": available,
+        "isr_nesting": nesting, "exception_frame": exception_frame}
+    with open(join(build_dir, "stack_usage.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    print("Worst case main stack: %d bytes (reset handler + %d nested handler(s))" % (
+        worst_case, nesting))
+    if available is None:
+        print("Warning: Main RAM region not found, the stack budget is not checked")
+        return None
+    print("Available stack: %d bytes" % available)
+    if any(set(r["flags"]) & {"recursion", "dynamic", "indirect"} for r in results):
+        print("Warning: Some paths contain recursion, dynamic frames or indirect calls, "
+              "their depth is a lower bound")
+    if worst_case > available:
+        sys.stderr.write(
+            "Error: The worst case stack depth (%d bytes) exceeds the available "
+            "stack (%d bytes)\n" % (worst_case, available))
+        return 1
+    return None
+
+
+if is_stack_usage_enabled(env):
+    env.Append(CCFLAGS=["-fstack-usage"])
+
+env.AddMethod(DisassembleElf)
+env.AddMethod(GetVectorTableHandlers)
+env.AddMethod(
+    lambda env: env.VerboseAction(StackAnalysis, "Analyzing stack usage of $SOURCE"),
+    "StackAnalysisAction")
@@ -0,0 +1,139 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Build timing instrumentation, enabled with board_build.trace = yes.
+# Writes $BUILD_DIR/build_trace.json in the Chrome trace-event format
+# (load it in chrome://tracing or https://ui.perfetto.dev).
+#
+# Every spawned tool (compiler, linker, objcopy, srec_cat, objdump, ..) is
+# timed through the SPAWN hook, which is inherited by all cloned environments.
+# Python function actions created with env.VerboseAction() are timed by
+# surrounding them with begin / end markers.
+#
+
+import atexit
+import json
+import os
+import threading
+import time
+from os.path import basename, isdir, join
+
+from SCons.Script import Action, Import
+
+Import("env")
+
+_events = []
+_events_lock = threading.Lock()
+_open_actions = threading.local()
+_start_time = time.time()
+
+
+def _timestamp():
+    # microseconds since the start of the build
+    return int((time.time() - _start_time) * 1e6)
+
+
+def _add_event(name, category, start, end, args=None):
+    with _events_lock:
+        _events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": max(end - start, 0),
+            "pid": 1,
+            "tid": threading.get_ident(),
+            "args": args or {}
+        })
+
+
+def _get_command_name(args):
+    # e.g. "arm-none-eabi-gcc FrameworkSPL/gd32f30x_gpio.o"
+    tool = basename(args[0].strip('"'))
+    output = None
+    if "-o" in args[:-1]:
+        output = args[args.index("-o") + 1]
+    elif ">" in args[:-1]:
+        output = args[args.index(">") + 1]
+    elif len(args) > 1:
+        output = args[-1]
+    if output:
+        return "%s %s" % (tool, basename(output.strip('"')))
+    return tool
+
+
+def _traced_spawn(spawn):
+    def _spawn(sh, escape, cmd, args, env):
+        start = _timestamp()
+        try:
+            return spawn(sh, escape, cmd, args, env)
+        finally:
+            _add_event(
+                _get_command_name(args), basename(cmd.strip('"')),
+                start, _timestamp(), {"cmd": " ".join(args)})
+    return _spawn
+
+
+def _begin_action(target, source, env):
+    if not hasattr(_open_actions, "stack"):
+        _open_actions.stack = []
+    _open_actions.stack.append(_timestamp())
+
+
+def _end_action_for(name):
+    def _end_action(target, source, env):
+        start = _open_actions.stack.pop()
+        _add_event(
+            env.subst(name, target=target, source=source), "action",
+            start, _timestamp(),
+            {"targets": [str(t) for t in target]})
+    return _end_action
+
+
+def TracedVerboseAction(env, act, actstr):
+    action = _verbose_action(act, actstr)
+    # shell commands are already covered by the SPAWN hook
+    if not callable(act):
+        return action
+    return Action([
+        Action(_begin_action, None),
+        action,
+        Action(_end_action_for(actstr), None)
+    ])
+
+
+def _write_trace(trace_file):
+    if not _events:
+        return
+    trace_dir = os.path.dirname(trace_file)
+    if not isdir(trace_dir):
+        os.makedirs(trace_dir)
+    with _events_lock:
+        events = sorted(_events, key=lambda e: e["ts"])
+    with open(trace_file, "w") as fp:
+        json.dump({
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"environment": env.subst("$PIOENV")}
+        }, fp)
+    print("Build trace written to %s" % trace_file)
+
+
+if "BOARD" in env and str(
+        env.BoardConfig().get("build.trace", "no")).lower() in ("1", "yes", "true"):
+    _verbose_action = env.VerboseAction
+    env["SPAWN"] = _traced_spawn(env["SPAWN"])
+    env.AddMethod(TracedVerboseAction, "VerboseAction")
+    atexit.register(_write_trace, env.subst(join("$BUILD_DIR", "build_trace.json")))
@@ -0,0 +1,352 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Persistent upload servers, e.g.
+#   board_upload.persistent_server = yes
+# Instead of initializing the adapter and examining the target on every
+# upload, one OpenOCD or J-Link GDB server per adapter (serial number, see
+# Gd32Platform.get_adapter_id()) is started in the background and kept
+# alive between uploads. An environment with other server arguments for
+# the same adapter (target, speed, ...) replaces its server. OpenOCD uploads
+# go over its Tcl RPC port (flash write_image, verify, reset), J-Link uploads over
+# the GDB port of JLinkGDBServer. A dead server is started again.
+# "pio run -t stop_upload_server" stops the server of the environment.
+#
+# OpenOCDTclClient and UploadServer don't depend on SCons, they are tested
+# against local fake servers in tests/test_upload_server.py.
+#
+
+import hashlib
+import json
+import os
+import signal
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from os import makedirs
+from os.path import isdir, isfile, join
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+TCL_TERMINATOR = b"\x1a"
+# servers get a port derived from their configuration in this range, so that
+# different adapters can be served at the same time
+SERVER_BASE_PORT = 50000
+SERVER_PORT_RANGE = 5000
+SERVER_START_TIMEOUT = 10.0
+SERVER_STOP_TIMEOUT = 5.0
+
+
+class UploadServerError(Exception):
+    pass
+
+
+class OpenOCDTclClient(object):
+    """Client for the Tcl RPC server of OpenOCD: commands and responses are
+    terminated by 0x1a."""
+
+    def __init__(self, host, port, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._buffer = b""
+
+    def connect(self):
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        return self
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def command(self, cmd, timeout=None):
+        """Sends a raw command and returns the response"""
+        self._sock.settimeout(timeout or self.timeout)
+        self._sock.sendall(cmd.encode("utf-8") + TCL_TERMINATOR)
+        while TCL_TERMINATOR not in self._buffer:
+            data = self._sock.recv(4096)
+            if not data:
+                raise UploadServerError("Connection closed by the Tcl server")
+            self._buffer += data
+        response, _, self._buffer = self._buffer.partition(TCL_TERMINATOR)
+        return response.decode("utf-8", errors="replace")
+
+    def run(self, cmd, timeout=None):
+        """Evaluates cmd, errors are raised as UploadServerError"""
+        rc = self.command("catch {%s} _pio_result" % cmd, timeout).strip()
+        result = self.command("set _pio_result")
+        if rc != "0":
+            raise UploadServerError(result or "'%s' failed" % cmd)
+        return result
+
+
+class UploadServer(object):
+    """A background OpenOCD ("openocd") or JLinkGDBServer ("jlink") process
+    for the adapter adapter_id (None if unknown, all of those share one
+    server). State (pid, port, command line) is kept in state_dir, so that
+    the server is found again by later builds."""
+
+    def __init__(self, kind, command, state_dir, sysenv=None, adapter_id=None):
+        self.kind = kind
+        self.command = list(command)
+        self.state_dir = state_dir
+        self.sysenv = sysenv
+        self.adapter_id = adapter_id
+        self.key = hashlib.sha1(
+            "\0".join([kind, adapter_id or ""]).encode("utf-8")).hexdigest()[:12]
+        self.port = SERVER_BASE_PORT + int(self.key, 16) % SERVER_PORT_RANGE
+        self.state_path = join(state_dir, "%s.json" % self.key)
+
+    def get_server_command(self):
+        if self.kind == "openocd":
+            return self.command + [
+                "-c", "tcl_port %d" % self.port,
+                "-c", "gdb_port disabled",
+                "-c", "telnet_port disabled"
+            ]
+        return self.command + [
+            "-port", str(self.port),
+            "-swoport", str(self.port + SERVER_PORT_RANGE),
+            "-telnetport", str(self.port + 2 * SERVER_PORT_RANGE)
+        ]
+
+    def _load_state(self):
+        if not isfile(self.state_path):
+            return None
+        try:
+            with open(self.state_path) as fp:
+                return json.load(fp)
+        except ValueError:
+            return None
+
+    def is_alive(self):
+        try:
+            if self.kind == "openocd":
+                with OpenOCDTclClient("127.0.0.1", self.port, timeout=2.0) as client:
+                    client.command("version")
+            else:
+                socket.create_connection(("127.0.0.1", self.port), 2.0).close()
+        except (OSError, UploadServerError):
+            return False
+        return True
+
+    def start(self):
+        if not isdir(self.state_dir):
+            makedirs(self.state_dir)
+        kwargs = {}
+        if sys.platform == "win32":
+            kwargs["creationflags"] = (
+                subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            kwargs["start_new_session"] = True
+        log_path = join(self.state_dir, "%s.log" % self.key)
+        with open(log_path, "w") as log:
+            proc = subprocess.Popen(
+                self.get_server_command(), stdin=subprocess.DEVNULL,
+                stdout=log, stderr=subprocess.STDOUT, cwd=self.state_dir,
+                env=self.sysenv, **kwargs)
+        with open(self.state_path, "w") as fp:
+            json.dump({"pid": proc.pid, "port": self.port, "command": self.command}, fp)
+
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            if proc.poll() is not None:
+                break
+            if self.is_alive():
+                return
+            time.sleep(0.1)
+        self.stop()
+        raise UploadServerError(
+            "Upload server didn't start, see %s" % log_path)
+
+    def stop(self):
+        state = self._load_state()
+        if state and state.get("pid"):
+            try:
+                os.kill(state["pid"], signal.SIGTERM)
+            except OSError:
+                pass
+            else:
+                _wait_for_exit(state["pid"], SERVER_STOP_TIMEOUT)
+        if isfile(self.state_path):
+            os.remove(self.state_path)
+
+    def ensure_running(self):
+        state = self._load_state()
+        if state and state.get("command") == self.command and self.is_alive():
+            return False
+        if state:
+            # crashed or killed, maybe with the adapter unplugged, or started
+            # with other arguments for the same adapter
+            self.stop()
+        self.start()
+        return True
+
+
+def _wait_for_exit(pid, timeout):
+    # the adapter and the port are only free again once the process is gone
+    if sys.platform == "win32":
+        return
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            # reaps the server if it was started by this process
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return
+        except ChildProcessError:
+            pass
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return
+        time.sleep(0.05)
+
+
+def _get_sysenv(env):
+    sysenv = os.environ.copy()
+    sysenv.update({k: str(v) for k, v in env["ENV"].items()})
+    return sysenv
+
+
+def _is_persistent_server_enabled(env):
+    return str(env.BoardConfig().get(
+        "upload.persistent_server", "no")).lower() in ("1", "yes", "true")
+
+
+def GetOpenOCDProgramCommands(env, image, offset=""):
+    """Tcl commands programming and verifying image into the halted target.
+    board_upload.verify selects the verification: "full" (read-back, the
+    default), "crc" (CRC32 computed on the target against the host side
+    image, read-back only on mismatch) or "no"."""
+    image = "{%s}" % image.replace("\\", "/")
+    image_args = ("%s %s" % (image, offset)).strip()
+    commands = ["flash write_image erase %s" % image_args]
+    mode = str(env.BoardConfig().get("upload.verify", "full")).lower()
+    if mode == "crc":
+        # the read-back also reports where the image differs
+        commands.append(
+            "if {[catch {verify_image_checksum %s}]} "
+            "{echo {Checksum mismatch, reading back the image}; verify_image %s}" % (
+                image_args, image_args))
+    elif mode not in ("no", "0", "false"):
+        commands.append("verify_image %s" % image_args)
+    return commands
+
+
+def _get_adapter_id(env, kind, command):
+    if kind == "openocd":
+        return env.PioPlatform().get_adapter_id(command)
+    # JLinkGDBServer -select USB=<serial number>
+    for i, arg in enumerate(command[:-1]):
+        if arg.lower() == "-select" and command[i + 1].lower().startswith("usb="):
+            return "serial:%s" % command[i + 1][4:]
+    return None
+
+
+def _get_upload_server(env, kind, command):
+    command = [env.subst(arg) for arg in command]
+    tool = shutil.which(command[0], path=env["ENV"]["PATH"])
+    if not tool:
+        raise UploadServerError("Upload server '%s' not found" % command[0])
+    return UploadServer(
+        kind, [tool] + command[1:],
+        join(env.subst("$PROJECT_CORE_DIR"), ".cache", "gd32-upload-servers"),
+        _get_sysenv(env), _get_adapter_id(env, kind, command))
+
+
+def _openocd_upload(env, server, source):
+    if env.IsDifferentialUploadEnabled():
+        script_path, update_record = env.PrepareDifferentialUpload(
+            source, server.adapter_id)
+        with OpenOCDTclClient("127.0.0.1", server.port) as client:
+            client.run("source {%s}" % script_path.replace("\\", "/"), timeout=120.0)
+        update_record()
+        return
+    commands = ["reset init"] + env.GetOpenOCDProgramCommands(
+        source, env.BoardConfig().get("upload.offset_address", "")) + ["reset run"]
+    with OpenOCDTclClient("127.0.0.1", server.port) as client:
+        client.run("; ".join(commands), timeout=120.0)
+
+
+def _jlink_upload(env, server, source):
+    # JLinkGDBServer verifies the download itself (-vd)
+    script_path = join(env.subst("$BUILD_DIR"), "upload.gdb")
+    with open(script_path, "w") as fp:
+        fp.write("\n".join([
+            "target extended-remote 127.0.0.1:%d" % server.port,
+            "monitor reset",
+            "monitor halt",
+            "load",
+            "monitor reset",
+            "monitor go",
+            "disconnect",
+            ""
+        ]))
+    result = subprocess.run(
+        [env.subst("$GDB"), "-batch", "-nx", "-x", script_path, source],
+        env=_get_sysenv(env))
+    if result.returncode != 0:
+        raise UploadServerError("GDB upload through JLinkGDBServer failed")
+
+
+def UploadViaServer(env, kind, command, source):
+    """Uploads source through the persistent server of the given kind
+    ("openocd" or "jlink") started with command, returns an exit code"""
+    upload = _openocd_upload if kind == "openocd" else _jlink_upload
+    try:
+        server = _get_upload_server(env, kind, command)
+        if server.ensure_running():
+            print("Started %s upload server on port %d" % (kind, server.port))
+        try:
+            upload(env, server, source)
+        except (OSError, UploadServerError) as exc:
+            if server.is_alive():
+                raise
+            # the server died during the upload, try once more with a new one
+            sys.stderr.write("Upload server lost (%s), restarting it\n" % exc)
+            server.ensure_running()
+            upload(env, server, source)
+    except (OSError, UploadServerError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    return 0
+
+
+def StopUploadServer(env, kind, command):
+    try:
+        server = _get_upload_server(env, kind, command)
+    except UploadServerError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    server.stop()
+    return 0
+
+
+env.AddMethod(_is_persistent_server_enabled, "IsPersistentUploadServerEnabled")
+env.AddMethod(GetOpenOCDProgramCommands)
+env.AddMethod(UploadViaServer)
+env.AddMethod(StopUploadServer)
@@ -0,0 +1,440 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# "pio run -t wcet": static estimate of the worst case execution time of
+# the interrupt handlers and of their entry latency, computed on the host
+# from the linked ELF file (no target needed).
+#
+# The handlers are the functions in the vector table of the startup code,
+# more functions (e.g. callbacks registered at runtime) can be added with
+#   board_build.wcet_functions = my_callback
+# Every instruction is charged with the worst case of the Cortex-M3 / M4 /
+# M33 timing tables, taken branches with the pipeline refill. Code running
+# from flash pays the flash wait states for every refill and every literal
+# load. The wait states follow from build.f_cpu, the defaults describe the
+# slow flash area, code in the zero wait state area can be described with
+#   board_build.flash_wait_states = 0
+#
+# Loops are bounded by annotations, per function or per backward branch
+# (offset of the branch in the function, as shown in the disassembly):
+#   board_build.wcet_loop_bounds = crc32_update=256, TIMER0_IRQHandler+0x2c=4
+#   board_build.wcet_default_loop_bound = 8   (loops without annotation)
+# Loops without any bound are counted once and marked as unbounded, as are
+# recursion and calls through function pointers.
+#
+# The latency of a handler is the exception entry plus the longest other
+# handler it can't preempt, that is one of the same or a more urgent
+# priority (lower number). The priorities are those set with
+# NVIC_SetPriority() / nvic_irq_enable():
+#   board_build.wcet_priorities = TIMER0_IRQHandler=1, USART0_IRQHandler=2
+# Handlers without an entry have the reset priority 0, so without the
+# option every handler may block every other one (a pessimistic bound).
+# Reset, NMI and HardFault are not analyzed.
+#
+
+import json
+import math
+import re
+import sys
+from os.path import join
+
+from SCons.Script import DefaultEnvironment
+
+env = DefaultEnvironment()
+
+# cycles per instruction class, the worst case of the ranges given in the
+# technical reference manuals. "refill" is the pipeline refill of taken
+# branches (P = 1..3).
+CORTEX_M_TIMINGS = {
+    "cortex-m3": {
+        "alu": 1, "mul": 1, "mla": 2, "mull": 5, "mlal": 7, "div": 12,
+        "load": 2, "store": 2, "refill": 3,
+    },
+    "cortex-m4": {
+        "alu": 1, "mul": 1, "mla": 1, "mull": 1, "mlal": 1, "div": 12,
+        "load": 2, "store": 2, "refill": 3,
+        "fpu": 1, "fpu_mla": 3, "fpu_div": 14, "fpu_load": 2,
+    },
+    "cortex-m33": {
+        "alu": 1, "mul": 1, "mla": 1, "mull": 1, "mlal": 1, "div": 11,
+        "load": 2, "store": 2, "refill": 3,
+        "fpu": 1, "fpu_mla": 3, "fpu_div": 14, "fpu_load": 2,
+    },
+}
+INSTRUCTION_CLASSES = {
+    "load": ("ldr", "ldrb", "ldrh", "ldrsb", "ldrsh", "ldrex", "ldrexb", "ldrexh",
+             "ldrt", "ldrbt", "ldrht", "ldrsbt", "ldrsht"),
+    "store": ("str", "strb", "strh", "strex", "strexb", "strexh", "strt", "strbt",
+              "strht"),
+    "multiple": ("ldm", "ldmia", "ldmfd", "ldmdb", "ldmea", "stm", "stmia", "stmea",
+                 "stmdb", "stmfd", "push", "pop", "ldrd", "strd"),
+    "mul": ("mul",),
+    "mla": ("mla", "mls"),
+    "mull": ("umull", "smull"),
+    "mlal": ("umlal", "smlal"),
+    "div": ("sdiv", "udiv"),
+    "fpu": ("vadd", "vsub", "vmul", "vnmul", "vneg", "vabs", "vcmp", "vcmpe", "vcvt",
+            "vcvtr", "vmov", "vmrs", "vmsr"),
+    "fpu_mla": ("vmla", "vmls", "vnmla", "vnmls", "vfma", "vfms", "vfnma", "vfnms"),
+    "fpu_div": ("vdiv", "vsqrt"),
+    "fpu_load": ("vldr", "vstr"),
+    "fpu_multiple": ("vpush", "vpop", "vldm", "vldmia", "vldmdb", "vstm", "vstmia",
+                     "vstmdb"),
+    "branch": ("b", "bl", "blx", "bx", "cbz", "cbnz", "tbb", "tbh"),
+}
+MNEMONIC_CLASSES = {
+    mnemonic: cls for cls, mnemonics in INSTRUCTION_CLASSES.items() for mnemonic in mnemonics}
+CONDITIONS = (
+    "eq", "ne", "cs", "hs", "cc", "lo", "mi", "pl", "vs", "vc", "hi", "ls", "ge",
+    "lt", "gt", "le", "al")
+# exception entry (stacking and vector fetch) and lazy FPU state stacking
+EXCEPTION_ENTRY = 12
+LAZY_FPU_STACKING = 17
+# MHz per flash wait state
+FLASH_WAIT_STATE_STEPS = {
+    "gd32f4xx": 30,
+}
+DEFAULT_FLASH_WAIT_STATE_STEP = 24
+FLASH_START = 0x08000000
+FLASH_END = 0x10000000
+
+BRANCH_TARGET_RE = re.compile(r"^\s*(?:\w+,\s*)?([0-9a-fA-F]+) <([^>+]+)(?:\+0x[0-9a-fA-F]+)?>")
+REGISTER_LIST_RE = re.compile(r"\{([^}]*)\}")
+
+
+class WcetError(Exception):
+    pass
+
+
+def split_mnemonic(mnemonic):
+    """Returns (base mnemonic, conditional), e.g. "ldrbeq.w" -> ("ldrb", True),
+    "bls" -> ("b", True), "muls" -> ("mul", False)"""
+    mnemonic = mnemonic.split(".")[0]
+    if mnemonic in MNEMONIC_CLASSES:
+        return mnemonic, False
+    if len(mnemonic) > 2 and mnemonic[-2:] in CONDITIONS:
+        base = mnemonic[:-2]
+        if base not in MNEMONIC_CLASSES and base.endswith("s"):
+            base = base[:-1]
+        if base in MNEMONIC_CLASSES:
+            return base, True
+    if mnemonic.endswith("s") and mnemonic[:-1] in MNEMONIC_CLASSES:
+        return mnemonic[:-1], False
+    return mnemonic, False
+
+
+def _get_register_count(operands):
+    match = REGISTER_LIST_RE.search(operands)
+    if not match:
+        return 2
+    count = 0
+    for item in match.group(1).split(","):
+        first, _, last = item.strip().partition("-")
+        if last:
+            count += int(re.sub(r"\D", "", last)) - int(re.sub(r"\D", "", first)) + 1
+        elif first:
+            count += 1
+    return count
+
+
+def get_instruction_cycles(timings, mnemonic, operands):
+    """Cycles of a non-branch instruction, without wait states"""
+    cls = MNEMONIC_CLASSES.get(mnemonic, "alu")
+    if cls in ("multiple", "fpu_multiple"):
+        return 1 + _get_register_count(operands)
+    return timings.get(cls, timings["alu"])
+
+
+def get_flash_wait_states(board):
+    if str(board.get("build.flash_wait_states", "")) != "":
+        return int(board.get("build.flash_wait_states"))
+    f_cpu = int(str(board.get("build.f_cpu", "0")).rstrip("L"))
+    step = FLASH_WAIT_STATE_STEPS.get(
+        board.get("build.spl_series", "").lower(), DEFAULT_FLASH_WAIT_STATE_STEP)
+    return max(0, int(math.ceil(f_cpu / (step * 1e6))) - 1)
+
+
+def parse_loop_bounds(value):
+    """"crc32=256, isr+0x2c=4" -> {"crc32": 256, "isr+0x2c": 4}"""
+    bounds = {}
+    for item in str(value).replace(",", " ").split():
+        name, _, bound = item.partition("=")
+        if bound:
+            key = name.strip()
+            if "+" in key:
+                function, _, offset = key.partition("+")
+                key = "%s+0x%x" % (function, int(offset, 16))
+            bounds[key] = int(bound)
+    return bounds
+
+
+def parse_priorities(value):
+    """"TIMER0_IRQHandler=1, USART0_IRQHandler=2" -> {"TIMER0_IRQHandler": 1, ...}"""
+    priorities = {}
+    for item in str(value).replace(",", " ").split():
+        name, _, priority = item.partition("=")
+        if priority:
+            priorities[name.strip()] = int(priority, 0)
+    return priorities
+
+
+def get_latencies(results, priorities, entry):
+    """Sets the "priority" and "latency" of the handler results: the entry
+    plus the longest other handler of the same or a more urgent priority"""
+    for result in results:
+        result["priority"] = priorities.get(result["function"], 0) if result["handler"] else None
+    for result in results:
+        if not result["handler"]:
+            result["latency"] = None
+            continue
+        others = [
+            r["cycles"] for r in results
+            if r["handler"] and r is not result and r["priority"] <= result["priority"]]
+        result["latency"] = entry + (max(others) if others else 0)
+
+
+class WcetAnalyzer(object):
+
+    def __init__(self, functions, timings, wait_states, loop_bounds, default_loop_bound=None):
+        self.functions = functions
+        self.timings = timings
+        self.wait_states = wait_states
+        self.loop_bounds = loop_bounds
+        self.default_loop_bound = default_loop_bound
+        self._starts = {f["address"]: name for name, f in functions.items()}
+        self._memo = {}
+        # worst case cycles from every instruction, for jumps into the middle
+        # of other functions
+        self._worst = {}
+
+    def _fetch_penalty(self, function):
+        address = function["address"]
+        return self.wait_states if FLASH_START <= address < FLASH_END else 0
+
+    def get_wcet(self, name, stack=()):
+        """Returns (cycles, [functions on the worst path], flags)"""
+        if name in stack:
+            return 0, [], {"recursion"}
+        if name in self._memo:
+            return self._memo[name]
+        function = self.functions.get(name)
+        if function is None:
+            return 0, [name], {"unknown function"}
+        result = self._analyze(name, function, stack + (name,))
+        if "recursion" not in result[2] or not stack:
+            self._memo[name] = result
+        return result
+
+    def _get_jump(self, target, stack):
+        """Returns (function, (cycles, path, flags)) of a branch leaving the
+        function: a tail call or a jump into another function (e.g. a
+        shared epilogue)"""
+        address = int(target.group(1), 16)
+        callee = self._starts.get(address, target.group(2))
+        result = self.get_wcet(callee, stack)
+        if address in self._starts or callee not in self.functions:
+            return callee, result
+        for i, (insn_address, _, _) in enumerate(self.functions[callee]["instructions"]):
+            if insn_address == address and callee in self._worst:
+                return callee, (self._worst[callee][i], result[1], result[2])
+        return callee, (result[0], result[1], result[2] | {"jump into function"})
+
+    def _analyze(self, name, function, stack):
+        instructions = function["instructions"]
+        index = {address: i for i, (address, _, _) in enumerate(instructions)}
+        ws = self._fetch_penalty(function)
+        refill = self.timings["refill"] + ws
+        flags = set()
+        n = len(instructions)
+        # per instruction: its cost, the successors as [(index, extra cost
+        # of the taken branch)] and the called function
+        cost = [0] * n
+        successors = [None] * n
+        calls = [None] * n
+        back_edges = []
+        for i, (address, mnemonic, operands) in enumerate(instructions):
+            base, conditional = split_mnemonic(mnemonic)
+            target = BRANCH_TARGET_RE.match(operands)
+            target_name = target.group(2) if target else None
+            # local by address, objdump may name the label after another
+            # symbol
+            target_index = index.get(int(target.group(1), 16)) if target else None
+            # fall through by default
+            succ = [(i + 1, 0)] if i + 1 < n else []
+            if base in ("b", "cbz", "cbnz") and target:
+                cost[i] = 1
+                if target_index is not None:
+                    if target_index <= i:
+                        back_edges.append((i, target_index, address - function["address"]))
+                        if base == "b" and not conditional:
+                            succ = []
+                    else:
+                        jump = [(target_index, refill)]
+                        succ = jump if base == "b" and not conditional else succ + jump
+                else:
+                    # tail call (also cbz / cbnz and conditional ones, those
+                    # keep the fall through)
+                    target_name, callee = self._get_jump(target, stack)
+                    calls[i] = (target_name, callee)
+                    flags |= callee[2]
+                    cost[i] = 1 + refill + callee[0]
+                    if base == "b" and not conditional:
+                        succ = []
+            elif base in ("bl", "blx") and target:
+                callee = self.get_wcet(target_name, stack)
+                calls[i] = (target_name, callee)
+                flags |= callee[2]
+                cost[i] = 1 + refill + callee[0]
+            elif base in ("blx", "bx"):
+                cost[i] = 1 + refill
+                if base == "blx":
+                    flags.add("indirect call")
+                else:
+                    if operands.strip() != "lr":
+                        flags.add("indirect jump")
+                    if not conditional:
+                        succ = []
+            elif base in ("tbb", "tbh"):
+                # switch tables, any later instruction may be the target
+                flags.add("table jump")
+                cost[i] = self.timings["load"] + 1 + refill + ws
+                succ = [(j, 0) for j in range(i + 1, n)]
+            elif base in ("pop", "ldm", "ldmia", "ldmfd") and "pc" in operands:
+                cost[i] = get_instruction_cycles(self.timings, base, operands) + refill
+                if not conditional:
+                    succ = []
+            else:
+                cost[i] = get_instruction_cycles(self.timings, base, operands)
+                if base in MNEMONIC_CLASSES and MNEMONIC_CLASSES[base] == "load" and "[pc" in operands:
+                    # literal pool in flash
+                    cost[i] += ws
+            successors[i] = succ
+
+        # loops, innermost first: the body is executed bound - 1 more times
+        for i, start, offset in sorted(back_edges, key=lambda e: e[0] - e[1]):
+            bound = self.loop_bounds.get("%s+0x%x" % (name, offset))
+            if bound is None:
+                bound = self.loop_bounds.get(name, self.default_loop_bound)
+            if bound is None:
+                flags.add("unbounded loop")
+                bound = 1
+            body = sum(cost[start:i + 1]) + refill
+            cost[i] += (bound - 1) * body
+
+        # longest path over the forward edges
+        worst = [0] * (n + 1)
+        best_next = [None] * n
+        for i in range(n - 1, -1, -1):
+            best = (0, None)
+            for j, extra in successors[i]:
+                if j >= n:
+                    continue
+                if extra + worst[j] > best[0] or best[1] is None:
+                    best = (extra + worst[j], j)
+            worst[i] = cost[i] + best[0]
+            best_next[i] = best[1]
+        self._worst[name] = worst
+
+        path = [name]
+        i = 0 if n else None
+        while i is not None:
+            if calls[i]:
+                path.extend(calls[i][1][1])
+            i = best_next[i]
+        return worst[0] if n else 0, path, flags
+
+
+def _get_timings(board):
+    cpu = board.get("build.cpu", "").lower()
+    if cpu not in CORTEX_M_TIMINGS:
+        raise WcetError("No instruction timings for %s, supported are %s" % (
+            cpu or board.get("build.mcu", ""), ", ".join(sorted(CORTEX_M_TIMINGS))))
+    return CORTEX_M_TIMINGS[cpu]
+
+
+def _get_list_option(board, option):
+    return [
+        v.strip() for v in str(board.get(option, "")).replace(",", " ").split()
+        if v.strip()
+    ]
+
+
+def Wcet(target, source, env):
+    board = env.BoardConfig()
+    elf_path = source[0].get_abspath()
+    try:
+        timings = _get_timings(board)
+        functions = env.DisassembleElf(elf_path)
+        handlers = env.GetVectorTableHandlers(elf_path)
+    except (WcetError, OSError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    handlers = [h for h in handlers if h in functions]
+    extra = [f for f in _get_list_option(board, "build.wcet_functions") if f in functions]
+
+    wait_states = get_flash_wait_states(board)
+    default_bound = board.get("build.wcet_default_loop_bound", "")
+    analyzer = WcetAnalyzer(
+        functions, timings, wait_states,
+        parse_loop_bounds(board.get("build.wcet_loop_bounds", "")),
+        int(default_bound) if str(default_bound) != "" else None)
+    f_cpu = int(str(board.get("build.f_cpu", "0")).rstrip("L"))
+
+    hard_float = any(
+        "-mfloat-abi=hard" in str(f) or "-mfloat-abi=softfp" in str(f)
+        for f in env.get("CCFLAGS", []) + env.get("LINKFLAGS", []))
+    entry = EXCEPTION_ENTRY + wait_states + (LAZY_FPU_STACKING if hard_float else 0)
+
+    results = []
+    for name in handlers + extra:
+        cycles, path, flags = analyzer.get_wcet(name)
+        results.append({
+            "function": name, "handler": name in handlers, "cycles": cycles,
+            "path": path, "flags": sorted(flags)})
+    get_latencies(
+        results, parse_priorities(board.get("build.wcet_priorities", "")), entry)
+
+    def _us(cycles):
+        return 1e6 * cycles / f_cpu if f_cpu else 0
+
+    print("CPU %s at %d MHz, %d flash wait state(s), exception entry %d cycles" % (
+        board.get("build.cpu"), f_cpu // 1000000, wait_states, entry))
+    print("%-32s %10s %9s %10s %9s  %s" % (
+        "function", "wcet [cy]", "[us]", "latency", "[us]", "flags"))
+    top = int(board.get("build.wcet_top", 10))
+    results.sort(key=lambda r: r["cycles"], reverse=True)
+    for result in results[:top]:
+        latency = result["latency"]
+        print("%-32s %10d %9.2f %10s %9s  %s" % (
+            result["function"], result["cycles"], _us(result["cycles"]),
+            latency if latency is not None else "-",
+            "%.2f" % _us(latency) if latency is not None else "-",
+            ", ".join(result["flags"])))
+    print("")
+    print("Slowest paths:")
+    for result in results[:top]:
+        if len(result["path"]) > 1:
+            print("  %s" % " -> ".join(result["path"]))
+
+    with open(join(env.subst("$BUILD_DIR"), "wcet.json"), "w") as fp:
+        json.dump({
+            "cpu": board.get("build.cpu"), "f_cpu": f_cpu, "wait_states": wait_states,
+            "exception_entry": entry, "functions": results}, fp, indent=2)
+    return None
+
+
+env.AddMethod(
+    lambda env: env.VerboseAction(Wcet, "Estimating execution times of $SOURCE"),
+    "WcetAction")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.util
+import os
+import sys
+
+# Queries the boards of this platform by their attributes through
+# Gd32Platform.query_boards(), e.g.
+#   query_boards.py --cpu cortex-m4 --min-flash 256K --framework arduino --protocol dfu
+# Like the platform, it also finds the boards of the project (when run
+# from a project folder) and of the core boards folder. Needs to be run
+# with the Python interpreter of PlatformIO (e.g.
+# ~/.platformio/penv/bin/python), since platform.py imports PlatformIO.
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    for suffix, factor in (("K", 1024), ("M", 1024 * 1024)):
+        if value.endswith(suffix):
+            return int(value[:-1], 0) * factor
+    return int(value, 0)
+
+def load_platform_module(platform_dir: str):
+    spec = importlib.util.spec_from_file_location(
+        "gd32_platform", os.path.join(platform_dir, "platform.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main():
+    parser = argparse.ArgumentParser(description="Find boards by their attributes.")
+    parser.add_argument("--mcu", help="MCU pattern, e.g. 'gd32f30*'")
+    parser.add_argument("--cpu", help="CPU pattern, e.g. 'cortex-m4'")
+    parser.add_argument("--series", dest="spl_series", help="SPL series pattern, e.g. 'GD32F30x'")
+    parser.add_argument("--framework", dest="frameworks", action="append",
+                        help="required framework (repeatable)")
+    parser.add_argument("--protocol", dest="protocols", action="append",
+                        help="required upload protocol (repeatable)")
+    for name in ("min-flash", "max-flash", "min-ram", "max-ram"):
+        parser.add_argument("--" + name, type=parse_size,
+                            help="size in bytes, K or M suffixes are allowed")
+    args = parser.parse_args()
+
+    this_script_path = os.path.dirname(os.path.realpath(__file__))
+    platform_dir = os.path.realpath(os.path.join(this_script_path, "..", ".."))
+    platform = load_platform_module(platform_dir).Gd32Platform(
+        os.path.join(platform_dir, "platform.json"))
+    for board_id in platform.query_boards(**vars(args)):
+        print(board_id)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,16 +12,137 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import copy
+import fnmatch
 import json
 import os
+import re
+import subprocess
 import sys
+import tempfile
 
 from platform import system
 
 from platformio.managers.platform import PlatformBase
 from platformio.util import get_systype
 
+
+def get_board_attributes(manifest):
+    # attributes for the secondary board indexes of query_boards()
+    build = manifest.get("build", {})
+    upload = manifest.get("upload", {})
+    return {
+        "mcu": [str(build.get("mcu", "")).lower()],
+        "cpu": [str(build.get("cpu", "")).lower()],
+        "spl_series": [str(build.get("spl_series", "")).lower()],
+        "frameworks": [str(f).lower() for f in manifest.get("frameworks", [])],
+        "protocols": [str(p).lower() for p in upload.get("protocols", [])],
+        "flash": int(upload.get("maximum_size", 0)),
+        "ram": int(upload.get("maximum_ram_size", 0)),
+    }
+
+
+def build_attribute_indexes(manifests):
+    # set attributes: {value: [board ids]}, range attributes: parallel
+    # lists of sorted values and board ids
+    indexes = {}
+    for board_id, manifest in sorted(manifests.items()):
+        for name, value in get_board_attributes(manifest).items():
+            if isinstance(value, list):
+                for v in value:
+                    indexes.setdefault(name, {}).setdefault(v, []).append(board_id)
+            else:
+                indexes.setdefault(name, []).append((value, board_id))
+    for name in ("flash", "ram"):
+        entries = sorted(indexes.get(name, []))
+        indexes[name] = {
+            "values": [e[0] for e in entries],
+            "ids": [e[1] for e in entries]
+        }
+    return indexes
+
+
+def query_attribute_indexes(indexes, mcu=None, cpu=None, spl_series=None,
+                            frameworks=None, protocols=None, min_flash=None,
+                            max_flash=None, min_ram=None, max_ram=None):
+    """Returns the sorted IDs of all boards matching all given criteria.
+    mcu, cpu and spl_series are case-insensitive patterns (e.g. "gd32f30*"),
+    frameworks and protocols lists of which all have to be supported,
+    flash and RAM sizes are inclusive bounds in bytes."""
+    result = None
+
+    def _restrict(ids):
+        return set(ids) if result is None else result & set(ids)
+
+    for name, pattern in (("mcu", mcu), ("cpu", cpu), ("spl_series", spl_series)):
+        if pattern is None:
+            continue
+        ids = set()
+        for value in fnmatch.filter(indexes.get(name, {}).keys(), pattern.lower()):
+            ids.update(indexes[name][value])
+        result = _restrict(ids)
+    for name, required in (("frameworks", frameworks), ("protocols", protocols)):
+        for value in required or []:
+            result = _restrict(indexes.get(name, {}).get(value.lower(), []))
+    for name, low, high in (("flash", min_flash, max_flash), ("ram", min_ram, max_ram)):
+        if low is None and high is None:
+            continue
+        values = indexes[name]["values"]
+        start = 0 if low is None else bisect.bisect_left(values, low)
+        end = len(values) if high is None else bisect.bisect_right(values, high)
+        result = _restrict(indexes[name]["ids"][start:end])
+    if result is None:
+        result = set(indexes["flash"]["ids"])
+    return sorted(result)
+
+
+# candidate SWD / JTAG clocks for debug_speed = auto (kHz)
+ADAPTER_SPEEDS = (100, 250, 500, 1000, 2000, 4000, 8000, 12000, 16000, 24000)
+# binary search for the fastest clock at which the flash can be read
+# reliably, the data read at the slowest clock is the reference.
+ADAPTER_SPEED_TUNING_SCRIPT = """init
+adapter speed %(slowest)d
+set ref [read_memory 0x08000000 32 256]
+set speeds {%(speeds)s}
+set lo 0
+set hi [expr {[llength $speeds] - 1}]
+set best -1
+while {$lo <= $hi} {
+    set mid [expr {($lo + $hi) / 2}]
+    adapter speed [lindex $speeds $mid]
+    set ok 1
+    for {set i 0} {$i < 3} {incr i} {
+        if {[catch {read_memory 0x08000000 32 256} data] || $data ne $ref} {
+            set ok 0
+            break
+        }
+    }
+    if {$ok} {
+        set best $mid
+        set lo [expr {$mid + 1}]
+    } else {
+        set hi [expr {$mid - 1}]
+    }
+}
+if {$best >= 0} {
+    echo "PIO_ADAPTER_SPEED [lindex $speeds $best]"
+}
+shutdown
+"""
+
+
+# OpenOCD commands selecting the adapter by its serial number
+ADAPTER_SERIAL_RE = re.compile(
+    r"(?:^|;)\s*(?:adapter serial|hla_serial|cmsis_dap_serial|ftdi serial|ftdi_serial)"
+    r"\s+[\"{]?([^\s\";}]+)")
+# USB VID:PID pairs declared by the interface configurations
+ADAPTER_VID_PID_RE = re.compile(
+    r"^\s*(?:hla_vid_pid|cmsis_dap_vid_pid|ftdi vid_pid|ftdi_vid_pid|st-link vid_pid)"
+    r"((?:\s+0x[0-9a-fA-F]+)+)", re.M)
+OPENOCD_SOURCE_RE = re.compile(r"^\s*source\s+\[find\s+([^\]]+)\]", re.M)
+
+
 class Gd32Platform(PlatformBase):
     # provides fixes for GD32E50x. Mac packages are still t.b.d.
     openocd_gd32 = {
@@ -66,8 +187,6 @@ class Gd32Platform(PlatformBase):
                     if board in json.load(fp):
                         self.packages["framework-mbed"]["version"] = "~6.51506.0"
             self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.90201.0"
-        if "wifi-sdk" in frameworks:
-            self.packages["tool-sreccat"]["optional"] = False
         if "zephyr" in variables.get("pioframework", []):
             for p in self.packages:
                 if p in ("tool-cmake", "tool-dtc", "tool-ninja"):
@@ -101,6 +220,14 @@ class Gd32Platform(PlatformBase):
         return PlatformBase.configure_default_packages(self, variables,
                                                        targets)
 
+    # full debug tool sections per board, memoized by (manifest path, mtime)
+    _debug_tools_cache = {}
+    # interned OpenOCD server argument lists, shared by all boards with the
+    # same (link, openocd board / target, extra args) combination
+    _openocd_args_templates = {}
+    # secondary indexes of query_boards()
+    _attribute_indexes = None
+
     def get_boards(self, id_=None):
         result = PlatformBase.get_boards(self, id_)
         if not result:
@@ -108,32 +235,87 @@ class Gd32Platform(PlatformBase):
         if id_:
             return self._add_default_debug_tools(result)
         else:
+            # listing boards only needs the tool names and default / onboard
+            # flags, the server configuration is added on first access of a
+            # single board (e.g. through board_config()).
             for key, value in result.items():
-                result[key] = self._add_default_debug_tools(result[key])
+                result[key] = self._add_default_debug_tools(result[key], brief=True)
         return result
 
-    def _add_default_debug_tools(self, board):
+    def query_boards(self, **criteria):
+        """Board IDs matching the given attributes, e.g.
+        query_boards(cpu="cortex-m4", min_flash=256 * 1024,
+                     frameworks=["arduino"], protocols=["dfu"]).
+        See query_attribute_indexes() for all criteria."""
+        # built once per platform instance, further queries only intersect
+        # the indexes
+        if self._attribute_indexes is None:
+            self._attribute_indexes = build_attribute_indexes({
+                board_id: board.manifest
+                for board_id, board in PlatformBase.get_boards(self).items()
+            })
+        return query_attribute_indexes(self._attribute_indexes, **criteria)
+
+    def _add_default_debug_tools(self, board, brief=False):
         debug = board.manifest.get("debug", {})
         upload_protocols = board.manifest.get("upload", {}).get(
             "protocols", [])
         if "tools" not in debug:
             debug["tools"] = {}
+        # links defined by the manifest itself are never touched
+        generated = getattr(board, "_generated_debug_tools", None)
+        if generated is None:
+            generated = board._generated_debug_tools = {}
+
+        links = [
+            link for link in ("blackmagic", "jlink", "stlink", "cmsis-dap", "sipeed-rv-debugger")
+            if link in upload_protocols and (link not in debug["tools"] or link in generated)
+        ]
+        if brief:
+            for link in links:
+                if link in generated:
+                    continue
+                debug["tools"][link] = {
+                    "onboard": link in debug.get("onboard_tools", []),
+                    "default": link in debug.get("default_tools", [])
+                }
+                generated[link] = "brief"
+        elif any(generated.get(link) != "full" for link in links):
+            tools = self._get_default_debug_tools(board, debug, links)
+            for link in links:
+                # copy, the debug session modifies the server settings in place
+                tool = dict(tools[link])
+                if "server" in tool:
+                    tool["server"] = dict(
+                        tool["server"], arguments=list(tool["server"]["arguments"]))
+                debug["tools"][link] = tool
+                generated[link] = "full"
+
+        board.manifest["debug"] = debug
+        return board
+
+    def _get_default_debug_tools(self, board, debug, links):
+        try:
+            cache_key = (board.manifest_path, os.path.getmtime(board.manifest_path))
+        except (AttributeError, OSError):
+            cache_key = None
+        if cache_key in Gd32Platform._debug_tools_cache:
+            return Gd32Platform._debug_tools_cache[cache_key]
 
+        tools = {}
         ftdi_based_links = ["sipeed-rv-debugger"]
 
         # BlackMagic, J-Link, ST-Link, Sipeed RV Debugger
-        for link in ("blackmagic", "jlink", "stlink", "cmsis-dap", "sipeed-rv-debugger"):
-            if link not in upload_protocols or link in debug["tools"]:
-                continue
+        for link in links:
             if link == "blackmagic":
-                debug["tools"]["blackmagic"] = {
+                tools["blackmagic"] = {
                     "hwids": [["0x1d50", "0x6018"]],
                     "require_debug_port": True
                 }
             elif link == "jlink":
                 assert debug.get("jlink_device"), (
                     "Missed J-Link Device ID for %s" % board.id)
-                debug["tools"][link] = {
+                tools[link] = {
                     "server": {
                         "package": "tool-jlink",
                         "arguments": [
@@ -149,58 +331,248 @@ class Gd32Platform(PlatformBase):
                     }
                 }
             else:
-                server_args = ["-s", "$PACKAGE_DIR/scripts"]
-                if debug.get("openocd_board"):
-                    server_args.extend([
-                        "-f", "board/%s.cfg" % debug.get("openocd_board")
-                    ])
-                else:
+                if not debug.get("openocd_board"):
                     assert debug.get("openocd_target"), (
                         "Missed target configuration for %s" % board.id)
-                    if link in ftdi_based_links:
-                        server_args.extend([
-                            "-f", "interface/ftdi/%s.cfg" % link,
-                            # JTAG protocol already pre-selected in .cfg file
-                            # ..probably allow overriding to SWD based link too?
-                        ])
-                    else:
-                        server_args.extend([
-                            "-f", "interface/%s.cfg" % link,
-                            "-c", "transport select %s" % (
-                                "hla_swd" if link == "stlink" else "swd"),
-                        ])
-                    # for GD32 chips we need to be able to insert a -c "set CPUTAPID .." command
-                    # *before* the target cfg is loaded.                    
-                    server_args.extend(debug.get("openocd_extra_pre_target_args", []))
-                    server_args.extend([
-                        "-f", "target/%s.cfg" % debug.get("openocd_target")
-                    ])
-                    # Always try and detect any RTOS
-                    server_args.extend([
-                        "-c", "%s.cpu configure -rtos auto" % (debug.get("openocd_target"))
-                    ])
-                    server_args.extend(debug.get("openocd_extra_args", []))
-                debug["tools"][link] = {
+                tools[link] = {
                     "server": {
                         "package": "tool-openocd-gd32",
                         "executable": "bin/openocd",
-                        "arguments": server_args
+                        "arguments": self._get_openocd_args(
+                            link, link in ftdi_based_links,
+                            debug.get("openocd_board"),
+                            debug.get("openocd_target"),
+                            tuple(debug.get("openocd_extra_pre_target_args", [])),
+                            tuple(debug.get("openocd_extra_args", [])))
                     }
                 }
-            debug["tools"][link]["onboard"] = link in debug.get("onboard_tools", [])
-            debug["tools"][link]["default"] = link in debug.get("default_tools", [])
+            tools[link]["onboard"] = link in debug.get("onboard_tools", [])
+            tools[link]["default"] = link in debug.get("default_tools", [])
 
-        board.manifest["debug"] = debug
-        return board
+        if cache_key:
+            Gd32Platform._debug_tools_cache[cache_key] = tools
+        return tools
+
+    def _get_openocd_args(self, link, ftdi_based, openocd_board, openocd_target,
+                          extra_pre_target_args, extra_args):
+        template_key = (link, ftdi_based, openocd_board, openocd_target,
+                        extra_pre_target_args, extra_args)
+        if template_key in Gd32Platform._openocd_args_templates:
+            return Gd32Platform._openocd_args_templates[template_key]
+
+        server_args = ["-s", "$PACKAGE_DIR/scripts"]
+        if openocd_board:
+            server_args.extend([
+                "-f", "board/%s.cfg" % openocd_board
+            ])
+        else:
+            if ftdi_based:
+                server_args.extend([
+                    "-f", "interface/ftdi/%s.cfg" % link,
+                    # JTAG protocol already pre-selected in .cfg file
+                    # ..probably allow overriding to SWD based link too?
+                ])
+            else:
+                server_args.extend([
+                    "-f", "interface/%s.cfg" % link,
+                    "-c", "transport select %s" % (
+                        "hla_swd" if link == "stlink" else "swd"),
+                ])
+            # for GD32 chips we need to be able to insert a -c "set CPUTAPID .." command
+            # *before* the target cfg is loaded.
+            server_args.extend(extra_pre_target_args)
+            server_args.extend([
+                "-f", "target/%s.cfg" % openocd_target
+            ])
+            # Always try and detect any RTOS
+            server_args.extend([
+                "-c", "%s.cpu configure -rtos auto" % openocd_target
+            ])
+            server_args.extend(extra_args)
+        # immutable, every board gets its own list copy
+        server_args = tuple(server_args)
+        Gd32Platform._openocd_args_templates[template_key] = server_args
+        return server_args
 
     def configure_debug_session(self, debug_config):
         server_executable = (debug_config.server or {}).get("executable", "")
         if debug_config.speed:
             if "openocd" in server_executable:
-                 debug_config.server["arguments"].extend(
-                    ["-c", "adapter speed %s" % debug_config.speed]
-                )
+                speed = debug_config.speed
+                if str(speed).lower() == "auto":
+                    speed = self.get_auto_adapter_speed(
+                        os.path.join(debug_config.server.get("cwd") or "", server_executable),
+                        debug_config.server["arguments"],
+                        debug_config.env_options.get("board"))
+                if speed:
+                    debug_config.server["arguments"].extend(
+                        ["-c", "adapter speed %s" % speed]
+                    )
             elif "jlink" in server_executable:
                 debug_config.server["arguments"].extend(
                     ["-speed", debug_config.speed]
                 )
+
+    # debug_speed = auto: the fastest stable adapter clock is determined once
+    # per (adapter, board) with OpenOCD and cached in the project workspace.
+    # J-Link handles "auto" itself.
+
+    def _get_adapter_speed_cache_path(self):
+        return os.path.join(
+            self.config.get("platformio", "workspace_dir"), "adapter_speed.json")
+
+    def _load_adapter_speeds(self):
+        try:
+            with open(self._get_adapter_speed_cache_path()) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_adapter_speed(self, key, speed):
+        speeds = self._load_adapter_speeds()
+        speeds[key] = speed
+        path = self._get_adapter_speed_cache_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fp:
+            json.dump(speeds, fp, indent=2)
+
+    @staticmethod
+    def _get_adapter_vid_pids(server_args):
+        # VID:PID pairs of the interface configuration (-f interface/...
+        # or -f board/... sourcing it), looked up in the -s scripts folders
+        args = list(server_args)
+        scripts_dirs = [args[i + 1] for i, a in enumerate(args[:-1]) if a == "-s"]
+        pending = [args[i + 1] for i, a in enumerate(args[:-1]) if a == "-f"]
+        vid_pids = []
+        for _ in range(3):  # interface configs are sourced at most 2 levels deep
+            sourced = []
+            for cfg in pending:
+                for scripts_dir in scripts_dirs:
+                    path = os.path.join(scripts_dir, cfg)
+                    if not os.path.isfile(path):
+                        continue
+                    with open(path, errors="ignore") as fp:
+                        content = fp.read()
+                    for match in ADAPTER_VID_PID_RE.finditer(content):
+                        values = [int(v, 16) for v in match.group(1).split()]
+                        vid_pids.extend(zip(values[0::2], values[1::2]))
+                    sourced.extend(OPENOCD_SOURCE_RE.findall(content))
+                    break
+            pending = sourced
+        for arg in args:
+            for match in ADAPTER_VID_PID_RE.finditer(arg):
+                values = [int(v, 16) for v in match.group(1).split()]
+                vid_pids.extend(zip(values[0::2], values[1::2]))
+        return vid_pids
+
+    @staticmethod
+    def _get_usb_serial_numbers(vid_pids):
+        """Serial numbers of the connected USB devices with one of the
+        VID:PIDs, from sysfs on Linux or through pyusb. None if the USB
+        devices can't be enumerated."""
+        serials = set()
+        sysfs_dir = "/sys/bus/usb/devices"
+        if os.path.isdir(sysfs_dir):
+            for device in os.listdir(sysfs_dir):
+                attributes = {}
+                for name in ("idVendor", "idProduct", "serial"):
+                    try:
+                        with open(os.path.join(sysfs_dir, device, name)) as fp:
+                            attributes[name] = fp.read().strip()
+                    except OSError:
+                        pass
+                try:
+                    vid_pid = (int(attributes["idVendor"], 16), int(attributes["idProduct"], 16))
+                except (KeyError, ValueError):
+                    continue
+                if vid_pid in vid_pids:
+                    serials.add(attributes.get("serial", ""))
+            return serials
+        try:
+            import usb.core
+            import usb.util
+            for vid, pid in set(vid_pids):
+                for device in usb.core.find(find_all=True, idVendor=vid, idProduct=pid):
+                    serials.add(usb.util.get_string(device, device.iSerialNumber) or "")
+        except (ImportError, ValueError, OSError):
+            # no pyusb or no libusb backend
+            return None
+        return serials
+
+    @staticmethod
+    def get_adapter_id(server_args):
+        """Identifies the adapter in the OpenOCD arguments: the serial number
+        selected by "adapter serial" (or the older driver specific commands),
+        else the serial number of the only connected USB device with a
+        VID:PID of the interface configuration. None if neither is known."""
+        for arg in server_args:
+            match = ADAPTER_SERIAL_RE.search(str(arg))
+            if match:
+                return "serial:%s" % match.group(1)
+        vid_pids = Gd32Platform._get_adapter_vid_pids(server_args)
+        if not vid_pids:
+            return None
+        serials = Gd32Platform._get_usb_serial_numbers(vid_pids)
+        # several adapters of the same kind: OpenOCD takes any of them
+        if serials and len(serials) == 1 and next(iter(serials)):
+            return "serial:%s" % next(iter(serials))
+        return None
+
+    @staticmethod
+    def get_adapter_speed_key(board_id, server_args):
+        adapter_id = Gd32Platform.get_adapter_id(server_args)
+        return "%s:%s" % (adapter_id, board_id) if adapter_id else None
+
+    def get_auto_adapter_speed(self, openocd, server_args, board_id):
+        """Returns the cached or newly tuned adapter speed in kHz, or None if
+        tuning failed (the adapter default is used then). The speed is only
+        cached if the adapter serial number is known."""
+        key = self.get_adapter_speed_key(board_id, server_args)
+        speeds = self._load_adapter_speeds() if key else {}
+        if key in speeds:
+            return speeds[key]
+        sys.stderr.write("Tuning adapter speed for %s...\n" % board_id)
+        with tempfile.NamedTemporaryFile(
+                "w", suffix=".tcl", delete=False) as fp:
+            fp.write(ADAPTER_SPEED_TUNING_SCRIPT % {
+                "slowest": ADAPTER_SPEEDS[0],
+                "speeds": " ".join(str(s) for s in ADAPTER_SPEEDS)
+            })
+        try:
+            result = subprocess.run(
+                [openocd] + list(server_args) + ["-f", fp.name.replace("\\", "/")],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, timeout=120)
+            match = re.search(r"PIO_ADAPTER_SPEED (\d+)", result.stdout)
+        except (OSError, subprocess.TimeoutExpired):
+            match = None
+        finally:
+            os.remove(fp.name)
+        if not match:
+            sys.stderr.write("Warning! Adapter speed tuning failed, using the default speed\n")
+            return None
+        speed = int(match.group(1))
+        sys.stderr.write("Adapter speed: %d kHz\n" % speed)
+        if key:
+            self._save_adapter_speed(key, speed)
+        else:
+            sys.stderr.write(
+                "The adapter serial number is unknown, so the speed is tuned again "
+                "next time. Select the adapter with \"adapter serial <number>\" "
+                "to cache it.\n")
+        return speed
+
+    def downgrade_adapter_speed(self, board_id, server_args):
+        """Steps the cached speed down after a transfer error, returns the
+        new speed or None if there is nothing to downgrade"""
+        key = self.get_adapter_speed_key(board_id, server_args)
+        if not key:
+            return None
+        speed = self._load_adapter_speeds().get(key)
+        slower = [s for s in ADAPTER_SPEEDS if speed and s < speed]
+        if not slower:
+            return None
+        self._save_adapter_speed(key, slower[-1])
+        sys.stderr.write("Adapter speed downgraded to %d kHz\n" % slower[-1])
+        return slower[-1]
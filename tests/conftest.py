@@ -0,0 +1,73 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# The builder modules are SConscripts that register their functions on the
+# PlatformIO build environment when they are loaded. The tests only cover
+# the parts that don't need a build, so the environment is replaced by a
+# minimal stand-in. Run with "pytest tests" from the platform folder
+# ("python -m pytest" puts platform.py in front of the standard library).
+#
+
+import importlib.util
+import sys
+import types
+from os.path import abspath, dirname, join
+
+import pytest
+
+BUILDER_DIR = join(dirname(dirname(abspath(__file__))), "builder")
+
+
+class FakeBoardConfig(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+
+class FakeEnvironment(dict):
+    def __init__(self, board=None):
+        dict.__init__(self)
+        self.board = FakeBoardConfig(board or {})
+
+    def AddMethod(self, function, name=None):
+        setattr(self, name or function.__name__, types.MethodType(function, self))
+
+    def BoardConfig(self):
+        return self.board
+
+    def Append(self, **kwargs):
+        for key, value in kwargs.items():
+            self.setdefault(key, []).extend(value)
+
+
+@pytest.fixture
+def load_builder_module(monkeypatch):
+    """Loads builder/<name>.py, returns (module, env)"""
+
+    def _load(name, board=None, targets=None):
+        env = FakeEnvironment(board)
+        scons = types.ModuleType("SCons")
+        script = types.ModuleType("SCons.Script")
+        script.DefaultEnvironment = lambda: env
+        script.COMMAND_LINE_TARGETS = list(targets or [])
+        scons.Script = script
+        monkeypatch.setitem(sys.modules, "SCons", scons)
+        monkeypatch.setitem(sys.modules, "SCons.Script", script)
+        spec = importlib.util.spec_from_file_location(
+            "builder_%s" % name, join(BUILDER_DIR, "%s.py" % name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module, env
+
+    return _load
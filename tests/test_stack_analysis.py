@@ -0,0 +1,108 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+DISASSEMBLY = """
+08000100 <Reset_Handler>:
+ 8000100:	push	{r7, lr}
+ 8000102:	bl	8000200 <SystemInit>
+ 8000106:	bl	8000300 <main>
+ 800010a:	b.n	800010a <Reset_Handler+0xa>
+
+08000200 <SystemInit>:
+ 8000200:	push	{r4, lr}
+ 8000202:	pop	{r4, pc}
+
+08000300 <main>:
+ 8000300:	push	{r4, r5, r6, lr}
+ 8000302:	sub	sp, #8
+ 8000304:	bl	8000400 <process>
+ 8000308:	b.n	8000304 <main+0x4>
+
+08000400 <process>:
+ 8000400:	push	{r4, r5, r6, r7, lr}
+ 8000402:	sub	sp, #20
+ 8000404:	pop	{r4, r5, r6, r7, pc}
+
+08000500 <NMI_Handler>:
+ 8000500:	push	{r4, r5, r6, r7, lr}
+ 8000502:	sub	sp, #200
+ 8000504:	b.n	8000504 <NMI_Handler+0x4>
+
+08000600 <TIMER0_IRQHandler>:
+ 8000600:	push	{r4, lr}
+ 8000602:	bl	8000400 <process>
+ 8000606:	pop	{r4, pc}
+
+08000700 <USART0_IRQHandler>:
+ 8000700:	push	{r7, lr}
+ 8000702:	pop	{r7, pc}
+"""
+
+
+def _vector_table(*addresses):
+    return b"".join(address.to_bytes(4, "little") for address in addresses)
+
+
+@pytest.fixture
+def stack_analysis(load_builder_module):
+    return load_builder_module("stack_analysis")[0]
+
+
+@pytest.fixture
+def functions(stack_analysis):
+    return stack_analysis.parse_disassembly(DISASSEMBLY)
+
+
+def test_vector_table_skips_reset_nmi_and_hardfault(stack_analysis, functions):
+    addresses = {f["address"]: name for name, f in functions.items()}
+    data = _vector_table(
+        0x20001000, 0x08000101, 0x08000501, 0x08000501,
+        0x08000601, 0x08000701, 0x08000601, 0x08000101, 0)
+    reset_handler, handlers = stack_analysis.get_vector_table_handlers(data, addresses)
+    assert reset_handler == "Reset_Handler"
+    assert handlers == ["TIMER0_IRQHandler", "USART0_IRQHandler"]
+
+
+def test_worst_case_is_reset_path_plus_deepest_handler(stack_analysis, functions):
+    results, worst_case = stack_analysis.analyze_stack(
+        functions, {}, "Reset_Handler", ["TIMER0_IRQHandler", "USART0_IRQHandler"],
+        exception_frame=32, nesting=1)
+    depths = {r["root"]: r["depth"] for r in results}
+    # Reset_Handler 8 + main 16 + 8 + process 20 + 20
+    assert depths["Reset_Handler"] == 72
+    assert "main" not in depths
+    # TIMER0_IRQHandler 8 + process 40 + exception frame
+    assert depths["TIMER0_IRQHandler"] == 80
+    assert depths["USART0_IRQHandler"] == 40
+    assert worst_case == 72 + 80
+
+    _, worst_case = stack_analysis.analyze_stack(
+        functions, {}, "Reset_Handler", ["TIMER0_IRQHandler", "USART0_IRQHandler"],
+        exception_frame=32, nesting=2)
+    assert worst_case == 72 + 80 + 40
+
+
+def test_main_is_the_root_without_vector_table(stack_analysis, functions):
+    results, worst_case = stack_analysis.analyze_stack(functions, {}, None, [])
+    assert [(r["kind"], r["root"]) for r in results] == [("main", "main")]
+    assert worst_case == 64
+
+
+def test_stack_usage_flag_only_with_the_board_option(load_builder_module):
+    _, env = load_builder_module("stack_analysis", targets=["stack-analysis"])
+    assert "-fstack-usage" not in env.get("CCFLAGS", [])
+    _, env = load_builder_module("stack_analysis", board={"build.stack_usage": "yes"})
+    assert "-fstack-usage" in env["CCFLAGS"]
@@ -0,0 +1,188 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+# stand-in for "openocd -c 'tcl_port N' ...": answers every command of the
+# Tcl RPC protocol, "catch" with 0
+FAKE_OPENOCD = """
+import socket, sys
+args = sys.argv[1:]
+port = [int(a.split()[1]) for a in args if a.startswith("tcl_port")][0]
+srv = socket.socket()
+srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+srv.bind(("127.0.0.1", port))
+srv.listen(5)
+while True:
+    conn, _ = srv.accept()
+    buf = b""
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            break
+        buf += data
+        while b"\\x1a" in buf:
+            cmd, _, buf = buf.partition(b"\\x1a")
+            conn.sendall(b"0\\x1a" if cmd.startswith(b"catch") else b"fake 0.12\\x1a")
+    conn.close()
+"""
+
+
+class FakeTclServer(object):
+    """Tcl RPC server in a thread, handler(command) returns the list of
+    chunks sent back (the terminator has to be part of them)"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.commands = []
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(1)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        conn, _ = self._sock.accept()
+        buf = b""
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                buf += data
+                while b"\x1a" in buf:
+                    cmd, _, buf = buf.partition(b"\x1a")
+                    self.commands.append(cmd.decode())
+                    chunks = self.handler(cmd.decode())
+                    if chunks is None:
+                        return
+                    for chunk in chunks:
+                        conn.sendall(chunk)
+                        time.sleep(0.01)
+
+    def close(self):
+        self._sock.close()
+
+
+@pytest.fixture
+def upload_server(load_builder_module):
+    return load_builder_module("upload_server")[0]
+
+
+def test_run_returns_the_result(upload_server):
+    server = FakeTclServer(lambda cmd: [b"0\x1a"] if cmd.startswith("catch") else [b"0x2000\x1a"])
+    with upload_server.OpenOCDTclClient("127.0.0.1", server.port) as client:
+        assert client.run("mdw 0x08000000") == "0x2000"
+    assert server.commands == ["catch {mdw 0x08000000} _pio_result", "set _pio_result"]
+    server.close()
+
+
+def test_run_raises_the_error_of_a_failed_command(upload_server):
+    server = FakeTclServer(
+        lambda cmd: [b"1\x1a"] if cmd.startswith("catch") else [b"couldn't open image.bin\x1a"])
+    with upload_server.OpenOCDTclClient("127.0.0.1", server.port) as client:
+        with pytest.raises(upload_server.UploadServerError, match="couldn't open image.bin"):
+            client.run("flash write_image erase image.bin")
+    server.close()
+
+
+def test_partial_and_combined_reads(upload_server):
+    # the first response arrives byte by byte, the second one together with
+    # the start of the third
+    responses = {
+        "a": [bytes([c]) for c in b"first\x1a"],
+        "b": [b"second\x1athi"],
+        "c": [b"rd\x1a"],
+    }
+    server = FakeTclServer(lambda cmd: responses[cmd])
+    with upload_server.OpenOCDTclClient("127.0.0.1", server.port) as client:
+        assert client.command("a") == "first"
+        assert client.command("b") == "second"
+        assert client.command("c") == "third"
+    server.close()
+
+
+def test_closed_connection(upload_server):
+    server = FakeTclServer(lambda cmd: None)
+    with upload_server.OpenOCDTclClient("127.0.0.1", server.port) as client:
+        with pytest.raises(upload_server.UploadServerError, match="closed"):
+            client.command("version")
+    server.close()
+
+
+def _get_pid(server):
+    return server._load_state()["pid"]
+
+
+def _wait_until_dead(server):
+    for _ in range(100):
+        if not server.is_alive():
+            return
+        time.sleep(0.05)
+    raise AssertionError("server still running")
+
+
+def test_ensure_running_restarts_a_dead_server(upload_server, tmp_path):
+    script = tmp_path / "fake_openocd.py"
+    script.write_text(FAKE_OPENOCD)
+    server = upload_server.UploadServer(
+        "openocd", [sys.executable, str(script)], str(tmp_path / "state"))
+    try:
+        assert server.ensure_running()
+        assert server.is_alive()
+        first_pid = _get_pid(server)
+        # running with the same command line: reused
+        assert not server.ensure_running()
+        assert _get_pid(server) == first_pid
+
+        os.kill(first_pid, signal.SIGTERM)
+        _wait_until_dead(server)
+        assert server.ensure_running()
+        assert server.is_alive()
+        assert _get_pid(server) != first_pid
+    finally:
+        server.stop()
+
+
+def test_other_arguments_for_the_same_adapter_replace_the_server(upload_server, tmp_path):
+    script = tmp_path / "fake_openocd.py"
+    script.write_text(FAKE_OPENOCD)
+    command = [sys.executable, str(script)]
+    state_dir = str(tmp_path / "state")
+    first = upload_server.UploadServer(
+        "openocd", command + ["-c", "adapter speed 1000"], state_dir, adapter_id="serial:A")
+    second = upload_server.UploadServer(
+        "openocd", command + ["-c", "adapter speed 4000"], state_dir, adapter_id="serial:A")
+    other = upload_server.UploadServer(
+        "openocd", command, state_dir, adapter_id="serial:B")
+    assert first.port == second.port != other.port
+    try:
+        assert first.ensure_running()
+        first_pid = _get_pid(first)
+        assert second.ensure_running()
+        assert _get_pid(second) != first_pid
+        with pytest.raises(OSError):
+            os.kill(first_pid, 0)
+        assert second.is_alive()
+    finally:
+        second.stop()
+        first.stop()
@@ -0,0 +1,136 @@
+# Copyright 2021-present CommunityCoresGD32 <maximlian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+DISASSEMBLY = """
+08000000 <count>:
+ 8000000:	movs	r0, #0
+ 8000002:	adds	r0, #1
+ 8000004:	cmp	r0, #10
+ 8000006:	bne.n	8000002 <count+0x2>
+ 8000008:	bx	lr
+
+08000100 <choose>:
+ 8000100:	cmp	r0, #0
+ 8000102:	beq.n	800010a <choose+0xa>
+ 8000104:	sdiv	r0, r1, r2
+ 8000108:	bx	lr
+ 800010a:	movs	r0, #0
+ 800010c:	bx	lr
+
+08000200 <handler>:
+ 8000200:	push	{r4, lr}
+ 8000202:	bl	8000100 <choose>
+ 8000206:	cbz	r0, 800010a <choose+0xa>
+ 8000208:	pop	{r4, pc}
+
+08000300 <tail>:
+ 8000300:	movs	r0, #1
+ 8000302:	b.w	8000100 <choose>
+"""
+
+
+@pytest.fixture
+def wcet(load_builder_module):
+    return load_builder_module("wcet")[0]
+
+
+@pytest.fixture
+def analyzer(load_builder_module, wcet):
+    stack_analysis = load_builder_module("stack_analysis")[0]
+
+    def _create(loop_bounds=None, default_loop_bound=None):
+        return wcet.WcetAnalyzer(
+            stack_analysis.parse_disassembly(DISASSEMBLY), wcet.CORTEX_M_TIMINGS["cortex-m3"],
+            0, loop_bounds or {}, default_loop_bound)
+
+    return _create
+
+
+@pytest.mark.parametrize("mnemonic, expected", [
+    ("ldrbeq.w", ("ldrb", True)),
+    ("bls", ("b", True)),
+    ("bne.n", ("b", True)),
+    ("muls", ("mul", False)),
+    ("bl", ("bl", False)),
+    ("cbnz", ("cbnz", False)),
+    ("adds", ("adds", False)),
+])
+def test_split_mnemonic(wcet, mnemonic, expected):
+    assert wcet.split_mnemonic(mnemonic) == expected
+
+
+def test_parse_loop_bounds(wcet):
+    assert wcet.parse_loop_bounds("crc32=256, isr+2C=4 isr+0x30=2 ignored") == {
+        "crc32": 256, "isr+0x2c": 4, "isr+0x30": 2}
+
+
+def test_parse_priorities(wcet):
+    assert wcet.parse_priorities("TIMER0_IRQHandler=1, USART0_IRQHandler=0x2") == {
+        "TIMER0_IRQHandler": 1, "USART0_IRQHandler": 2}
+
+
+def test_unbounded_loop_is_counted_once(analyzer):
+    # movs, adds, cmp, bne, bx lr with the refill
+    assert analyzer().get_wcet("count") == (8, ["count"], {"unbounded loop"})
+
+
+@pytest.mark.parametrize("loop_bounds, default_loop_bound", [
+    ({"count": 10}, None),
+    ({"count+0x6": 10}, None),
+    ({}, 10),
+])
+def test_loop_bound(analyzer, loop_bounds, default_loop_bound):
+    # the body (adds, cmp, bne and the refill) runs 9 more times
+    cycles, _, flags = analyzer(loop_bounds, default_loop_bound).get_wcet("count")
+    assert cycles == 8 + 9 * 6
+    assert flags == set()
+
+
+def test_longest_path_takes_the_slower_branch(analyzer):
+    # cmp, beq not taken, sdiv, bx lr
+    assert analyzer().get_wcet("choose")[0] == 1 + 1 + 12 + 4
+
+
+def test_calls_and_jumps_into_other_functions(analyzer):
+    cycles, path, flags = analyzer().get_wcet("handler")
+    # push, bl with refill and callee, cbz into choose+0xa (movs, bx lr) that
+    # keeps the fall through, pop {pc} with refill
+    assert cycles == 3 + (4 + 18) + (4 + 5) + 6
+    assert path[:2] == ["handler", "choose"]
+    assert flags == set()
+
+
+def test_unconditional_tail_call(analyzer):
+    assert analyzer().get_wcet("tail") == (1 + 4 + 18, ["tail", "choose"], set())
+
+
+def test_latency_is_blocked_by_same_or_more_urgent_handlers(wcet):
+    def _results():
+        return [
+            {"function": "a", "handler": True, "cycles": 100},
+            {"function": "b", "handler": True, "cycles": 50},
+            {"function": "c", "handler": True, "cycles": 30},
+            {"function": "callback", "handler": False, "cycles": 500},
+        ]
+
+    results = _results()
+    wcet.get_latencies(results, {"a": 1, "b": 2}, 12)
+    assert [r["latency"] for r in results] == [12 + 30, 12 + 100, 12, None]
+
+    # all at the reset priority: every handler blocks every other one
+    results = _results()
+    wcet.get_latencies(results, {}, 12)
+    assert [r["latency"] for r in results] == [12 + 50, 12 + 100, 12 + 100, None]